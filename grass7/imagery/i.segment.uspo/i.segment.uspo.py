@@ -301,6 +301,8 @@ import os
 import atexit
 from multiprocessing import Process, Queue, current_process
 
+import numpy as np
+
 # check requirements
 
 # for python 3 compatibility
@@ -309,6 +311,9 @@ try:
 except NameError:
     xrange = range
 
+# null value of CELL rasters
+CELL_NULL = -2147483648
+
 def iteritems(dict):
     try:
         dictitems = dict.iteritems()
@@ -316,18 +321,6 @@ def iteritems(dict):
         dictitems = dict.items()
     return dictitems
 
-def check_progs():
-    found_missing = False
-    for prog in ['r.neighborhoodmatrix']:
-        if not gscript.find_program(prog, '--help'):
-
-            found_missing = True
-            gscript.warning(
-                _("'%s' required. Please install '%s' first using 'g.extension %s'") % (prog, prog, prog))
-    if found_missing:
-        gscript.fatal(_("An ERROR occurred running i.segment.uspo"))
-
-
 def cleanup():
     """ Delete temporary maps """
 
@@ -358,23 +351,10 @@ def rg_hier_worker(parms, thresholds, minsize_queue, result_queue):
             for mapname, threshold, minsize in map_list:
                 mapinfo = gscript.raster_info(mapname)
                 if mapinfo['max'] > mapinfo['min']:
-                    variance_per_raster = []
-                    autocor_per_raster = []
-                    neighbordict = get_nb_matrix(mapname)
-                    for raster in parms['rasters']:
-                        # there seems to be some trouble in ms windows with qualified
-                        # map names
-                        raster = raster.split('@')[0]
-                        var = get_variance(mapname, raster)
-                        variance_per_raster.append(var)
-                        autocor = get_autocorrelation(mapname, raster,
-                                                      neighbordict, parms['indicator'])
-                        autocor_per_raster.append(autocor)
-
-                    mean_lv = sum(variance_per_raster) / \
-                        len(variance_per_raster)
-                    mean_autocor = sum(autocor_per_raster) / \
-                        len(autocor_per_raster)
+                    mean_lv, mean_autocor = get_criteria(mapname,
+                                                         parms['rasters'],
+                                                         parms['indicator'],
+                                                         int(mapinfo['max']) + 1)
                     result_queue.put([mapname, mean_lv, mean_autocor,
                                       threshold, minsize])
                 else:
@@ -400,22 +380,10 @@ def rg_nonhier_worker(parms, parameter_queue, result_queue):
             mapname = rg_non_hierarchical_seg(parms, threshold, minsize)
             mapinfo = gscript.raster_info(mapname)
             if mapinfo['max'] > mapinfo['min']:
-                variance_per_raster = []
-                autocor_per_raster = []
-                neighbordict = get_nb_matrix(mapname)
-                for raster in parms['rasters']:
-                    # there seems to be some trouble in ms windows with qualified
-                    # map names
-                    raster = raster.split('@')[0]
-                    var = get_variance(mapname, raster)
-                    variance_per_raster.append(var)
-                    autocor = get_autocorrelation(mapname, raster,
-                                                  neighbordict, parms['indicator'])
-                    autocor_per_raster.append(autocor)
-
-                mean_lv = sum(variance_per_raster) / len(variance_per_raster)
-                mean_autocor = sum(autocor_per_raster) / \
-                    len(autocor_per_raster)
+                mean_lv, mean_autocor = get_criteria(mapname,
+                                                     parms['rasters'],
+                                                     parms['indicator'],
+                                                     int(mapinfo['max']) + 1)
                 result_queue.put(
                     [mapname, mean_lv, mean_autocor, threshold, minsize])
             else:
@@ -505,23 +473,14 @@ def ms_worker(parms, parameter_queue, result_queue):
     try:
         for threshold, hr, radius, minsize in iter(parameter_queue.get, 'STOP'):
             mapname = ms_seg(parms, threshold, hr, radius, minsize)
-            variance_per_raster = []
-            autocor_per_raster = []
-            neighbordict = get_nb_matrix(mapname)
-            for raster in parms['rasters']:
-                var = get_variance(mapname, raster)
-                variance_per_raster.append(var)
-                autocor = get_autocorrelation(mapname, raster,
-                                              neighbordict, parms['indicator'])
-                autocor_per_raster.append(autocor)
-
-            if len(variance_per_raster) > 0:
-                mean_lv = sum(variance_per_raster) / len(variance_per_raster)
+            mapinfo = gscript.raster_info(mapname)
+            if parms['rasters'] and mapinfo['max'] > mapinfo['min']:
+                mean_lv, mean_autocor = get_criteria(mapname,
+                                                     parms['rasters'],
+                                                     parms['indicator'],
+                                                     int(mapinfo['max']) + 1)
             else:
                 mean_lv = 999999
-            if len(autocor_per_raster) > 0:
-                mean_autocor = sum(autocor_per_raster) / len(autocor_per_raster)
-            else:
                 mean_autocor = 0
             result_queue.put([mapname, mean_lv, mean_autocor, threshold, hr,
                               radius, minsize])
@@ -572,111 +531,158 @@ def ms_seg(parms, threshold, hr, radius, minsize):
     return temp_segment_map_thresh
 
 
-def get_variance(mapname, raster):
-    """ Calculate intra-segment variance of the values of the given raster"""
-
-    # current_process name contains '-' which can cause problems so we replace
-    # with '_'
-    temp_map = "isegmentuspo_temp_variance_map_%d_%s" % (
-        os.getpid(), current_process().name.replace('-', '_'))
-    gscript.run_command('r.stats.zonal',
-                        base=mapname,
-                        cover=raster,
-                        method='variance',
-                        output=temp_map,
-                        overwrite=True,
-                        quiet=True)
-    univar = gscript.parse_command('r.univar',
-                                   map_=temp_map,
-                                   flags='g',
-                                   quiet=True)
-    var = float(univar['mean'])
-    gscript.run_command('g.remove',
-                        type_='raster',
-                        name=temp_map,
-                        flags='f',
-                        quiet=True)
-    return var
-
-
-def get_nb_matrix(mapname):
-    """ Create a dictionary with neighbors per segment"""
-
-    res = gscript.read_command('r.neighborhoodmatrix',
-                               input_=mapname,
-                               output='-',
-                               sep='comma',
-                               quiet=True)
-
-    neighbordict = {}
-    for line in res.splitlines():
-        n1 = line.split(',')[0]
-        n2 = line.split(',')[1]
-        if n1 in neighbordict:
-            neighbordict[n1].append(n2)
-        else:
-            neighbordict[n1] = [n2]
-
-    return neighbordict
-
-
-def get_autocorrelation(mapname, raster, neighbordict, indicator):
-    """ Calculate either Moran's I or Geary's C for values of the given raster """
-
-    raster_vars = gscript.parse_command('r.univar',
-                                        map_=raster,
-                                        flags='g',
-                                        quiet=True)
-    global_mean = float(raster_vars['mean'])
-
-    univar_res = gscript.read_command('r.univar',
-                                      flags='t',
-                                      map_=raster,
-                                      zones=mapname,
-                                      out='-',
-                                      sep='comma',
-                                      quiet=True)
-
-    means = {}
-    mean_diffs = {}
-    firstline = True
-    for line in univar_res.splitlines():
-        l = line.split(',')
-        if firstline:
-            i = l.index('mean')
-            firstline = False
-        else:
-            means[l[0]] = float(l[i])
-            mean_diffs[l[0]] = float(l[i]) - global_mean
-
-    sum_sq_mean_diffs = sum(x**2 for x in mean_diffs.values())
-
-    total_nb_neighbors = 0
-    for region in neighbordict:
-        total_nb_neighbors += len(neighbordict[region])
-
-    N = len(means)
-    sum_products = 0
-    sum_squared_differences = 0
-    for region in neighbordict:
-        region_value = means[region] - global_mean
-        neighbors = neighbordict[region]
-        nb_neighbors = len(neighbors)
-        for neighbor in neighbors:
-            neighbor_value = means[neighbor] - global_mean
-            sum_products += region_value * neighbor_value
-            sum_squared_differences = (means[region] - means[neighbor]) ** 2
+def read_row(rast, row):
+    """ Read a raster row as floats, with NaN for null cells """
+
+    values = np.array(rast[row], dtype=np.float64)
+    if rast.mtype == 'CELL':
+        values[values == CELL_NULL] = np.nan
+    return values
+
+
+def unique_pairs(pairs):
+    """ Merge a list of arrays of neighbor pair keys into unique keys """
+
+    if not pairs:
+        return np.empty(0, dtype=np.int64)
+    return np.unique(np.concatenate(pairs))
+
+
+def segment_statistics(mapname, rasters, nb_segments):
+    """ Compute segment statistics reading the segment map and the rasters
+    once.
+
+    Returns the number of cells of each segment, for each raster the number
+    of non-null cells, the sum and the variance of the values per segment
+    and the pairs of neighbor segments (4-connectivity), each pair being
+    stored once with the smaller id first.
+    """
+
+    from grass.pygrass.raster import RasterRow
+    from grass.pygrass.gis.region import Region
+
+    nrows = Region().rows
+    size = np.zeros(nb_segments, dtype=np.int64)
+    counts = np.zeros((len(rasters), nb_segments), dtype=np.int64)
+    sums = np.zeros((len(rasters), nb_segments))
+    sumsqs = np.zeros((len(rasters), nb_segments))
+    # values are shifted by the first valid value of each raster to limit
+    # the loss of precision of the sum of squares
+    shifts = [None] * len(rasters)
+    pairs = []
+    rows_pairs = []
+    seg = RasterRow(mapname.split('@')[0])
+    seg.open('r')
+    bands = []
+    for raster in rasters:
+        band = RasterRow(*raster.split('@'))
+        band.open('r')
+        bands.append(band)
+    try:
+        previous = None
+        for row in xrange(nrows):
+            ids = np.array(seg[row], dtype=np.int64)
+            valid = ids != CELL_NULL
+            ids[~valid] = 0
+            size += np.bincount(ids[valid], minlength=nb_segments)
+            for i, band in enumerate(bands):
+                values = read_row(band, row)
+                ok = valid & ~np.isnan(values)
+                if shifts[i] is None and ok.any():
+                    shifts[i] = values[ok][0]
+                vals = values[ok] - (shifts[i] or 0.)
+                counts[i] += np.bincount(ids[ok], minlength=nb_segments)
+                sums[i] += np.bincount(ids[ok], weights=vals,
+                                       minlength=nb_segments)
+                sumsqs[i] += np.bincount(ids[ok], weights=vals ** 2,
+                                         minlength=nb_segments)
+            # horizontal neighbors and vertical neighbors with previous row
+            neighbors = [(ids[:-1], ids[1:], valid[:-1] & valid[1:])]
+            if previous is not None:
+                neighbors.append((previous[0], ids, previous[1] & valid))
+            for first, second, both in neighbors:
+                diff = both & (first != second)
+                if diff.any():
+                    low = np.minimum(first[diff], second[diff])
+                    high = np.maximum(first[diff], second[diff])
+                    rows_pairs.append(np.unique(low * nb_segments + high))
+            previous = (ids, valid)
+            if len(rows_pairs) >= 256:
+                pairs.append(unique_pairs(rows_pairs))
+                rows_pairs = []
+    finally:
+        seg.close()
+        for band in bands:
+            band.close()
+    pairs = unique_pairs(pairs + rows_pairs)
+    pairs = (pairs // nb_segments, pairs % nb_segments)
+    # the variance does not depend on the shift, the sums do
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variances = np.maximum(sumsqs / counts - (sums / counts) ** 2, 0)
+    for i, shift in enumerate(shifts):
+        if shift:
+            sums[i] += counts[i] * shift
+    return size, counts, sums, variances, pairs
+
+
+def get_variance(size, count, variance):
+    """ Calculate the intra-segment variance of the values of a raster,
+    averaged over all the cells of the segments """
+
+    ok = count > 0
+    return float((variance[ok] * size[ok]).sum() / size[ok].sum())
+
+
+def get_autocorrelation(count, sum_, pairs, indicator):
+    """ Calculate either Moran's I or Geary's C for the segment means of
+    the values of a raster """
+
+    ok = count > 0
+    global_mean = sum_[ok].sum() / count[ok].sum()
+    means = np.zeros(len(count))
+    means[ok] = sum_[ok] / count[ok]
+    mean_diffs = means - global_mean
+    sum_sq_mean_diffs = (mean_diffs[ok] ** 2).sum()
+
+    first, second = pairs
+    neighbors = ok[first] & ok[second]
+    first, second = first[neighbors], second[neighbors]
+    # each pair is counted once, so both the number of neighbors and the
+    # sums are half of the ones of the symmetric definitions
+    total_nb_neighbors = len(first)
+    N = ok.sum()
 
     if indicator == 'morans':
+        sum_products = (mean_diffs[first] * mean_diffs[second]).sum()
         autocor = ((float(N) / total_nb_neighbors) *
                    (float(sum_products) / sum_sq_mean_diffs))
     elif indicator == 'geary':
+        sum_squared_differences = ((means[first] - means[second]) ** 2).sum()
         autocor = (float(N - 1) / (2 * total_nb_neighbors)) * \
             (float(sum_squared_differences) / sum_sq_mean_diffs)
 
     return autocor
 
 
+def get_criteria(mapname, rasters, indicator, nb_segments):
+    """ Calculate the mean intra-segment variance and the mean spatial
+    autocorrelation over all rasters for a segmentation """
+
+    size, counts, sums, variances, pairs = segment_statistics(mapname,
+                                                              rasters,
+                                                              nb_segments)
+    variance_per_raster = []
+    autocor_per_raster = []
+    for i in xrange(len(rasters)):
+        variance_per_raster.append(get_variance(size, counts[i],
+                                                variances[i]))
+        autocor_per_raster.append(get_autocorrelation(counts[i], sums[i],
+                                                      pairs, indicator))
+    mean_lv = sum(variance_per_raster) / len(variance_per_raster)
+    mean_autocor = sum(autocor_per_raster) / len(autocor_per_raster)
+    return mean_lv, mean_autocor
+
+
 def normalize_criteria(crit_list, direction):
     """ Normalize the optimization criteria """
 
@@ -741,8 +747,6 @@ def main():
         message += "INFO: Note that this leads to less optimal parallization."
         gscript.info(message)
 
-    check_progs()
-
     parms = {}
     group = options['group']
     parms['group'] = group
@@ -91,17 +91,28 @@
 #% description: Keep layer mahalanobis distance in reference domain?
 #%end
 
+#%option
+#% key: block_rows
+#% type: integer
+#% description: Number of rows read and processed together
+#% required: no
+#% answer: 256
+#% guisection: Input
+#%end
+
 # import libraries
 import os
 import sys
 import atexit
 import numpy as np
 import grass.script as gs
-import grass.script.array as garray
 import tempfile
 import uuid
 import string
 from grass.pygrass.modules import Module
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+from grass.pygrass.gis.region import Region
 from subprocess import PIPE
 
 COLORS_EXDET = """\
@@ -113,6 +124,8 @@ COLORS_EXDET = """\
 100% 219:65:0
 """
 
+CNULL = -2147483648  # null value for CELL maps
+
 # Functions
 CLEAN_LAY = []
 
@@ -144,25 +157,137 @@ def tmpname(prefix):
     return tmpf
 
 
-def CoVar(maps):
-    """Compute the covariance matrix over reference layers"""
-    tmpcov = tempfile.mkstemp()[1]
-    with open(tmpcov, "w") as text_file:
-        text_file.write(gs.read_command("r.covar", quiet=True, map=maps))
-    covar = np.loadtxt(tmpcov, skiprows=1)
-    os.remove(tmpcov)
-    VI = np.linalg.inv(covar)
-    return VI
+def set_region():
+    """Make the current region (changed by g.region) the region used
+    for reading and writing raster rows"""
+    reg = Region()
+    reg.read()
+    reg.set_raster_region()
+    return reg
+
+
+def open_maps(names):
+    """Open raster maps for reading"""
+    maps = [RasterRow(name) for name in names]
+    for rast in maps:
+        rast.open('r')
+    return maps
+
+
+def new_map(name, mtype='DCELL'):
+    """Open a new raster map for writing"""
+    rast = RasterRow(name)
+    rast.open('w', mtype=mtype, overwrite=gs.overwrite())
+    return rast
+
+
+def close_maps(maps):
+    for rast in maps:
+        if rast.is_open():
+            rast.close()
+
+
+def read_block(maps, start, stop):
+    """Return the rows start..stop-1 of the maps as (maps, cells) array,
+    null cells are NaN"""
+    block = np.array([[rast[row] for row in range(start, stop)]
+                      for rast in maps], dtype=np.double)
+    for i, rast in enumerate(maps):
+        if rast.mtype == "CELL":
+            block[i][block[i] == CNULL] = np.nan
+    return block.reshape(len(maps), -1)
+
+
+def write_block(rast, values, cols):
+    """Write the cells of a block of rows to the next rows of rast"""
+    for row in values.reshape(-1, cols):
+        buf = Buffer((cols,), rast.mtype)
+        buf[:] = row
+        rast.put_row(buf)
+
+
+def blocks(rows, block_rows):
+    """Return the (start, stop) rows of the blocks"""
+    return [(start, min(start + block_rows, rows))
+            for start in range(0, rows, block_rows)]
+
+
+def CoVar(maps, block_rows, leave_one_out=False):
+    """Compute univariate statistics and the inverse of the covariance matrix
+    over reference layers in one pass by blocks of rows. As r.covar, the
+    covariance uses the cells where none of the layers is null.
+
+    If leave_one_out is True, return also the inverse covariance matrices
+    of the layers without layer i (for each i), computed over the cells
+    where none of the other layers is null.
+    """
+    s = len(maps)
+    masks = s + 1 if leave_one_out else 1
+    count = np.zeros(masks)
+    sums = np.zeros((masks, s))
+    prods = np.zeros((masks, s, s))
+    nmin = np.full(s, np.inf)
+    nmax = np.full(s, -np.inf)
+    nsum = np.zeros(s)
+    ncount = np.zeros(s)
+    shift = None
+    reg = Region()
+    rasts = open_maps(maps)
+    try:
+        for start, stop in blocks(reg.rows, block_rows):
+            data = read_block(rasts, start, stop)
+            valid = np.isfinite(data)
+            ncount += valid.sum(axis=1)
+            nsum += np.where(valid, data, 0).sum(axis=1)
+            nmin = np.minimum(nmin, np.where(valid, data, np.inf).min(axis=1))
+            nmax = np.maximum(nmax, np.where(valid, data, -np.inf).max(axis=1))
+            if shift is None:
+                # shifted sums keep the covariance accurate
+                shift = np.where(valid, data, 0).sum(axis=1) / \
+                    np.maximum(valid.sum(axis=1), 1)
+            delta = np.where(valid, data - shift[:, None], 0)
+            nulls = (~valid).sum(axis=0)
+            for m in range(masks):
+                if m == 0:
+                    cells = nulls == 0
+                else:
+                    cells = nulls == (~valid[m - 1]).astype(int)
+                d = delta[:, cells]
+                count[m] += d.shape[1]
+                sums[m] += d.sum(axis=1)
+                prods[m] += np.einsum('ip,jp->ij', d, d)
+    finally:
+        close_maps(rasts)
+    if not ncount.all():
+        gs.fatal(_("One of the reference layers has only null cells"))
+
+    VI = []
+    for m in range(masks):
+        if count[m] < 2:
+            gs.fatal(_("Not enough non-null reference cells to compute "
+                       "the covariance"))
+        covar = (prods[m] - np.outer(sums[m], sums[m]) / count[m]) / \
+            (count[m] - 1)
+        if m > 0:
+            covar = np.delete(np.delete(covar, m - 1, axis=0), m - 1, axis=1)
+        VI.append(np.linalg.inv(covar))
+    stats = dict(min=nmin, max=nmax, mean=nsum / ncount)
+    return stats, VI[0], VI[1:]
 
 
 def mahal(v, m, VI):
-    """Compute the mahalanobis distance over reference layers"""
-    delta = v - m[:, None, None]
-    mahdist = np.sum(np.sum(delta[None, :, :, :] *
-                     VI[:, :, None, None], axis=1) * delta, axis=0)
-    stat_mahal = garray.array()
-    stat_mahal[...] = mahdist
-    return stat_mahal
+    """Compute the mahalanobis distance of the cells v (layers, cells)"""
+    delta = v - m[:, None]
+    return np.einsum('ip,ij,jp->p', delta, VI, delta)
+
+
+def nanargmin(values):
+    """Index of the minimum over the layers (axis 0), ignoring nulls as
+    r.series method=min_raster does; NaN where all layers are null"""
+    idx = np.argmin(np.where(np.isnan(values), np.inf, values), axis=0)
+    idx = idx.astype(np.double)
+    idx[np.isnan(values).all(axis=0)] = np.nan
+    return idx
 
 
 def main(options, flags):
@@ -183,6 +308,7 @@ def main(options, flags):
     opn = [z.split('@')[0] for z in PRO]
     out = options['output']
     region = options['region']
+    block_rows = int(options['block_rows'])
     flag_d = flags['d']
     flag_e = flags['e']
     flag_p = flags['p']
@@ -212,43 +338,34 @@ def main(options, flags):
     with open(tmphist, "w") as text_file:
         text_file.write(hist)
 
-    # Create covariance table
-    VI = CoVar(maps=REF)
-
-    # Import reference data & compute univar stats per reference layer
-    s = len(REF)
-    dat_ref = stat_mean = stat_min = stat_max = None
-    layer = garray.array()
-
-    for i, map in enumerate(REF):
-        layer.read(map, null=np.nan)
-        r, c = layer.shape
-        if dat_ref is None:
-            dat_ref = np.empty((s, r, c), dtype=np.double)
-        if stat_mean is None:
-            stat_mean = np.empty((s), dtype=np.double)
-        if stat_min is None:
-            stat_min = np.empty((s), dtype=np.double)
-        if stat_max is None:
-            stat_max = np.empty((s), dtype=np.double)
-        stat_min[i] = np.nanmin(layer)
-        stat_mean[i] = np.nanmean(layer)
-        stat_max[i] = np.nanmax(layer)
-        dat_ref[i, :, :] = layer
-    del layer
+    # Compute univar stats per reference layer and covariance table
+    reg = set_region()
+    stats, VI, VItmp = CoVar(maps=REF, block_rows=block_rows,
+                             leave_one_out=flag_p)
+    stat_min, stat_mean, stat_max = stats['min'], stats['mean'], stats['max']
 
     # Compute mahalanobis over full set of reference layers
-    mahal_ref = mahal(v=dat_ref, m=stat_mean, VI=VI)
-    mahal_ref_max = max(mahal_ref[np.isfinite(mahal_ref)])
+    mahal_ref_max = -np.inf
+    rasts = open_maps(REF)
+    mahalref = "{}_mahalref".format(out)
+    outs = [new_map(mahalref)] if flag_e else []
+    try:
+        for start, stop in blocks(reg.rows, block_rows):
+            mahal_ref = mahal(v=read_block(rasts, start, stop), m=stat_mean,
+                              VI=VI)
+            finite = mahal_ref[np.isfinite(mahal_ref)]
+            if finite.size:
+                mahal_ref_max = max(mahal_ref_max, finite.max())
+            if flag_e:
+                write_block(outs[0], mahal_ref, reg.cols)
+    finally:
+        close_maps(rasts + outs)
     if flag_e:
-        mahalref = "{}_mahalref".format(out)
-        mahal_ref.write(mapname=mahalref)
         gs.info(_("Mahalanobis distance map saved: {}").format(mahalref))
         gs.run_command("r.support", map=mahalref,
                        title="Mahalanobis distance map", units="unitless",
                        description="Mahalanobis distance map in reference "
                                    "domain", loadhistory=tmphist)
-    del mahal_ref
 
     # Remove mask and set new region based on user-defined region or
     # otherwise based on projection layers
@@ -261,24 +378,84 @@ def main(options, flags):
         gs.run_command("g.region", raster=PRO[0])
         # TODO: only set region to PRO[0] when different from current region
         gs.info(_("The region has set to match the proj raster layers"))
+    reg = set_region()
 
-    # Import projected layers in numpy array
-    s = len(PRO)
-    dat_pro = None
-    layer = garray.array()
-    for i, map in enumerate(PRO):
-        layer.read(map, null=np.nan)
-        r, c = layer.shape
-        if dat_pro is None:
-            dat_pro = np.empty((s, r, c), dtype=np.double)
-        dat_pro[i, :, :] = layer
-    del layer
-
-    # Compute mahalanobis distance
-    mahal_pro = mahal(v=dat_pro, m=stat_mean, VI=VI)
+    # Compute NT1, NT2, the mahalanobis distance and the most influential
+    # covariate (MIC) metrics by blocks of projected layers
+    nt1 = "{}_NT1".format(out)
+    nt2 = "{}_NT2".format(out)
+    nt12 = "{}_NT1NT2".format(out)
+    mahalpro = "{}_mahalpro".format(out)
+    mic12 = "{}_MICNT1and2".format(out)
+    rasts = open_maps(PRO)
+    outs = []
+    try:
+        out_nt1 = new_map(nt1)
+        outs.append(out_nt1)
+        out_nt2 = new_map(nt2)
+        outs.append(out_nt2)
+        out_nt12 = new_map(nt12)
+        outs.append(out_nt12)
+        if flag_d:
+            out_mahal = new_map(mahalpro)
+            outs.append(out_mahal)
+        if flag_p:
+            out_mic = new_map(mic12, mtype='CELL')
+            outs.append(out_mic)
+        for start, stop in blocks(reg.rows, block_rows):
+            dat_pro = read_block(rasts, start, stop)
+
+            # Compute NT1
+            # TODO: computations below sometimes result in very small
+            # negative numbers, which are not 'real', but rather due to some
+            # differences in handling digits, hence the threshold.
+            # Need to figure out how to handle this better.
+            with np.errstate(divide='ignore', invalid='ignore'):
+                Dij = np.minimum(np.minimum(dat_pro - stat_min[:, None],
+                                            stat_max[:, None] - dat_pro), 0)
+                Dij /= (stat_max - stat_min)[:, None]
+                Dij[Dij > -0.000000001] = 0
+            tmplay = np.nansum(Dij, axis=0)
+            tmplay[np.isnan(Dij).all(axis=0)] = np.nan
+
+            # Compute NT2
+            mahal_pro = mahal(v=dat_pro, m=stat_mean, VI=VI)
+            tmpla2 = mahal_pro / mahal_ref_max
+
+            # Compute nt1, nt2, and nt1and2 novelty maps
+            with np.errstate(invalid='ignore'):
+                novel = tmplay < 0
+                similar = tmplay >= 0
+            write_block(out_nt1, np.where(novel, tmplay, np.nan), reg.cols)
+            write_block(out_nt2, np.where(similar, tmpla2, np.nan), reg.cols)
+            write_block(out_nt12, np.where(novel, tmplay,
+                                           np.where(similar, tmpla2, np.nan)),
+                        reg.cols)
+            if flag_d:
+                write_block(out_mahal, mahal_pro, reg.cols)
+
+            # Compute most influential covariate (MIC) metric for NT1 and
+            # for NT2. In Mesgaran et al, the MIC2 is the max icp, but that
+            # is the same as the minimum mahalanobis distance (ymap)
+            # icp = (mahal_pro - ymap) / mahal_pro * 100
+            if flag_p:
+                tmpla1 = nanargmin(Dij)
+                ymap = np.array([mahal(v=np.delete(dat_pro, i, axis=0),
+                                       m=np.delete(stat_mean, i, axis=0),
+                                       VI=VItmp[i])
+                                 for i in range(len(PRO))])
+                tmpla3 = nanargmin(ymap)
+                with np.errstate(invalid='ignore'):
+                    mic = np.where(similar,
+                                   np.where(tmpla2 > 1, tmpla3, -1),
+                                   tmpla1)
+                mic[np.isnan(tmplay) | np.isnan(mic) |
+                    (similar & np.isnan(tmpla2))] = CNULL
+                write_block(out_mic, mic, reg.cols)
+            gs.percent(stop, reg.rows, 1)
+    finally:
+        close_maps(rasts + outs)
     if flag_d:
-        mahalpro = "{}_mahalpro".format(out)
-        mahal_pro.write(mapname=mahalpro)
         gs.info(_("Mahalanobis distance map saved: {}").format(mahalpro))
         gs.run_command("r.support", map=mahalpro,
                        title="Mahalanobis distance map projection domain",
@@ -286,72 +463,6 @@ def main(options, flags):
                        description="Mahalanobis distance map in projection "
                        "domain estimated using covariance of refence data")
 
-    # Compute NT1
-    tmplay = tmpname(out)
-    mnames = [None] * len(REF)
-    for i in xrange(len(REF)):
-        tmpout = tmpname("exdet")
-        # TODO: computations below sometimes result in very small negative
-        # numbers, which are not 'real', but rather due to some differences
-        # in handling digits in grass and python, hence second mapcalc
-        # statement. Need to figure out how to handle this better.
-        gs.mapcalc("eval("
-                   "tmp = min(($prolay - $refmin), ($refmax - $prolay),0) / "
-                   "($refmax - $refmin))\n"
-                   "$Dij = if(tmp > -0.000000001, 0, tmp)",
-                   Dij=tmpout, prolay=PRO[i], refmin=stat_min[i],
-                   refmax=stat_max[i], quiet=True)
-        mnames[i] = tmpout
-    gs.run_command("r.series", quiet=True, input=mnames, output=tmplay,
-                   method="sum")
-
-    # Compute most influential covariate (MIC) metric for NT1
-    if flag_p:
-        tmpla1 = tmpname(out)
-        gs.run_command("r.series", quiet=True, output=tmpla1, input=mnames,
-                       method="min_raster")
-
-    # Compute NT2
-    tmpla2 = tmpname(out)
-    nt2map = garray.array()
-    nt2map[...] = mahal_pro / mahal_ref_max
-    nt2map.write(mapname=tmpla2)
-
-    # Compute  most influential covariate (MIC) metric for NT2
-    if flag_p:
-        tmpla3 = tmpname(out)
-        laylist = []
-        layer = garray.array()
-        for i, map in enumerate(opn):
-            gs.use_temp_region()
-            gs.run_command("g.region", quiet=True, region=regbu1)
-            REFtmp = [x for num, x in enumerate(REF) if not num == i]
-            stattmp = np.delete(stat_mean, i, axis=0)
-            VItmp = CoVar(maps=REFtmp)
-            gs.del_temp_region()
-            dat_protmp = np.delete(dat_pro, i, axis=0)
-            ymap = mahal(v=dat_protmp, m=stattmp, VI=VItmp)
-            # in Mesgaran et al, the MIC2 is the max icp, but that is the
-            # same as the minimum mahalanobis distance (ymap)
-            # icp = (mahal_pro - ymap) / mahal_pro * 100
-            layer[:, :] = ymap
-            tmpmahal = tmpname(out)
-            layer.write(tmpmahal)
-            laylist.append(tmpmahal)
-        gs.run_command("r.series", quiet=True, output=tmpla3,
-                       input=laylist, method="min_raster", overwrite=True)
-
-    # Compute nt1, nt2, and nt1and2 novelty maps
-    nt1 = "{}_NT1".format(out)
-    nt2 = "{}_NT2".format(out)
-    nt12 = "{}_NT1NT2".format(out)
-    expr = ";".join([
-        "$nt12 = if($tmplay < 0, $tmplay, $tmpla2)",
-        "$nt2 = if($tmplay >= 0, $tmpla2, null())",
-        "$nt1 = if($tmplay < 0, $tmplay, null())"])
-    gs.mapcalc(expr, nt12=nt12, nt1=nt1, nt2=nt2, tmplay=tmplay,
-               tmpla2=tmpla2, quiet=True)
-
     # Write metadata nt1, nt2, nt1and2  maps
     gs.run_command("r.support", map=nt1, units="unitless",
                    title="Type 1 similarity",
@@ -366,14 +477,8 @@ def main(options, flags):
                    description="Type 1 + 2 similarity (NT1)",
                    loadhistory=tmphist)
 
-    # Compute MIC maps
+    # Write MIC maps metadata
     if flag_p:
-        mic12 = "{}_MICNT1and2".format(out)
-        expr = "$mic12 = if($tmplay < 0, $tmpla1, " \
-               "if($tmpla2>1, $tmpla3, -1))"
-        gs.mapcalc(expr, tmplay=tmplay, tmpla1=tmpla1, tmpla2=tmpla2,
-                   tmpla3=tmpla3, mic12=mic12, quiet=True)
-
         # Write category labels to MIC maps
         tmpcat = tempfile.mkstemp()
         with open(tmpcat[1], "w") as text_file:
@@ -34,6 +34,18 @@
 #% description: r.futures.pga runs for each subregion and after all subregions are completed, the results are patched together
 #% guisection: Parallel
 #%end
+#%flag
+#% key: r
+#% label: Resumes an interrupted computation
+#% description: Runs (and subregion runs with -d) whose output already exists are not computed again
+#% guisection: Parallel
+#%end
+#%flag
+#% key: s
+#% label: Does not keep the output of each run
+#% description: Only the ensemble outputs are written
+#% guisection: Ensemble
+#%end
 #%option
 #% key: nprocs
 #% type: integer
@@ -253,17 +265,76 @@
 #% answer: 1
 #% guisection: Scenarios
 #%end
+#%option
+#% key: probability
+#% type: string
+#% required: no
+#% multiple: no
+#% key_desc: name
+#% description: Probability of development computed from all the runs
+#% gisprompt: new,cell,raster
+#% guisection: Ensemble
+#%end
+#%option
+#% key: mean
+#% type: string
+#% required: no
+#% multiple: no
+#% key_desc: name
+#% description: Mean step of development of the runs in which the cell is developed
+#% gisprompt: new,cell,raster
+#% guisection: Ensemble
+#%end
+#%option
+#% key: variance
+#% type: string
+#% required: no
+#% multiple: no
+#% key_desc: name
+#% description: Variance of the step of development of the runs in which the cell is developed
+#% gisprompt: new,cell,raster
+#% guisection: Ensemble
+#%end
+#%option
+#% key: percentiles
+#% type: double
+#% required: no
+#% multiple: yes
+#% options: 0-100
+#% description: Percentiles of the step of development computed from all the runs
+#% guisection: Ensemble
+#%end
+#%option
+#% key: percentile_output
+#% type: string
+#% required: no
+#% multiple: no
+#% key_desc: basename
+#% description: Basename of the percentile outputs, the percentile is used as suffix
+#% gisprompt: new,cell,raster
+#% guisection: Ensemble
+#%end
+#%rules
+#% requires: -s,probability,mean,variance,percentile_output
+#% collective: percentiles,percentile_output
+#%end
 
 import os
 import sys
+import json
+import shutil
 import atexit
 from multiprocessing import Pool
 
+import numpy as np
+
 import grass.script as gscript
 from grass.exceptions import CalledModuleError
 
 TMP_RASTERS = []
 PREFIX = 'tmprfuturesparallelpga'
+# maximum number of bins of the per-cell histogram used for percentiles
+PERCENTILE_BINS = 16
 
 
 def cleanup():
@@ -283,21 +354,226 @@ def futures_process(params):
             gscript.message(_("Running simulation {s}/{r}".format(s=seed, r=repeat)))
             gscript.run_command('r.futures.pga', **options)
     except (KeyboardInterrupt, CalledModuleError):
-        return
+        return seed, cat, False
+    return seed, cat, True
 
 
-def split_subregions(expr):
-    try:
-        gscript.mapcalc(expr)
-    except (KeyboardInterrupt, CalledModuleError):
-        return
+class Ensemble(object):
+    """Per-cell accumulators of the runs, updated as soon as each run is
+    completed so that the runs do not need to be kept.
+
+    The accumulators are memory mapped files in the directory path, together
+    with the list of accumulated runs, so an interrupted computation can be
+    resumed. For each cell they store whether the cell is in the study area,
+    the number of runs in which the cell is developed, mean and sum of
+    squared differences of the step of development (Welford algorithm) and,
+    if percentiles are requested, the histogram of the step of development.
+    The histogram has at most PERCENTILE_BINS bins, so its size does not
+    depend on the number of steps; with more steps than bins the steps are
+    grouped and the percentiles are interpolated within the bin.
+
+    Each run is accumulated into new files, which replace the current ones
+    only once the run is completely accumulated. A journal with the new list
+    of runs is written before the files are replaced, so that an interrupted
+    run is either discarded or completed when resuming, and never
+    accumulated twice.
+    """
+    def __init__(self, path, rows, cols, nsteps, percentiles=False,
+                 resume=False):
+        self.path = path
+        self.rows = rows
+        self.cols = cols
+        self.nsteps = nsteps
+        self.binwidth = -(-(nsteps + 1) // PERCENTILE_BINS)
+        self.runs = []
+        shape = (rows, cols)
+        self.arrays = {'valid': (np.bool_, shape),
+                       'count': (np.uint32, shape),
+                       'mean': (np.float64, shape),
+                       'm2': (np.float64, shape)}
+        if percentiles:
+            nbins = -(-(nsteps + 1) // self.binwidth)
+            self.arrays['hist'] = (np.uint32, shape + (nbins,))
+        if not resume:
+            shutil.rmtree(path, ignore_errors=True)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if os.path.exists(self._join('journal.json')):
+            # interrupted while replacing the files of a complete run
+            self._apply_journal()
+        else:
+            self._discard()
+        if resume and os.path.exists(self._join('runs.json')):
+            with open(self._join('runs.json')) as state:
+                self.runs = json.load(state)
+        if self.runs:
+            self._check()
+        mode = 'r+' if self.runs else 'w+'
+        self.hist = None
+        for key in self.arrays:
+            setattr(self, key, self._memmap(key, mode))
+
+    def _join(self, name):
+        return os.path.join(self.path, name)
+
+    def _memmap(self, key, mode, ext='.dat'):
+        dtype, shape = self.arrays[key]
+        return np.memmap(self._join(key + ext), dtype=dtype, mode=mode,
+                         shape=shape)
+
+    def _check(self):
+        """Check that the accumulators of the resumed runs can be used"""
+        for key, (dtype, shape) in self.arrays.items():
+            name = self._join(key + '.dat')
+            if key == 'hist' and not os.path.exists(name):
+                gscript.fatal(_("The accumulated runs have no histogram, option"
+                                " percentiles cannot be added when resuming"))
+            size = np.dtype(dtype).itemsize * int(np.prod(shape))
+            if not os.path.exists(name) or os.path.getsize(name) != size:
+                gscript.fatal(_("The accumulated runs in <{p}> do not match the"
+                                " current region and options, remove the"
+                                " directory to start again").format(p=self.path))
+
+    def _replace(self, src, dst):
+        # os.rename does not overwrite on Windows
+        if sys.platform == 'win32' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+    def _apply_journal(self):
+        """Replace the accumulators with the new files of the journal"""
+        for key in self.arrays:
+            if os.path.exists(self._join(key + '.new')):
+                self._replace(self._join(key + '.new'), self._join(key + '.dat'))
+        self._replace(self._join('journal.json'), self._join('runs.json'))
+
+    def _discard(self):
+        """Remove the files of a run interrupted before it was completed"""
+        for key in self.arrays:
+            if os.path.exists(self._join(key + '.new')):
+                os.remove(self._join(key + '.new'))
+
+    def add(self, name, run):
+        """Add the output of a run to the accumulators"""
+        from grass.pygrass.raster import RasterRow
+        new = dict((key, self._memmap(key, 'w+', '.new')) for key in self.arrays)
+        with RasterRow(name) as rast:
+            for row in range(self.rows):
+                # -1 undeveloped, 0 initially developed, >0 step of
+                # development, nulls are the most negative integer
+                x = np.array(rast[row], dtype=np.int64)
+                new['valid'][row] = self.valid[row] | (x >= -1)
+                dev = x >= 0
+                count = self.count[row] + dev
+                mean = self.mean[row]
+                delta = np.where(dev, x - mean, 0.)
+                newmean = mean + delta / np.maximum(count, 1)
+                new['m2'][row] = self.m2[row] + delta * np.where(dev, x - newmean, 0.)
+                new['mean'][row] = newmean
+                new['count'][row] = count
+                if self.hist is not None:
+                    hist = np.array(self.hist[row])
+                    idx = np.nonzero(dev)[0]
+                    bins = np.minimum(x[idx], self.nsteps) // self.binwidth
+                    hist[idx, bins] += 1
+                    new['hist'][row] = hist
+        for array in new.values():
+            array.flush()
+        # the new files are complete, from now on the run is accumulated
+        # even if the replacement is interrupted
+        with open(self._join('journal.tmp'), 'w') as journal:
+            json.dump(self.runs + [run], journal)
+        self._replace(self._join('journal.tmp'), self._join('journal.json'))
+        # close the memory maps before their files are replaced
+        new.clear()
+        for key in self.arrays:
+            setattr(self, key, None)
+        self._apply_journal()
+        self.runs.append(run)
+        for key in self.arrays:
+            setattr(self, key, self._memmap(key, 'r+'))
+
+    def probability(self, row):
+        prob = self.count[row] / float(len(self.runs))
+        return np.where(self.valid[row], prob, np.nan)
+
+    def mean_step(self, row):
+        return np.where(self.count[row] > 0, self.mean[row], np.nan)
+
+    def variance_step(self, row):
+        count = self.count[row]
+        return np.where(count > 0, self.m2[row] / np.maximum(count, 1), np.nan)
+
+    def percentile_step(self, row, percentile):
+        """Step by which the cell is developed in percentile % of the runs,
+        interpolated linearly within the histogram bin"""
+        hist = self.hist[row]
+        cumulative = hist.cumsum(axis=1)
+        target = percentile / 100. * len(self.runs)
+        reached = cumulative >= target
+        cells = np.arange(self.cols)
+        b = np.argmax(reached, axis=1)
+        inbin = hist[cells, b].astype(np.float64)
+        before = cumulative[cells, b] - inbin
+        fraction = (target - before) / np.maximum(inbin, 1)
+        # steps of bin b are b * binwidth, ..., (b + 1) * binwidth - 1
+        step = b * self.binwidth + np.ceil(fraction * self.binwidth) - 1
+        step = np.clip(step, b * self.binwidth, self.nsteps)
+        return np.where(reached[:, -1] & self.valid[row], step, np.nan)
+
+    def write(self, name, func, *args):
+        """Write a raster computing each row with func"""
+        from grass.pygrass.raster import RasterRow
+        from grass.pygrass.raster.buffer import Buffer
+        with RasterRow(name, mode='w', mtype='FCELL',
+                       overwrite=gscript.overwrite()) as out:
+            for row in range(self.rows):
+                buf = Buffer((self.cols,), mtype='FCELL')
+                buf[:] = func(row, *args)
+                out.put_row(buf)
+        gscript.raster_history(name)
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def demand_steps(demand):
+    """Number of steps of the demand file, the first line is the header"""
+    with open(demand) as f:
+        return len([line for line in f if line.strip()]) - 1
+
+
+def split_subregions(subregions, cats):
+    """Create the rasters of all the subregions with a single r.mapcalc run,
+    so that the subregions map is read only once"""
+    expr = '\n'.join('{new} = if({sub} == {cat}, {sub}, null())'.format(
+        sub=subregions, cat=cat, new=PREFIX + cat) for cat in cats)
+    gscript.mapcalc(expr, quiet=True, overwrite=True)
+
+
+def exists(name):
+    return bool(gscript.find_file(name, element='cell',
+                                  mapset=gscript.gisenv()['MAPSET'])['file'])
+
+
+def patch_run(output, run, cats):
+    """Patch the subregions of a run and remove them"""
+    patch_input = [output + '_run' + str(run) + '_' + cat for cat in cats]
+    gscript.run_command('r.patch', input=patch_input, output=output + '_run' + str(run),
+                        quiet=True)
+    gscript.run_command('g.remove', type='raster', name=patch_input, flags='f', quiet=True)
 
 
 def main():
     repeat = int(options.pop('repeat'))
     nprocs = int(options.pop('nprocs'))
+    ensemble_outputs = {key: options.pop(key) for key in
+                        ('probability', 'mean', 'variance', 'percentile_output')}
+    percentiles = [float(p) for p in options.pop('percentiles').split(',') if p]
     subregions = options['subregions']
     tosplit = flags['d']
+    resume = flags['r']
+    keep_runs = not flags['s']
     # filter unused optional params
     for key in list(options.keys()):
         if options[key] == '':
@@ -305,61 +581,125 @@ def main():
     if tosplit and 'output_series' in options:
         gscript.fatal(_("Parallelization on subregion level is not supported together with <output_series> option"))
 
-    if not gscript.overwrite() and gscript.list_grouped('raster', pattern=options['output'] + '_run1')[gscript.gisenv()['MAPSET']]:
+    if not resume and not gscript.overwrite() and exists(options['output'] + '_run1'):
         gscript.fatal(_("Raster map <{r}> already exists."
-                     " To overwrite, use the --overwrite flag").format(r=options['output'] + '_run_1'))
+                     " To overwrite, use the --overwrite flag").format(r=options['output'] + '_run1'))
     global TMP_RASTERS
+
+    ensemble = None
+    if any(ensemble_outputs.values()):
+        genv = gscript.gisenv()
+        region = gscript.region()
+        nsteps = (int(options['num_steps']) if 'num_steps' in options
+                  else demand_steps(options['demand']))
+        path = os.path.join(genv['GISDBASE'], genv['LOCATION_NAME'], genv['MAPSET'],
+                            'rfuturesparallelpga', options['output'])
+        ensemble = Ensemble(path, region['rows'], region['cols'], nsteps,
+                            percentiles=bool(percentiles), resume=resume)
+
+    def run_completed(run):
+        name = options['output'] + '_run' + str(run)
+        if ensemble is not None and run not in ensemble.runs:
+            gscript.message(_("Adding run {r} to the ensemble").format(r=run))
+            ensemble.add(name, run)
+        if not keep_runs:
+            gscript.run_command('g.remove', type='raster', name=name, flags='f', quiet=True)
+
+    runs = []
+    for i in range(repeat):
+        run = i + 1
+        if resume and exists(options['output'] + '_run' + str(run)):
+            # completed, but maybe not accumulated
+            run_completed(run)
+        elif not (resume and ensemble is not None and run in ensemble.runs):
+            runs.append(run)
+    if resume and len(runs) < repeat:
+        gscript.message(_("Resuming, {n} runs are already completed").format(n=repeat - len(runs)))
+
     cats = []
     if tosplit:
         gscript.message(_("Splitting subregions"))
-        cats = gscript.read_command('r.stats', flags='n', input=subregions).strip().splitlines()
+        # number of cells of each subregion is used as the expected cost
+        stats = gscript.read_command('r.stats', flags='cn', input=subregions).strip().splitlines()
+        cost = dict(line.split() for line in stats)
+        # the biggest subregions are run first, so that the small ones
+        # fill the processes at the end of each run
+        cats = sorted(cost, key=lambda cat: int(cost[cat]), reverse=True)
         if len(cats) < 2:
             gscript.fatal(_("Not enough subregions to split computation. Do not use -d flag."))
-        mapcalcs = []
-        for cat in cats:
-            new = PREFIX + cat
-            TMP_RASTERS.append(new)
-            mapcalcs.append('{new} = if({sub} == {cat}, {sub}, null())'.format(sub=subregions, cat=cat, new=new))
-        pool = Pool(nprocs)
-        p = pool.map_async(split_subregions, mapcalcs)
-        try:
-            p.get()
-        except (KeyboardInterrupt, CalledModuleError):
-            return
+        TMP_RASTERS.extend(PREFIX + cat for cat in cats)
+        missing = [cat for cat in cats if not (resume and exists(PREFIX + cat))]
+        if runs and missing:
+            split_subregions(subregions, missing)
 
     options_list = []
-    for i in range(repeat):
+    remaining = {}
+    for run in runs:
         if cats:
+            remaining[run] = set(cats)
             for cat in cats:
                 op = options.copy()
-                op['random_seed'] = i + 1
-                if 'output_series' in op:
-                    op['output_series'] += '_run' + str(i + 1) + '_' + cat
-                    TMP_RASTERS.append(op['output_series'])
-                op['output'] += '_run' + str(i + 1) + '_' + cat
+                op['random_seed'] = run
+                op['output'] += '_run' + str(run) + '_' + cat
                 op['subregions'] = PREFIX + cat
-                options_list.append((repeat, i + 1, cat, op))
-                TMP_RASTERS.append(op['output'])
+                # completed subregions are kept for -r and removed by patch_run
+                if resume and exists(op['output']):
+                    remaining[run].discard(cat)
+                    continue
+                options_list.append((repeat, run, cat, op))
         else:
             op = options.copy()
-            op['random_seed'] = i + 1
+            op['random_seed'] = run
             if 'output_series' in op:
-                op['output_series'] += '_run' + str(i + 1)
-            op['output'] += '_run' + str(i + 1)
-            options_list.append((repeat, i + 1, None, op))
+                op['output_series'] += '_run' + str(run)
+            op['output'] += '_run' + str(run)
+            options_list.append((repeat, run, None, op))
+
+    # runs completed before an interruption only need to be patched
+    for run in runs:
+        if cats and not remaining[run]:
+            patch_run(options['output'], run, cats)
+            run_completed(run)
 
+    failed = 0
     pool = Pool(nprocs)
-    p = pool.map_async(futures_process, options_list)
     try:
-        p.get()
+        # jobs are handed out one by one, each run is patched and added to
+        # the ensemble as soon as all its subregions are completed
+        for run, cat, success in pool.imap_unordered(futures_process, options_list, chunksize=1):
+            if not success:
+                failed += 1
+                continue
+            if cat:
+                remaining[run].discard(cat)
+                if not remaining[run]:
+                    gscript.message(_("Patching subregions of run {r}").format(r=run))
+                    patch_run(options['output'], run, cats)
+                    run_completed(run)
+            else:
+                run_completed(run)
     except (KeyboardInterrupt, CalledModuleError):
-        return
+        pool.terminate()
+        return 1
+    finally:
+        pool.close()
+        pool.join()
+    if failed:
+        gscript.fatal(_("{n} simulations failed, use -r flag to resume the computation").format(n=failed))
 
-    if cats:
-        gscript.message(_("Patching subregions"))
-        for i in range(repeat):
-            patch_input = [options['output'] + '_run' + str(i + 1) + '_' + cat for cat in cats]
-            gscript.run_command('r.patch', input=patch_input, output=options['output'] + '_run' + str(i + 1))
+    if ensemble is not None:
+        gscript.message(_("Writing the ensemble outputs"))
+        if ensemble_outputs['probability']:
+            ensemble.write(ensemble_outputs['probability'], ensemble.probability)
+        if ensemble_outputs['mean']:
+            ensemble.write(ensemble_outputs['mean'], ensemble.mean_step)
+        if ensemble_outputs['variance']:
+            ensemble.write(ensemble_outputs['variance'], ensemble.variance_step)
+        for percentile in percentiles:
+            name = '{base}_p{p}'.format(base=ensemble_outputs['percentile_output'],
+                                        p=('%g' % percentile).replace('.', '_'))
+            ensemble.write(name, ensemble.percentile_step, percentile)
+        ensemble.remove()
 
     return 0
 
@@ -70,7 +70,7 @@
 #% label: Classifier
 #% description: Supervised learning model to use
 #% answer: RandomForestClassifier
-#% options: LogisticRegression,LinearDiscriminantAnalysis,QuadraticDiscriminantAnalysis,KNeighborsClassifier,GaussianNB,DecisionTreeClassifier,DecisionTreeRegressor,RandomForestClassifier,RandomForestRegressor,ExtraTreesClassifier,ExtraTreesRegressor,GradientBoostingClassifier,GradientBoostingRegressor,SVC,EarthClassifier,EarthRegressor
+#% options: LogisticRegression,LinearDiscriminantAnalysis,QuadraticDiscriminantAnalysis,KNeighborsClassifier,GaussianNB,DecisionTreeClassifier,DecisionTreeRegressor,RandomForestClassifier,RandomForestRegressor,ExtraTreesClassifier,ExtraTreesRegressor,GradientBoostingClassifier,GradientBoostingRegressor,SVC,SGDClassifier,SGDRegressor,PassiveAggressiveClassifier,PassiveAggressiveRegressor,EarthClassifier,EarthRegressor
 #% guisection: Classifier settings
 #% required: no
 #%end
@@ -79,7 +79,7 @@
 #% key: c
 #% type: double
 #% label: Inverse of regularization strength
-#% description: Inverse of regularization strength (LogisticRegression and SVC)
+#% description: Inverse of regularization strength (LogisticRegression and SVC), or maximum step size (PassiveAggressive)
 #% answer: 1.0
 #% multiple: yes
 #% guisection: Classifier settings
@@ -311,6 +311,15 @@
 #% multiple: yes
 #%end
 
+#%option
+#% key: max_samples
+#% type: integer
+#% label: Maximum number of training pixels per class
+#% description: Maximum number of labelled pixels to sample per class (all labelled pixels for regression) using reservoir sampling; zero extracts all labelled pixels
+#% answer: 0
+#% guisection: Optional
+#%end
+
 #%option
 #% key: rowincr
 #% type: integer
@@ -365,16 +374,33 @@
 #% guisection: Optional
 #%end
 
+#%flag
+#% key: i
+#% label: Incremental out-of-core training
+#% description: Fit the model incrementally on blocks of rowincr rows of the trainingmap (SGD, PassiveAggressive and GaussianNB models only)
+#% guisection: Optional
+#%end
+
 #%option G_OPT_F_OUTPUT
 #% key: save_training
-#% label: Save training data to csv
+#% label: Save training data to file
+#% description: Training data is saved as a binary cache directory, or as text if the file name has a .csv extension
 #% required: no
 #% guisection: Optional
 #%end
 
 #%option G_OPT_F_INPUT
 #% key: load_training
-#% label: Load training data from csv
+#% label: Load training data from file
+#% description: Binary cache directory or .csv file created using the save_training option
+#% required: no
+#% guisection: Optional
+#%end
+
+#%option G_OPT_M_DIR
+#% key: training_cache
+#% label: Directory to cache extracted training data
+#% description: Training data extracted from trainingmap is cached and reused when the maps, their modification times, the region and the extraction settings are unchanged
 #% required: no
 #% guisection: Optional
 #%end
@@ -386,6 +412,14 @@
 #% guisection: Optional
 #%end
 
+#%option G_OPT_F_OUTPUT
+#% key: manifest
+#% label: Prediction manifest file
+#% description: JSON file recording checksums of the inputs and outputs of each block of rows. Re-running the prediction with the same model only predicts blocks whose predictors have changed
+#% required: no
+#% guisection: Optional
+#%end
+
 #%option G_OPT_F_INPUT
 #% key: load_model
 #% label: Load model from file
@@ -399,13 +433,17 @@
 #% exclusive: trainingmap,load_training
 #% exclusive: trainingpoints,trainingmap
 #% exclusive: trainingpoints,load_training
+#% requires: -i,trainingmap
 #% requires: fimp_file,-f
 #%end
 
 from __future__ import absolute_import
 import atexit
+import hashlib
+import json
 import os
 import tempfile
+import time
 from copy import deepcopy
 import numpy as np
 import grass.script as gs
@@ -441,6 +479,9 @@ def model_classifiers(estimator, random_state, n_jobs, p, weights=None):
     """
 
     from sklearn.linear_model import LogisticRegression
+    from sklearn.linear_model import SGDClassifier, SGDRegressor
+    from sklearn.linear_model import (
+        PassiveAggressiveClassifier, PassiveAggressiveRegressor)
     from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
     from sklearn.discriminant_analysis import QuadraticDiscriminantAnalysis
     from sklearn.naive_bayes import GaussianNB
@@ -551,6 +592,20 @@ def model_classifiers(estimator, random_state, n_jobs, p, weights=None):
                                           subsample=p['subsample'],
                                           max_features=p['max_features'],
                                           random_state=random_state),
+            'SGDClassifier':
+                SGDClassifier(loss='log',
+                              class_weight=weights,
+                              random_state=random_state,
+                              n_jobs=n_jobs),
+            'SGDRegressor': SGDRegressor(random_state=random_state),
+            'PassiveAggressiveClassifier':
+                PassiveAggressiveClassifier(C=p['C'],
+                                            class_weight=weights,
+                                            random_state=random_state,
+                                            n_jobs=n_jobs),
+            'PassiveAggressiveRegressor':
+                PassiveAggressiveRegressor(C=p['C'],
+                                           random_state=random_state),
             'GaussianNB': GaussianNB(),
             'LinearDiscriminantAnalysis': LinearDiscriminantAnalysis(),
             'QuadraticDiscriminantAnalysis': QuadraticDiscriminantAnalysis(),
@@ -573,6 +628,8 @@ def model_classifiers(estimator, random_state, n_jobs, p, weights=None):
         or estimator == 'QuadraticDiscriminantAnalysis' \
         or estimator == 'EarthClassifier' \
         or estimator == 'SVC' \
+        or estimator == 'SGDClassifier' \
+        or estimator == 'PassiveAggressiveClassifier' \
         or estimator == 'KNeighborsClassifier':
         mode = 'classification'
     else:
@@ -581,9 +638,13 @@ def model_classifiers(estimator, random_state, n_jobs, p, weights=None):
     return (clf, mode)
 
 
-def save_training_data(X, y, groups, coords, file):
+def save_training_data(X, y, groups, coords, file, header=None):
     """
-    Saves any extracted training data to a csv file
+    Saves any extracted training data to a csv file or a binary cache
+
+    The binary cache is a directory containing memory-mappable .npy arrays
+    for X (stored column-major), y, groups and coords, and a small
+    header.json file. Files with a .csv extension are saved as text
 
     Args
     ----
@@ -591,25 +652,48 @@ def save_training_data(X, y, groups, coords, file):
     y (1d numpy array): Numpy array containing labels
     groups (1d numpy array): Numpy array of group labels
     coords (2d numpy array): Numpy array containing xy coordinates of samples
-    file (string): Path to a csv file to save data to
+    file (string): Path to a csv file or cache directory to save data to
+    header (dict): Optional metadata (e.g. predictors, region) to store
     """
 
-    # if there are no group labels, create a nan filled array
-    if groups is None:
-        groups = np.empty((y.shape[0]))
-        groups[:] = np.nan
+    if file.lower().endswith('.csv'):
+        # if there are no group labels, create a nan filled array
+        if groups is None:
+            groups = np.empty((y.shape[0]))
+            groups[:] = np.nan
+
+        training_data = np.column_stack([coords, X, y, groups])
+        np.savetxt(file, training_data, delimiter=',')
+        return
+
+    if not os.path.exists(file):
+        os.makedirs(file)
+
+    np.save(os.path.join(file, 'X.npy'), np.asfortranarray(X))
+    np.save(os.path.join(file, 'y.npy'), np.asarray(y))
+    np.save(os.path.join(file, 'coords.npy'), np.asarray(coords))
+    if groups is not None:
+        np.save(os.path.join(file, 'groups.npy'), np.asarray(groups))
+
+    if header is None:
+        header = {}
+    header = dict(header, n_samples=int(X.shape[0]),
+                  n_features=int(X.shape[1]), groups=groups is not None)
 
-    training_data = np.column_stack([coords, X, y, groups])
-    np.savetxt(file, training_data, delimiter=',')
+    # header is written last so that incomplete caches are never loaded
+    with open(os.path.join(file, 'header.json'), 'w') as f:
+        json.dump(header, f, indent=2)
 
 
 def load_training_data(file):
     """
-    Loads training data and labels from a csv file
+    Loads training data and labels from a csv file or a binary cache
+
+    Arrays in a binary cache are opened as read-only memory maps
 
     Args
     ----
-    file (string): Path to a csv file to save data to
+    file (string): Path to a csv file or cache directory to load data from
 
     Returns
     -------
@@ -619,6 +703,20 @@ def load_training_data(file):
     coords (2d numpy array): Numpy array containing x,y coordinates of samples
     """
 
+    if os.path.isdir(file):
+        with open(os.path.join(file, 'header.json')) as f:
+            header = json.load(f)
+
+        X = np.load(os.path.join(file, 'X.npy'), mmap_mode='r')
+        y = np.load(os.path.join(file, 'y.npy'), mmap_mode='r')
+        coords = np.load(os.path.join(file, 'coords.npy'), mmap_mode='r')
+        if header['groups'] is True:
+            groups = np.load(os.path.join(file, 'groups.npy'), mmap_mode='r')
+        else:
+            groups = None
+
+        return(X, y, groups, coords)
+
     training_data = np.loadtxt(file, delimiter=',')
     n_cols = training_data.shape[1]
     last_Xcol = n_cols-2
@@ -638,54 +736,142 @@ def load_training_data(file):
     return(X, y, groups, coords)
 
 
-def save_model(estimator, X, y, sample_coords, groups, filename):
+def raster_mtime(name):
+    """
+    Returns the latest modification time of the files of a GRASS raster
+
+    Args
+    ----
+    name (string): Name of GRASS raster
+
+    Returns
+    -------
+    mtime (float): Modification time in seconds since the epoch
+    """
+
+    info = gs.find_file(name, element='cell')
+    if info['file'] == '':
+        gs.fatal("GRASS raster " + name + " does not exist.... exiting")
+
+    mapset_dir = os.path.dirname(os.path.dirname(info['file']))
+    mtimes = []
+    for element in ('cellhd', 'cell', 'fcell', 'cell_misc'):
+        path = os.path.join(mapset_dir, element, info['name'])
+        if os.path.exists(path):
+            mtimes.append(os.path.getmtime(path))
+
+    return max(mtimes)
+
+
+def training_cache_key(response, predictors, **kwargs):
+    """
+    Hash of the input rasters, their modification times, the current region
+    and the extraction settings, used to identify cached training data
+
+    Args
+    ----
+    response (string): Name of GRASS raster with labelled pixels
+    predictors (list): Names of GRASS rasters (predictors and group raster)
+    kwargs: Any other settings that affect the extracted training data
+
+    Returns
+    -------
+    key (string): Hexadecimal digest
+    """
+
+    key = hashlib.sha1()
+
+    for name in [response] + predictors:
+        key.update('{0}:{1!r};'.format(name, raster_mtime(name)).encode('utf-8'))
+
+    region = gs.region()
+    for setting in sorted(region.keys()):
+        key.update('{0}={1};'.format(setting, region[setting]).encode('utf-8'))
+
+    for setting in sorted(kwargs.keys()):
+        key.update('{0}={1};'.format(setting, kwargs[setting]).encode('utf-8'))
+
+    return key.hexdigest()
+
+
+def save_model(estimator, class_labels, filename):
+    """
+    Saves a fitted estimator (without the training data) to a file
+
+    Args
+    ----
+    estimator (object): Fitted scikit-learn estimator
+    class_labels (1d numpy array): Class labels, or None for regression
+    filename (string): Path of file (for compression use e.g. '.gz' extension)
+    """
+
     from sklearn.externals import joblib
-    joblib.dump((estimator, X, y, sample_coords, group_id), filename)
+    joblib.dump((estimator, class_labels), filename)
 
 
 def load_model(filename):
+    """
+    Loads a fitted estimator from a file
+
+    Files written by earlier versions that store the training data together
+    with an unfitted estimator are refitted on loading
+
+    Args
+    ----
+    filename (string): Path of file
+
+    Returns
+    -------
+    estimator (object): Fitted scikit-learn estimator
+    class_labels (1d numpy array): Class labels, or None for regression
+    """
+
     from sklearn.externals import joblib
-    estimator, X, y, sample_coords, groups = joblib.load(filename)
+    model = joblib.load(filename)
 
-    return (estimator, X, y, sample_coords, groups)
+    if len(model) == 5:
+        X, y, sample_coords, groups, estimator = model
+        estimator.fit(X, y)
+        class_labels = np.unique(y)
+    else:
+        estimator, class_labels = model
+
+    return (estimator, class_labels)
 
-def extract_pixels(response, predictors, lowmem=False, na_rm=False):
+
+def extract_pixels(response, predictors, lowmem=False, na_rm=False,
+                   max_samples=0, stratify=True, random_state=None):
     """
     Samples a list of GRASS rasters using a labelled raster
-    Per raster sampling
+
+    The response raster is streamed row-by-row to record the positions of the
+    labelled pixels, optionally using reservoir sampling to keep a maximum
+    number of pixels per class. The predictors are then read only for the
+    rows that contain sampled pixels
 
     Args
     ----
     response (string): Name of GRASS raster with labelled pixels
     predictors (list): List of GRASS raster names containing explanatory variables
-    lowmem (boolean): Use numpy memmap to query predictors
+    lowmem (boolean): Use numpy memmap to store the extracted training data
     na_rm (boolean): Remove samples containing NaNs
+    max_samples (integer): Maximum number of pixels to sample per class;
+        zero extracts all labelled pixels
+    stratify (boolean): Apply max_samples separately to each class,
+        otherwise to all labelled pixels
+    random_state (float): Seed to use for the reservoir sampling
 
     Returns
     -------
     training_data (2d numpy array): Extracted raster values
     training_labels (1d numpy array): Numpy array of labels
-    is_train (2d numpy array): Row and Columns of label positions
+    is_train (2d numpy array): x,y coordinates of label positions
     """
 
-    from grass.pygrass.utils import pixel2coor
-
     current = Region()
+    rstate = np.random.RandomState(random_state)
 
-    # open response raster as rasterrow and read as np array
-    if RasterRow(response).exist() is True:
-        roi_gr = RasterRow(response)
-        roi_gr.open('r')
-
-        if lowmem is False:
-            response_np = np.array(roi_gr)
-        else:
-            response_np = np.memmap(
-                tempfile.NamedTemporaryFile(),
-                dtype='float32', mode='w+',
-                shape=(current.rows, current.cols))
-            response_np[:] = np.array(roi_gr)[:]
-    else:
+    if RasterRow(response).exist() is not True:
         gs.fatal("GRASS GIS response raster map <%s> does not exist" % response)
 
     # determine number of predictor rasters
@@ -697,11 +883,66 @@ def extract_pixels(response, predictors, lowmem=False, na_rm=False):
             gs.fatal("GRASS raster " + predictors[i] +
                           " does not exist.... exiting")
 
-    # check if any of those pixels are labelled (not equal to nodata)
+    # stream the response raster and record the positions of labelled pixels
     # can use even if roi is FCELL because nodata will be nan
-    is_train = np.nonzero(response_np > -2147483648)
-    training_labels = response_np[is_train]
-    n_labels = np.array(is_train).shape[1]
+    roi_gr = RasterRow(response)
+    roi_gr.open('r')
+    label_dtype = np.asarray(roi_gr[0]).dtype
+
+    rows, cols, labels = [], [], []
+    reservoirs, n_seen = {}, {}
+
+    for row in range(current.rows):
+        values = np.asarray(roi_gr[row])
+        is_label = np.nonzero(values > -2147483648)[0]
+
+        if is_label.shape[0] == 0:
+            continue
+
+        if max_samples <= 0:
+            rows.append(np.repeat(row, is_label.shape[0]))
+            cols.append(is_label)
+            labels.append(values[is_label])
+        else:
+            if stratify is True:
+                strata = values[is_label]
+            else:
+                strata = np.zeros(is_label.shape[0])
+
+            for stratum in np.unique(strata):
+                stratum_cols = is_label[strata == stratum]
+                __reservoir_sample(
+                    reservoirs, n_seen, stratum, row, stratum_cols,
+                    values[stratum_cols], max_samples, rstate, label_dtype)
+
+        gs.percent(row, current.rows, 10)
+
+    roi_gr.close()
+
+    if max_samples <= 0:
+        rows.append(np.zeros(0, dtype=int))
+        cols.append(np.zeros(0, dtype=int))
+        labels.append(np.zeros(0, dtype=label_dtype))
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        training_labels = np.concatenate(labels)
+    else:
+        strata = sorted(reservoirs.keys())
+        n_kept = [min(n_seen[stratum], max_samples) for stratum in strata]
+        positions = np.vstack(
+            [reservoirs[stratum][0][0:n] for stratum, n in zip(strata, n_kept)]
+            + [np.zeros((0, 2), dtype=int)])
+        rows = positions[:, 0]
+        cols = positions[:, 1]
+        training_labels = np.concatenate(
+            [reservoirs[stratum][1][0:n] for stratum, n in zip(strata, n_kept)]
+            + [np.zeros(0, dtype=label_dtype)])
+
+    # order samples by position so that each row is read only once
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], cols[order]
+    training_labels = training_labels[order]
+    n_labels = rows.shape[0]
 
     # Create a zero numpy array of len training labels
     if lowmem is False:
@@ -709,39 +950,32 @@ def extract_pixels(response, predictors, lowmem=False, na_rm=False):
     else:
         training_data = np.memmap(tempfile.NamedTemporaryFile(),
                                   dtype='float32', mode='w+',
-                                  shape=(n_labels, n_features))
+                                  shape=(max(n_labels, 1), n_features))
+        training_data = training_data[0:n_labels]
 
-    # Loop through each raster and sample pixel values at training indexes
-    if lowmem is True:
-        feature_np = np.memmap(tempfile.NamedTemporaryFile(),
-                               dtype='float32', mode='w+',
-                               shape=(current.rows, current.cols))
+    # read only the rows of the predictors that contain sampled pixels
+    rasstack = [RasterRow(predictor) for predictor in predictors]
+    for ras in rasstack:
+        ras.open('r')
 
-    for f in range(n_features):
-        predictor_gr = RasterRow(predictors[f])
-        predictor_gr.open('r')
-
-        if lowmem is False:
-            feature_np = np.array(predictor_gr)
-        else:
-            feature_np[:] = np.array(predictor_gr)[:]
+    label_rows, starts = np.unique(rows, return_index=True)
+    ends = np.append(starts[1:], n_labels)
 
-        training_data[0:n_labels, f] = feature_np[is_train]
+    for i, (row, start, end) in enumerate(zip(label_rows, starts, ends)):
+        for f, ras in enumerate(rasstack):
+            training_data[start:end, f] = np.asarray(ras[row])[cols[start:end]]
+        gs.percent(i, label_rows.shape[0], 10)
 
-        # close each predictor map
-        predictor_gr.close()
+    for ras in rasstack:
+        ras.close()
 
     # convert any CELL maps no datavals to NaN in the training data
-    for i in range(n_features):
-        training_data[training_data[:, i] == -2147483648] = np.nan
-
-    # convert indexes of training pixels from tuple to n*2 np array
-    is_train = np.array(is_train).T
-    for i in range(is_train.shape[0]):
-        is_train[i, :] = np.array(pixel2coor(tuple(is_train[i]), current))
+    training_data[training_data == -2147483648] = np.nan
 
-    # close the response map
-    roi_gr.close()
+    # convert indexes of training pixels to x,y coordinates of cell centres
+    is_train = np.column_stack([
+        current.west + (cols + 0.5) * current.ewres,
+        current.north - (rows + 0.5) * current.nsres])
 
     # remove samples containing NaNs
     if na_rm is True:
@@ -754,6 +988,232 @@ def extract_pixels(response, predictors, lowmem=False, na_rm=False):
     return(training_data, training_labels, is_train)
 
 
+def __reservoir_sample(reservoirs, n_seen, stratum, row, cols, labels,
+                       max_samples, rstate, label_dtype):
+    """
+    Vectorized reservoir sampling of the labelled pixels in a raster row
+
+    Args
+    ----
+    reservoirs (dict): Arrays of sampled (row, col) positions and of labels
+                       per stratum
+    n_seen (dict): Number of labelled pixels seen so far per stratum
+    stratum (float): Stratum (class) of the labelled pixels
+    row (integer): Index of the raster row
+    cols (1d numpy array): Indexes of the columns of the labelled pixels
+    labels (1d numpy array): Labels of the pixels
+    max_samples (integer): Size of the reservoir
+    rstate (object): numpy RandomState
+    label_dtype (numpy dtype): Data type of the labels of the response raster
+    """
+
+    if stratum not in reservoirs:
+        reservoirs[stratum] = (np.zeros((max_samples, 2), dtype=int),
+                               np.zeros(max_samples, dtype=label_dtype))
+        n_seen[stratum] = 0
+
+    # position of each pixel in the stream of this stratum
+    t = n_seen[stratum] + np.arange(cols.shape[0])
+
+    # fill the reservoir and then replace samples with decreasing probability
+    slots = np.where(
+        t < max_samples, t,
+        (rstate.random_sample(t.shape[0]) * (t + 1)).astype(int))
+    keep = slots < max_samples
+
+    positions, sampled_labels = reservoirs[stratum]
+    positions[slots[keep]] = np.column_stack(
+        [np.repeat(row, keep.sum()), cols[keep]])
+    sampled_labels[slots[keep]] = labels[keep]
+    n_seen[stratum] += cols.shape[0]
+
+
+def extract_pixels_batches(response, predictors, rowincr=25, na_rm=False):
+    """
+    Generator that streams the labelled pixels of a raster in blocks of rows
+
+    Only one block of training data is held in memory at a time, so that the
+    memory use is bounded irrespective of the number of labelled pixels
+
+    Args
+    ----
+    response (string): Name of GRASS raster with labelled pixels
+    predictors (list): List of GRASS raster names containing explanatory variables
+    rowincr (integer): Number of raster rows to read per batch
+    na_rm (boolean): Remove samples containing NaNs
+
+    Yields
+    ------
+    training_data (2d numpy array): Extracted raster values of the batch
+    training_labels (1d numpy array): Numpy array of labels of the batch
+    is_train (2d numpy array): x,y coordinates of label positions of the batch
+    """
+
+    current = Region()
+
+    for name in [response] + predictors:
+        if RasterRow(name).exist() is not True:
+            gs.fatal("GRASS raster " + name + " does not exist.... exiting")
+
+    roi_gr = RasterRow(response)
+    roi_gr.open('r')
+    rasstack = [RasterRow(predictor) for predictor in predictors]
+    for ras in rasstack:
+        ras.open('r')
+
+    try:
+        for row_min in range(0, current.rows, rowincr):
+            row_max = min(row_min + rowincr, current.rows)
+            gs.percent(row_min, current.rows, rowincr)
+
+            # read the labelled pixels of the block of rows
+            rows, cols, labels = [], [], []
+            for row in range(row_min, row_max):
+                values = np.asarray(roi_gr[row])
+                is_label = np.nonzero(values > -2147483648)[0]
+                if is_label.shape[0] > 0:
+                    rows.append(np.repeat(row, is_label.shape[0]))
+                    cols.append(is_label)
+                    labels.append(values[is_label])
+
+            if len(rows) == 0:
+                continue
+
+            rows = np.concatenate(rows)
+            cols = np.concatenate(cols)
+            training_labels = np.concatenate(labels)
+
+            # sample the predictors for the labelled rows only
+            training_data = np.zeros((rows.shape[0], len(predictors)))
+            start = 0
+            for row in np.unique(rows):
+                end = start + np.count_nonzero(rows == row)
+                for f, ras in enumerate(rasstack):
+                    training_data[start:end, f] = \
+                        np.asarray(ras[row])[cols[start:end]]
+                start = end
+
+            # convert any CELL maps no datavals to NaN in the training data
+            training_data[training_data == -2147483648] = np.nan
+
+            is_train = np.column_stack([
+                current.west + (cols + 0.5) * current.ewres,
+                current.north - (rows + 0.5) * current.nsres])
+
+            # remove samples containing NaNs
+            if na_rm is True:
+                valid = ~np.isnan(training_data).any(axis=1)
+                training_data = training_data[valid]
+                training_labels = training_labels[valid]
+                is_train = is_train[valid]
+
+            if training_labels.shape[0] > 0:
+                yield (training_data, training_labels, is_train)
+    finally:
+        roi_gr.close()
+        for ras in rasstack:
+            ras.close()
+
+
+def incremental_fit(estimator, response, predictors, mode, rowincr=25,
+                    standardize=False, balance=False, random_state=None):
+    """
+    Out-of-core training of an estimator that supports partial_fit using
+    batches of training data streamed from a labelled raster
+
+    Args
+    ----
+    estimator (object): scikit-learn estimator with a partial_fit method
+    response (string): Name of GRASS raster with labelled pixels
+    predictors (list): List of GRASS raster names containing explanatory variables
+    mode (string): 'classification' or 'regression'
+    rowincr (integer): Number of raster rows to read per batch
+    standardize (boolean): Standardize the predictors using a StandardScaler
+        that is fitted by a separate streaming pass
+    balance (boolean): Weight the classes by their inverse frequency
+    random_state (float): Seed used to shuffle the samples within batches
+
+    Returns
+    -------
+    estimator (object): Fitted estimator, or Pipeline if standardized
+    class_labels (1d numpy array): Class labels, or None for regression
+    """
+
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    rstate = np.random.RandomState(random_state)
+
+    # all classes have to be known on the first call of partial_fit
+    class_labels, class_weights = None, None
+    if mode == 'classification':
+        gs.message('Counting labelled pixels per class...')
+        current = Region()
+        counts = {}
+        roi_gr = RasterRow(response)
+        roi_gr.open('r')
+        for row in range(current.rows):
+            values = np.asarray(roi_gr[row])
+            labels, n = np.unique(
+                values[values > -2147483648], return_counts=True)
+            for label, count in zip(labels, n):
+                counts[label] = counts.get(label, 0) + count
+        roi_gr.close()
+
+        class_labels = np.array(sorted(counts.keys()))
+        if class_labels.shape[0] == 0:
+            gs.fatal('There are too few training features to perform classification')
+
+        if balance is True:
+            n_samples = np.array([counts[i] for i in class_labels], dtype=float)
+            weights = n_samples.sum() / (class_labels.shape[0] * n_samples)
+            class_weights = dict(zip(class_labels, weights))
+
+            if 'class_weight' in estimator.get_params():
+                estimator.set_params(class_weight=class_weights)
+                class_weights = None
+
+    # first streaming pass to fit the scaler
+    if standardize is True:
+        gs.message('Fitting standardization...')
+        scaler = StandardScaler()
+        for X, y, coords in extract_pixels_batches(
+                response, predictors, rowincr, na_rm=True):
+            scaler.partial_fit(X)
+
+    gs.message('Incremental fitting...')
+    n_samples = 0
+    for X, y, coords in extract_pixels_batches(
+            response, predictors, rowincr, na_rm=True):
+
+        # shuffle the spatially ordered samples of the batch
+        order = rstate.permutation(y.shape[0])
+        X, y = X[order], y[order]
+
+        if standardize is True:
+            X = scaler.transform(X)
+
+        fit_params = {}
+        if class_labels is not None:
+            fit_params['classes'] = class_labels
+        if class_weights is not None:
+            fit_params['sample_weight'] = np.array(
+                [class_weights[i] for i in y])
+
+        estimator.partial_fit(X, y, **fit_params)
+        n_samples += y.shape[0]
+
+    if n_samples == 0:
+        gs.fatal('No training pixels or pixels in imagery group '
+                 '...check computational region')
+    gs.message('Model fitted using {0} training samples'.format(n_samples))
+
+    if standardize is True:
+        estimator = Pipeline([('scaling', scaler), ('classifier', estimator)])
+
+    return (estimator, class_labels)
+
+
 def extract_points(gvector, grasters, field, na_rm=False):
     """
     Extract values from grass rasters using vector points input
@@ -827,10 +1287,16 @@ def extract_points(gvector, grasters, field, na_rm=False):
 
 
 def predict(estimator, predictors, output, predict_type='raw', index=None,
-            class_labels=None, overwrite=False, rowincr=25, n_jobs=-2):
+            class_labels=None, overwrite=False, rowincr=25, n_jobs=-2,
+            manifest=None):
     """
     Prediction on list of GRASS rasters using a fitted scikit learn model
 
+    The predictors are read block-by-block (rowincr rows at a time) into one
+    of two shared memory-mapped cubes. Worker processes receive zero-copy
+    views of the current cube whilst the next block of rows is read into the
+    other cube, so that reading of the rasters overlaps with the prediction
+
     Args
     ----
     estimator (object): scikit-learn estimator object
@@ -841,17 +1307,18 @@ def predict(estimator, predictors, output, predict_type='raw', index=None,
     index (list): Optional, list of class indices to export
     class_labels (1d numpy array): Optional, class labels
     overwrite (boolean): enable overwriting of existing raster
+    rowincr (integer): Number of raster rows to read and predict per block
     n_jobs (integer): Number of processing cores;
         -1 for all cores; -2 for all cores-1
+    manifest (string): Optional, path of a json file recording checksums of
+        the inputs and outputs of each block of rows. If the manifest matches
+        the model and region, only blocks with changed inputs are predicted
+        and patched into the existing outputs
     """
 
-    from sklearn.externals.joblib import Parallel, delayed
-    from grass.pygrass.raster import numpy2raster
-
-    # TODO
-    # better memory efficiency and use of memmap for parallel
-    # processing
-    #from sklearn.externals.joblib.pool import has_shareable_memory
+    from multiprocessing import Pool, cpu_count
+    from multiprocessing.pool import ThreadPool
+    from grass.pygrass.raster.buffer import Buffer
 
     # first unwrap the estimator from any potential pipelines or gridsearchCV
     if type(estimator).__name__ == 'Pipeline':
@@ -872,139 +1339,362 @@ def predict(estimator, predictors, output, predict_type='raw', index=None,
         'KNeighborsClassifier']:
        n_jobs = 1
 
+    # convert joblib-style negative n_jobs to a number of workers
+    if n_jobs < 0:
+        n_jobs = max(cpu_count() + 1 + n_jobs, 1)
+
     # convert potential single index to list
     if isinstance(index, int): index = [index]
 
-    # open predictors as list of rasterrow objects
     current = Region()
+    n_features = len(predictors)
+    rowincr = min(rowincr, current.rows)
 
-    # create lists of row increments
-    row_mins, row_maxs = [], []
-    for row in range(0, current.rows, rowincr):
-        if row+rowincr > current.rows:
-            rowincr = current.rows - row
-        row_mins.append(row)
-        row_maxs.append(row+rowincr)
-
-    # perform predictions on lists of row increments in parallel
-    prediction = Parallel(n_jobs=n_jobs, max_nbytes=None)(
-        delayed(__predict_parallel2)
-        (estimator, predictors, predict_type, current, row_min, row_max)
-        for row_min, row_max in zip(row_mins, row_maxs))
-    prediction = np.vstack(prediction)
-
-    # determine raster dtype
-    if prediction.dtype == 'float':
-        ftype = 'FCELL'
-    else:
-        ftype = 'CELL'
-
-    #  writing of predicted results for classification
+    # determine the output data type and number of classes from a dummy sample
+    dummy = np.zeros((1, n_features))
     if predict_type == 'raw':
-        numpy2raster(array=prediction, mtype=ftype, rastname=output,
-                     overwrite=True)
-        gs.raster_history(output)
-
-    # writing of predicted results for probabilities
-    if predict_type == 'prob':
+        dtype = estimator.predict(dummy).dtype
+        if np.issubdtype(dtype, np.floating):
+            ftype, nodata = 'FCELL', np.nan
+        else:
+            ftype, nodata = 'CELL', -2147483648
+    else:
+        n_classes = estimator.predict_proba(dummy).shape[1]
+        ftype, nodata, dtype = 'FCELL', np.nan, np.float32
 
         # use class labels if supplied
         # else output predictions as 0,1,2...n
         if class_labels is None:
-            class_labels = range(prediction.shape[2])
+            class_labels = range(n_classes)
 
         # output all class probabilities if subset is not specified
         if index is None:
             index = class_labels
 
         # select indexes of predictions 3d numpy array to be exported to rasters
-        selected_prediction_indexes = [i for i, x in enumerate(class_labels) if x in index]
+        selected_prediction_indexes = [
+            i for i, x in enumerate(class_labels) if x in index]
 
-        # write each 3d of numpy array as a probability raster
-        for pred_index, label in zip(selected_prediction_indexes, index):
-            rastername = output + '_' + str(label)
-            numpy2raster(array=prediction[:, :, pred_index], mtype='FCELL',
-                         rastname=rastername, overwrite=overwrite)
-            gs.raster_history(output)
+    if predict_type == 'raw':
+        output_names = [output]
+    else:
+        output_names = [output + '_' + str(label) for label in index]
+
+    # compare the inputs against the manifest of a previous prediction
+    tiles = None
+    if manifest is not None:
+        import pickle
+        state = {
+            'region': gs.region(),
+            'rowincr': rowincr,
+            'predictors': predictors,
+            'mtimes': [raster_mtime(name) for name in predictors],
+            'model': hashlib.sha1(pickle.dumps(estimator, 2)).hexdigest(),
+            'outputs': output_names}
+        key = predict_type + ':' + output
+
+        manifests = {}
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                manifests = json.load(f)
+        previous = manifests.get(key)
+
+        if previous is not None and all(
+                previous[i] == state[i] for i in
+                ('region', 'rowincr', 'predictors', 'model', 'outputs')) \
+                and all(RasterRow(name).exist() for name in output_names):
+            if previous['mtimes'] == state['mtimes'] and \
+                    previous['output_mtimes'] == [
+                        raster_mtime(name) for name in output_names]:
+                gs.message('Prediction <{0}> is up to date'.format(output))
+                return
+            tiles = previous['tiles']
 
+    # open predictors as list of rasterrow objects
+    rasstack = [0] * n_features
+    for i in range(n_features):
+        rasstack[i] = RasterRow(predictors[i])
+        if rasstack[i].exist() is True:
+            rasstack[i].open('r')
+        else:
+            gs.fatal("GRASS raster " + predictors[i] +
+                     " does not exist.... exiting")
+
+    # open the output rasters for writing row-by-row
+    # when patching, unchanged tiles are copied from the previous outputs
+    # and the new outputs replace them once complete
+    previous_outputs = []
+    if tiles is not None:
+        for name in output_names:
+            previous_outputs.append(RasterRow(name))
+            previous_outputs[-1].open('r')
+        write_names = ['tmp_{0}_{1}'.format(name, os.getpid())
+                       for name in output_names]
+        tmp_rast.extend(write_names)
+    else:
+        write_names = output_names
+
+    outputs = []
+    for name in write_names:
+        outputs.append(RasterRow(name))
+        outputs[-1].open(
+            'w', mtype=ftype,
+            overwrite=overwrite if predict_type == 'prob' and tiles is None
+            else True)
+
+    # two shared memory-mapped cubes used as read/predict double-buffer
+    cube_shape = (rowincr, current.cols, n_features)
+    cube_files = [tempfile.mkstemp() for i in range(2)]
+    cubes = [np.memmap(f, dtype='float64', mode='w+', shape=cube_shape)
+             for fd, f in cube_files]
+
+    # workers share the estimator and open the cubes once on startup
+    # multithreaded estimators use a single thread to overlap reading
+    initargs = (estimator, [f for fd, f in cube_files], cube_shape)
+    if n_jobs == 1:
+        pool = ThreadPool(1, __init_predict_worker, initargs)
+    else:
+        pool = Pool(n_jobs, __init_predict_worker, initargs)
+
+    # create lists of row increments
+    blocks = [(row, min(row + rowincr, current.rows))
+              for row in range(0, current.rows, rowincr)]
+    input_checksums, output_checksums = [], []
+    n_predicted = 0
 
-def __predict_parallel2(estimator, predictors, predict_type, current, row_min, row_max):
+    try:
+        __read_block(rasstack, cubes[0], blocks[0][0], blocks[0][1])
+        if manifest is not None:
+            input_checksums.append(
+                hashlib.sha1(cubes[0][0:blocks[0][1]].tobytes()).hexdigest())
+
+        for i, (row_min, row_max) in enumerate(blocks):
+            buf = i % 2
+            n_rows = row_max - row_min
+            tile = None
+
+            # reuse unchanged tiles if the previous output is still intact
+            if tiles is not None and i < len(tiles) and \
+                    tiles[i]['inputs'] == input_checksums[i]:
+                tile, checksums = __read_tile(
+                    previous_outputs, row_min, row_max)
+                if checksums != tiles[i]['outputs']:
+                    tile = None
+
+            # split the rows of the current block between the workers
+            jobs = []
+            if tile is None:
+                splits = np.array_split(np.arange(n_rows), min(n_jobs, n_rows))
+                jobs = [pool.apply_async(
+                            __predict_block,
+                            (buf, rows[0], rows[-1] + 1, predict_type, dtype,
+                             nodata))
+                        for rows in splits]
+                n_predicted += 1
+
+            # read the next block whilst the current block is predicted
+            if i + 1 < len(blocks):
+                __read_block(rasstack, cubes[1 - buf],
+                             blocks[i + 1][0], blocks[i + 1][1])
+                if manifest is not None:
+                    input_checksums.append(hashlib.sha1(
+                        cubes[1 - buf][0:blocks[i + 1][1] - blocks[i + 1][0]]
+                        .tobytes()).hexdigest())
+
+            if tile is None:
+                result = np.vstack([job.get() for job in jobs])
+                if predict_type == 'raw':
+                    tile = [result]
+                else:
+                    tile = [result[:, :, pred_index]
+                            for pred_index in selected_prediction_indexes]
+
+            # write the rows of the tile to the output rasters
+            newrow = Buffer((current.cols,), mtype=ftype)
+            hashers = [hashlib.sha1() for out in outputs]
+            for row in range(n_rows):
+                for out, values, hasher in zip(outputs, tile, hashers):
+                    newrow[:] = values[row, :]
+                    out.put_row(newrow)
+                    __row_checksum(hasher, newrow)
+            output_checksums.append([hasher.hexdigest() for hasher in hashers])
+
+            gs.percent(i + 1, len(blocks), 1)
+    finally:
+        pool.close()
+        pool.join()
+
+        for ras in rasstack + previous_outputs + outputs:
+            ras.close()
+
+        del cubes
+        for fd, f in cube_files:
+            os.close(fd)
+            os.remove(f)
+
+    # replace the previous outputs by the patched outputs
+    if tiles is not None:
+        gs.message('{0} of {1} tiles were predicted'.format(
+            n_predicted, len(blocks)))
+        for write_name, name in zip(write_names, output_names):
+            gs.run_command('g.rename', raster=(write_name, name),
+                           overwrite=True, quiet=True)
+
+    for name in output_names:
+        gs.raster_history(name)
+
+    # record the inputs and output checksums of each tile
+    if manifest is not None:
+        state['output_mtimes'] = [raster_mtime(name) for name in output_names]
+        state['tiles'] = [
+            {'rows': [row_min, row_max], 'inputs': inputs, 'outputs': checksums}
+            for (row_min, row_max), inputs, checksums in zip(
+                blocks, input_checksums, output_checksums)]
+        manifests[key] = state
+        with open(manifest, 'w') as f:
+            json.dump(manifests, f, indent=2)
+
+
+def __read_tile(rasstack, row_min, row_max):
     """
-    Performs prediction on range of rows in grass rasters
+    Reads a range of rows of previously predicted rasters
 
     Args
     ----
-    estimator: scikit-learn estimator object
-    predictors: list of GRASS rasters
-    predict_type: character, 'raw' for classification/regression;
-                  'prob' for class probabilities
-    current: current region settings
-    row_min, row_max: Range of rows of grass rasters to perform predictions
+    rasstack (list): Opened RasterRow objects of the outputs
+    row_min, row_max: Range of rows of grass rasters to read
 
     Returns
     -------
-    result: 2D (classification) or 3D numpy array (class probabilities) of predictions
-    ftypes: data storage type
+    tile (list): 2D numpy array of the rows of each raster
+    checksums (list): Checksum of the rows of each raster
     """
 
-    # initialize output
-    result, mask = None, None
+    tile, checksums = [], []
 
-    # open grass rasters
-    n_features = len(predictors)
-    rasstack = [0] * n_features
+    for ras in rasstack:
+        hasher = hashlib.sha1()
+        values = []
+        for row in range(row_min, row_max):
+            values.append(np.array(ras[row]))
+            __row_checksum(hasher, values[-1])
+        tile.append(np.vstack(values))
+        checksums.append(hasher.hexdigest())
 
-    for i in range(n_features):
-        rasstack[i] = RasterRow(predictors[i])
-        if rasstack[i].exist() is True:
-            rasstack[i].open('r')
-        else:
-            gs.fatal("GRASS raster " + predictors[i] +
-                     " does not exist.... exiting")
+    return tile, checksums
+
+
+def __row_checksum(hasher, row):
+    """
+    Updates a checksum with the values of a raster row, treating all NaN
+    bit patterns (e.g. GRASS FCELL nulls) as equal
+
+    Args
+    ----
+    hasher (object): hashlib hash object
+    row (1d numpy array): Raster row
+    """
+
+    row = np.asarray(row)
+    if row.dtype.kind == 'f':
+        isnull = np.isnan(row)
+        hasher.update(isnull.tobytes())
+        hasher.update(np.where(isnull, 0, row).astype(row.dtype).tobytes())
+    else:
+        hasher.update(row.tobytes())
+
+
+_predict_estimator = None
+_predict_cubes = []
+
+
+def __init_predict_worker(estimator, filenames, shape):
+    """
+    Initialize a prediction worker with the estimator and shared cubes
+
+    Args
+    ----
+    estimator (object): scikit-learn estimator object
+    filenames (list): Paths to the memory-mapped files of the cubes
+    shape (tuple): Shape of the cubes (rows, cols, n_features)
+    """
+
+    global _predict_estimator, _predict_cubes
+
+    _predict_estimator = estimator
+    _predict_cubes = [np.memmap(f, dtype='float64', mode='r', shape=shape)
+                      for f in filenames]
+
+
+def __read_block(rasstack, cube, row_min, row_max):
+    """
+    Reads a range of rows of all predictors into a shared cube
+
+    Args
+    ----
+    rasstack (list): Opened RasterRow objects of the predictors
+    cube (3d numpy memmap): Shared array of shape (rows, cols, n_features)
+    row_min, row_max: Range of rows of grass rasters to read
+    """
 
-    # loop through each row, and each band and add to 2D img_np_row
-    img_np_row = np.zeros((row_max-row_min, current.cols, n_features))
     for row in range(row_min, row_max):
-        for band in range(n_features):
-            img_np_row[row-row_min, :, band] = np.array(rasstack[band][row])
+        for band, ras in enumerate(rasstack):
+            cube[row - row_min, :, band] = ras[row]
+
+    # convert any CELL maps nodata values to NaN
+    block = cube[0:row_max - row_min]
+    block[block == -2147483648] = np.nan
+
+
+def __predict_block(buf, row_min, row_max, predict_type, dtype, nodata):
+    """
+    Performs prediction on range of rows of a shared cube
+
+    Args
+    ----
+    buf (integer): Index of the shared cube to predict
+    row_min, row_max: Range of rows within the cube to perform predictions
+    predict_type (string): 'raw' for classification/regression;
+        'prob' for class probabilities
+    dtype (numpy dtype): Data type of the predictions
+    nodata (float): Value to assign to pixels with missing predictor values
+
+    Returns
+    -------
+    result: 2D (classification) or 3D numpy array (class probabilities) of
+        predictions
+    """
 
-    # create mask
-    img_np_row[img_np_row == -2147483648] = np.nan
-    mask = np.zeros((img_np_row.shape[0], img_np_row.shape[1]))
-    for feature in range(n_features):
-        invalid_indexes = np.nonzero(np.isnan(img_np_row[:, :, feature]))
-        mask[invalid_indexes] = np.nan
+    # zero-copy view of the rows in the shared cube
+    img_np_row = _predict_cubes[buf][row_min:row_max]
+    n_rows, n_cols, n_features = img_np_row.shape
 
     # reshape each row-band matrix into a n*m array
-    nsamples = (row_max-row_min) * current.cols
-    flat_pixels = img_np_row.reshape((nsamples, n_features))
+    flat_pixels = img_np_row.reshape((n_rows * n_cols, n_features))
 
-    # remove NaNs prior to passing to scikit-learn predict
-    flat_pixels = np.nan_to_num(flat_pixels)
+    # only pass pixels without NaNs to scikit-learn predict
+    valid = ~np.isnan(flat_pixels).any(axis=1)
 
     # perform prediction for classification/regression
     if predict_type == 'raw':
-        result = estimator.predict(flat_pixels)
-        result = result.reshape((row_max-row_min, current.cols))
-
-        # determine nodata value and grass raster type
-        if result.dtype == 'float':
-            nodata = np.nan
-        else:
-            nodata = -2147483648
-
-        # replace NaN values so that the prediction does not have a border
-        result[np.nonzero(np.isnan(mask))] = nodata
+        result = np.full(n_rows * n_cols, nodata, dtype=dtype)
+        if valid.any():
+            result[valid] = _predict_estimator.predict(flat_pixels[valid])
+        result = result.reshape((n_rows, n_cols))
 
     # perform prediction for class probabilities
     if predict_type == 'prob':
-        result = estimator.predict_proba(flat_pixels)
-        result = result.reshape((row_max-row_min, current.cols, result.shape[1]))
-        result[np.nonzero(np.isnan(mask))] = np.nan
-
-    # close maps
-    for i in range(n_features):
-        rasstack[i].close()
+        if valid.any():
+            prob = _predict_estimator.predict_proba(flat_pixels[valid])
+            result = np.full((n_rows * n_cols, prob.shape[1]), nodata,
+                             dtype=dtype)
+            result[valid] = prob
+        else:
+            n_classes = _predict_estimator.predict_proba(
+                np.zeros((1, n_features))).shape[1]
+            result = np.full((n_rows * n_cols, n_classes), nodata,
+                             dtype=dtype)
+        result = result.reshape((n_rows, n_cols, result.shape[1]))
 
     return result
 
@@ -1033,7 +1723,7 @@ def specificity_score(y_true, y_pred):
 
 
 def varimp_permutation(estimator, X, y, n_permutations, scorer,
-                       n_jobs, random_state):
+                       n_jobs, random_state, batch_size=100000):
     """
     Method to perform permutation-based feature importance during
     cross-validation (cross-validation is applied externally to this
@@ -1047,6 +1737,10 @@ def varimp_permutation(estimator, X, y, n_permutations, scorer,
     4. Repeat (3) for many random permutations
     5. Average the repeats
 
+    The features are split between the workers, each of which works on a
+    single copy of X. A column is permuted in place and restored afterwards,
+    and several permutations of a column are predicted in a single batch
+
     Args
     ----
     estimator (object): estimator that has been fitted to a training partition
@@ -1055,10 +1749,11 @@ def varimp_permutation(estimator, X, y, n_permutations, scorer,
     scorer (object): scikit-learn metric function to use
     n_jobs (integer): integer, number of processing cores
     random_state (float): seed to pass to the numpy random.seed
+    batch_size (integer): maximum number of samples to predict at once
 
     Returns
     -------
-    scores (2d numpy array): scores for each predictor following permutation
+    scores (1d numpy array): mean score decrease for each predictor
     """
 
     from sklearn.externals.joblib import Parallel, delayed
@@ -1068,20 +1763,24 @@ def varimp_permutation(estimator, X, y, n_permutations, scorer,
     y_pred = estimator.predict(X)
     best_score = scorer(y, y_pred)
 
-    # repeated permutations and return difference from best score per predictor
+    # split the predictors between the workers
+    if n_jobs < 0:
+        from multiprocessing import cpu_count
+        n_jobs = max(cpu_count() + 1 + n_jobs, 1)
+    features = np.array_split(np.arange(X.shape[1]), min(n_jobs, X.shape[1]))
+
+    # permutations of each predictor and difference from best score
     scores = Parallel(n_jobs=n_jobs)(
         delayed(__permute)(
-            estimator, X, y, best_score, scorer, random_state)
-        for n in range(n_permutations))
-
-    # average the repetitions
-    scores = np.asarray(scores)
-    scores = scores.mean(axis=0)
+            estimator, X, y, best_score, scorer, random_state, i,
+            n_permutations, batch_size)
+        for i in features)
 
-    return scores
+    return np.concatenate(scores)
 
 
-def __permute(estimator, X, y, best_score, scorer, random_state):
+def __permute(estimator, X, y, best_score, scorer, random_state, features,
+              n_permutations, batch_size):
     """
     Permute each predictor and measure difference from best score
 
@@ -1092,29 +1791,50 @@ def __permute(estimator, X, y, best_score, scorer, random_state):
     best_score (float): best scorer obtained on unperturbed data
     scorer (object): scoring method to use to measure importances
     random_state (float): random seed
+    features (1d numpy array): indexes of the predictors to permute
+    n_permutations (integer): number of random permutations to apply
+    batch_size (integer): maximum number of samples to predict at once
 
     Returns
     -------
-    scores (2D numpy array): scores for each predictor following permutation
+    scores (1d numpy array): mean score decrease for each predictor
     """
 
     from numpy.random import RandomState
-    rstate = RandomState(random_state)
 
-    # permute each predictor variable and assess difference in score
-    scores = np.zeros(X.shape[1])
+    n_samples = X.shape[0]
+    n_batch = int(max(1, min(n_permutations, batch_size // max(n_samples, 1))))
+
+    # single working copy of X that is repeated for a batch of permutations
+    Xbatch = np.tile(X, (n_batch, 1))
+
+    scores = np.zeros(len(features))
+
+    for j, i in enumerate(features):
+        # seed per predictor so that results do not depend on n_jobs
+        if random_state is None:
+            rstate = RandomState()
+        else:
+            rstate = RandomState(random_state + i)
+
+        for start in range(0, n_permutations, n_batch):
+            n = min(n_batch, n_permutations - start)
 
-    for i in range(X.shape[1]):
-        Xscram = np.copy(X)
-        Xscram[:, i] = rstate.choice(X[:, i], X.shape[0])
+            # permute the column in place for each permutation of the batch
+            for k in range(n):
+                Xbatch[k*n_samples:(k+1)*n_samples, i] = \
+                    rstate.permutation(X[:, i])
 
-        # fit the model on the training data and predict the test data
-        y_pred = estimator.predict(Xscram)
-        scores[i] = best_score-scorer(y, y_pred)
-        if scores[i] < 0:
-            scores[i] = 0
+            y_pred = estimator.predict(Xbatch[0:n*n_samples])
 
-    return scores
+            for k in range(n):
+                scores[j] += max(best_score - scorer(
+                    y, y_pred[k*n_samples:(k+1)*n_samples]), 0)
+
+        # restore the column
+        Xbatch[:, i] = np.tile(X[:, i], n_batch)
+
+    return scores / n_permutations
 
 
 def __parallel_fit(estimator, X, y, groups, train_indices, sample_weight):
@@ -1130,9 +1850,15 @@ def __parallel_fit(estimator, X, y, groups, train_indices, sample_weight):
         training/validation
     sample_weight (1D numpy array): of len(y) containing weights to use during
         fitting
+
+    Returns
+    -------
+    rs_estimator (object): fitted estimator
+    fit_time (float): time in seconds used to fit the estimator
     """
     from sklearn.pipeline import Pipeline
 
+    start = time.time()
     rs_estimator = deepcopy(estimator)
 
     # create training and test folds
@@ -1161,7 +1887,7 @@ def __parallel_fit(estimator, X, y, groups, train_indices, sample_weight):
     else:
         rs_estimator.fit(X_train, y_train, **fit_params)
 
-    return rs_estimator
+    return (rs_estimator, time.time() - start)
 
 
 def cross_val_scores(estimator, X, y, groups=None, sample_weight=None, cv=3,
@@ -1191,6 +1917,8 @@ def cross_val_scores(estimator, X, y, groups=None, sample_weight=None, cv=3,
     fimp (2D numpy array): permutation feature importances per feature
     clf_resamples (list): List of fitted estimators
     predictions (2d numpy array): with y_true, y_pred, fold
+    timings (dict): Containing lists of times in seconds per cross-validation
+        fold for the fit, predict, scoring and importances steps
     """
 
     from sklearn import metrics
@@ -1310,9 +2038,12 @@ def cross_val_scores(estimator, X, y, groups=None, sample_weight=None, cv=3,
     # -------------------------------------------------------------------------
     # Perform multiprocessing fitting of clf on each fold
     # -------------------------------------------------------------------------
-    clf_resamples = Parallel(n_jobs=n_jobs)(
+    fitted = Parallel(n_jobs=n_jobs)(
         delayed(__parallel_fit)(clf, X, y, groups, train_indices, sample_weight)
         for train_indices in trains)
+    clf_resamples = [estimator for estimator, fit_time in fitted]
+    timings = {'fit': [fit_time for estimator, fit_time in fitted],
+               'predict': [], 'scoring': [], 'importances': []}
 
     # -------------------------------------------------------------------------
     # loop through each fold and calculate performance metrics
@@ -1328,7 +2059,10 @@ def cross_val_scores(estimator, X, y, groups=None, sample_weight=None, cv=3,
         X_test, y_test = X[test_indices], y[test_indices]
 
         # prediction of test fold
+        start = time.time()
         y_pred = clf_resamples[fold].predict(X_test)
+        timings['predict'].append(time.time() - start)
+        start = time.time()
         predictions[test_indices, 0] = y_test
         predictions[test_indices, 1] = y_pred
         predictions[test_indices, 2] = fold
@@ -1373,14 +2107,18 @@ def cross_val_scores(estimator, X, y, groups=None, sample_weight=None, cv=3,
                 byclass_scores[key], byclass_methods[key](
                     y_test, y_pred, labels=labels, average=None)))
 
-        # feature importances using permutation
+        timings['scoring'].append(time.time() - start)
+
+        # feature importances using permutation of the fitted fold model
         if feature_importances is True:
+            start = time.time()
             fimp[fold, :] = varimp_permutation(
                 clf_resamples[fold], X_test, y_test, n_permutations,
                 scoring_methods[scoring[0]], n_jobs, random_state)
+            timings['importances'].append(time.time() - start)
         fold += 1
 
-    return(scores, byclass_scores, fimp, clf_resamples, predictions)
+    return(scores, byclass_scores, fimp, clf_resamples, predictions, timings)
 
 
 
@@ -1467,10 +2205,14 @@ def main():
     model_load = options['load_model']
     load_training = options['load_training']
     save_training = options['save_training']
+    training_cache = options['training_cache']
     indexes = options['indexes']
     rowincr = int(options['rowincr'])
+    manifest = options['manifest'] if options['manifest'] != '' else None
+    max_samples = int(options['max_samples'])
     n_jobs = int(options['n_jobs'])
     lowmem = flags['l']
+    incremental = flags['i']
     balance = flags['b']
 
     # fetch individual raster names from group
@@ -1595,66 +2337,113 @@ def main():
                    'neg_median_absolute_error']
         search_scorer = 'r2'
 
+    # -------------------------------------------------------------------------
+    # Incremental out-of-core training
+    # -------------------------------------------------------------------------
+
+    if incremental is True:
+        if not hasattr(clf, 'partial_fit'):
+            gs.fatal('Incremental training requires a classifier that '
+                     'supports partial_fit')
+        if categorymaps is not None or any(param_grid) is True or cv > 1:
+            gs.fatal('Incremental training does not support categorymaps, '
+                     'hyperparameter tuning or cross-validation')
+
+        gs.message(os.linesep)
+        gs.message(('Incremental fitting of model using ' + classifier))
+        clf, class_labels = incremental_fit(
+            clf, trainingmap, maplist, mode, rowincr, norm_data, balance,
+            random_state)
+
     # -------------------------------------------------------------------------
     # Extract training data
     # -------------------------------------------------------------------------
 
-    if model_load == '':
+    elif model_load == '':
 
         # Sample training data and group id
         if load_training != '':
             X, y, group_id, sample_coords = load_training_data(load_training)
         else:
-            gs.message('Extracting training data')
-
-            # generate spatial clump/patch partitions
-            # clump the labelled pixel raster and set the group_raster
-            # to the clumped raster
-            if trainingmap != '' and cvtype == 'clumped' and group_raster == '':
-                clumped_trainingmap = 'tmp_clumped_trainingmap'
-                tmp_rast.append(clumped_trainingmap)
-                r.clump(input=trainingmap, output=clumped_trainingmap,
-                        overwrite=True, quiet=True)
-                group_raster = clumped_trainingmap
-            elif trainingmap == '' and cvtype == 'clumped':
-                gs.fatal('Cross-validation using clumped training areas ',
-                              'requires raster-based training areas')
-
-            # append spatial clumps or group raster to the predictors
-            if group_raster != '':
-                maplist2 = deepcopy(maplist)
-                maplist2.append(group_raster)
+            # look up previously extracted training data in the cache
+            cache_file = ''
+            if training_cache != '' and trainingmap != '':
+                cached_maps = deepcopy(maplist)
+                if group_raster != '':
+                    cached_maps.append(group_raster)
+                cache_key = training_cache_key(
+                    trainingmap, cached_maps, cvtype=cvtype,
+                    n_partitions=n_partitions, max_samples=max_samples,
+                    random_state=random_state, group_raster=group_raster)
+                cache_file = os.path.join(training_cache, cache_key)
+
+            if cache_file != '' and os.path.exists(
+                    os.path.join(cache_file, 'header.json')):
+                gs.message('Loading cached training data')
+                X, y, group_id, sample_coords = load_training_data(cache_file)
             else:
-                maplist2 = maplist
-
-            # extract training data
-            if trainingmap != '':
-                X, y, sample_coords = extract_pixels(
-                    response=trainingmap, predictors=maplist2, lowmem=lowmem, na_rm=True)
-            elif trainingpoints != '':
-                X, y, sample_coords = extract_points(
-                    trainingpoints, maplist2, field, na_rm=True)
-            group_id = None
-
-            if len(y) < 1 or X.shape[0] < 1:
-                gs.fatal('There are too few training features to perform classification')
-
-            # take group id from last column and remove from predictors
-            if group_raster != '':
-                group_id = X[:, -1]
-                X = np.delete(X, -1, axis=1)
-
-            if cvtype == 'kmeans':
-                clusters = KMeans(
-                    n_clusters=n_partitions,
-                    random_state=random_state, n_jobs=n_jobs)
-                clusters.fit(sample_coords)
-                group_id = clusters.labels_
-
-            # check for labelled pixels and training data
-            if y.shape[0] == 0 or X.shape[0] == 0:
-                gs.fatal('No training pixels or pixels in imagery group '
-                              '...check computational region')
+                gs.message('Extracting training data')
+
+                # generate spatial clump/patch partitions
+                # clump the labelled pixel raster and set the group_raster
+                # to the clumped raster
+                if trainingmap != '' and cvtype == 'clumped' and group_raster == '':
+                    clumped_trainingmap = 'tmp_clumped_trainingmap'
+                    tmp_rast.append(clumped_trainingmap)
+                    r.clump(input=trainingmap, output=clumped_trainingmap,
+                            overwrite=True, quiet=True)
+                    group_raster = clumped_trainingmap
+                elif trainingmap == '' and cvtype == 'clumped':
+                    gs.fatal('Cross-validation using clumped training areas ',
+                                  'requires raster-based training areas')
+
+                # append spatial clumps or group raster to the predictors
+                if group_raster != '':
+                    maplist2 = deepcopy(maplist)
+                    maplist2.append(group_raster)
+                else:
+                    maplist2 = maplist
+
+                # extract training data
+                if trainingmap != '':
+                    X, y, sample_coords = extract_pixels(
+                        response=trainingmap, predictors=maplist2, lowmem=lowmem,
+                        na_rm=True, max_samples=max_samples,
+                        stratify=mode == 'classification',
+                        random_state=random_state)
+                elif trainingpoints != '':
+                    X, y, sample_coords = extract_points(
+                        trainingpoints, maplist2, field, na_rm=True)
+                group_id = None
+
+                if len(y) < 1 or X.shape[0] < 1:
+                    gs.fatal('There are too few training features to perform classification')
+
+                # take group id from last column and remove from predictors
+                if group_raster != '':
+                    group_id = X[:, -1]
+                    X = np.delete(X, -1, axis=1)
+
+                if cvtype == 'kmeans':
+                    clusters = KMeans(
+                        n_clusters=n_partitions,
+                        random_state=random_state, n_jobs=n_jobs)
+                    clusters.fit(sample_coords)
+                    group_id = clusters.labels_
+
+                # check for labelled pixels and training data
+                if y.shape[0] == 0 or X.shape[0] == 0:
+                    gs.fatal('No training pixels or pixels in imagery group '
+                                  '...check computational region')
+
+                # store the extracted training data in the cache
+                if cache_file != '':
+                    save_training_data(
+                        X, y, group_id, sample_coords, cache_file,
+                        header={'response': trainingmap,
+                                'predictors': maplist,
+                                'group_raster': group_raster,
+                                'region': gs.region()})
 
             # shuffle data
             if group_id is None:
@@ -1664,10 +2453,11 @@ def main():
                 X, y, sample_coords, group_id = shuffle(
                     X, y, sample_coords, group_id, random_state=random_state)
 
-            # optionally save extracted data to .csv file
+            # optionally save extracted data to file
             if save_training != '':
                 save_training_data(
-                    X, y, group_id, sample_coords, save_training)
+                    X, y, group_id, sample_coords, save_training,
+                    header={'predictors': maplist, 'region': gs.region()})
 
         # ---------------------------------------------------------------------
         # define the inner search resampling method
@@ -1822,7 +2612,7 @@ def main():
                     scoring.append('matthews_corrcoef')
 
                 # perform the cross-validatation
-                scores, cscores, fimp, models, preds = cross_val_scores(
+                scores, cscores, fimp, models, preds, timings = cross_val_scores(
                     clf, X, y, group_id, class_weights, outer, scoring,
                     importances, n_permutations, random_state, n_jobs)
 
@@ -1859,6 +2649,15 @@ def main():
                                 map(str, np.round(
                                         mat_cscores.std(axis=0), 2)[0])))
 
+                # timings of the cross-validation steps
+                gs.message(os.linesep)
+                gs.message('Cross validation timings (seconds)......:')
+                gs.message('Step \tTotal \tPer fold')
+                for step in ('fit', 'predict', 'scoring', 'importances'):
+                    if len(timings[step]) > 0:
+                        gs.message(step + ':\t%0.2f\t%0.2f' % (
+                            np.sum(timings[step]), np.mean(timings[step])))
+
                 # write cross-validation results for csv file
                 if errors_file != '':
                     errors = pd.DataFrame(scores)
@@ -1889,16 +2688,20 @@ def main():
                     if fimp_file != '':
                         np.savetxt(fname=fimp_file, X=fimp, delimiter=',',
                                    header=','.join(maplist), comments='')
+
+        # class labels for the output of class probabilities
+        if mode == 'classification':
+            class_labels = np.unique(y)
+        else:
+            class_labels = None
     else:
-        # load a previously fitted train object
+        # load a previously fitted model
         if model_load != '':
-            # load a previously fitted model
-            X, y, sample_coords, group_id, clf = joblib.load(model_load)
-            clf.fit(X,y)
+            clf, class_labels = load_model(model_load)
 
     # Optionally save the fitted model
     if model_save != '':
-        joblib.dump((X, y, sample_coords, group_id, clf), model_save)
+        save_model(clf, class_labels, model_save)
 
     # -------------------------------------------------------------------------
     # prediction on grass imagery group
@@ -1912,7 +2715,7 @@ def main():
             gs.message('Predicting classification/regression raster...')
             predict(estimator=clf, predictors=maplist, output=output,
                     predict_type='raw', overwrite=gs.overwrite(),
-                    rowincr=rowincr, n_jobs=n_jobs)
+                    rowincr=rowincr, n_jobs=n_jobs, manifest=manifest)
 
             if predict_resamples is True:
                 for i in range(cv):
@@ -1920,24 +2723,24 @@ def main():
                     predict(estimator=models[i], predictors=maplist,
                             output=resample_name, predict_type='raw',
                             overwrite=gs.overwrite(),
-                            rowincr=rowincr, n_jobs=n_jobs)
+                            rowincr=rowincr, n_jobs=n_jobs, manifest=manifest)
 
         # predict class probabilities
         if probability is True:
             gs.message('Predicting class probabilities...')
             predict(estimator=clf, predictors=maplist, output=output,
                     predict_type='prob', index=indexes,
-                    class_labels=np.unique(y), overwrite=gs.overwrite(),
-                    rowincr=rowincr, n_jobs=n_jobs)
+                    class_labels=class_labels, overwrite=gs.overwrite(),
+                    rowincr=rowincr, n_jobs=n_jobs, manifest=manifest)
 
             if predict_resamples is True:
                 for i in range(cv):
                     resample_name = output + '_Resample' + str(i)
                     predict(estimator=models[i], predictors=maplist,
                             output=resample_name, predict_type='prob',
-                            class_labels=np.unique(y), index=indexes,
+                            class_labels=class_labels, index=indexes,
                             overwrite=gs.overwrite(),
-                            rowincr=rowincr, n_jobs=n_jobs)
+                            rowincr=rowincr, n_jobs=n_jobs, manifest=manifest)
     else:
         gs.message("Model built and now exiting")
 
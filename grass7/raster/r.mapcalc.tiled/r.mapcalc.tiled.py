@@ -37,17 +37,15 @@
 #%option
 #% key: width
 #% type: integer
-#% description: Width of tiles (columns)
-#% answer: 1000
-#% required: yes
+#% description: Deprecated and ignored, tiles span all the columns of the region
+#% required: no
 #%end
 #
 #%option
 #% key: height
 #% type: integer
-#% description: Height of tiles (rows)
-#% answer: 1000
-#% required: yes
+#% description: Height of tiles (rows), computed from region size and processes if not set
+#% required: no
 #%end
 #
 #%option
@@ -67,67 +65,143 @@
 #%end
 #
 #%option
+#% key: tiles_per_process
+#% type: integer
+#% description: Number of tiles per process used to compute the tile height
+#% answer: 4
+#% required: no
+#%end
+#
+#%option
 #% key: mapset_prefix
 #% type: string
-#% description: Mapset prefix
+#% description: Deprecated and ignored, no temporary mapsets are created
 #% required: no
 #%end
 
 
+import os
 import math
+from multiprocessing.pool import ThreadPool
+
 import grass.script as gscript
-from grass.pygrass.modules.grid.grid import *
+from grass.exceptions import CalledModuleError
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.gis.region import Region
+
 
-class MyGridModule(GridModule):
-    """inherit GridModule, but handle the fact that the output name is in the expression"""
+def tile_height(rows, cols, processes, overlap=0, tiles_per_process=4,
+                min_cells=250000):
+    """Return the number of rows of each tile.
 
-    def patch(self):
-        """Patch the final results."""
-        bboxes = split_region_tiles(width=self.width, height=self.height)
-        loc = Location()
-        mset = loc[self.mset.name]
-        mset.visible.extend(loc.mapsets())
-        output_map = self.out_prefix[:]
-        self.out_prefix = ''
-        rpatch_map(output_map,
-                   self.mset.name, self.msetstr, bboxes,
-                   self.module.flags.overwrite,
-                   self.start_row, self.start_col, self.out_prefix)
+    Small tiles keep all the processes busy until the end, even when some
+    tiles are much slower than others, but each tile has a fixed cost
+    (starting r.mapcalc and reading the overlap), so the tiles are kept
+    larger than min_cells and than the overlap.
+
+    >>> tile_height(10000, 10000, 4)
+    625
+    >>> tile_height(100, 100, 4)
+    100
+    >>> tile_height(10000, 10, 4, overlap=10)
+    10000
+    """
+    height = int(math.ceil(rows / float(processes * tiles_per_process)))
+    height = max(height, int(math.ceil(min_cells / float(cols))),
+                 4 * overlap, 1)
+    return min(height, rows)
+
+
+def split_rows(rows, height, overlap=0):
+    """Return a list of tuples with the rows written by each tile and the
+    rows computed by r.mapcalc, including the overlap.
+
+    >>> split_rows(10, 4, 1)
+    [(0, 4, 0, 5), (4, 8, 3, 9), (8, 10, 7, 10)]
+    """
+    return [(start, min(start + height, rows),
+             max(start - overlap, 0), min(start + height + overlap, rows))
+            for start in range(0, rows, height)]
+
+
+def run_tile(args):
+    """Run r.mapcalc over the rows of a tile and return the temporary map"""
+    tmp, rhs, env, nsres, north, south, region = args
+    env = dict(env)
+    env['GRASS_REGION'] = gscript.region_env(n=north, s=south,
+                                             w=region.west, e=region.east,
+                                             nsres=nsres, ewres=region.ewres)
+    gscript.run_command('r.mapcalc', expression='%s = %s' % (tmp, rhs),
+                        overwrite=True, quiet=True, env=env)
+    return tmp
 
 
 def main():
 
     expression = options['expression']
-    width = int(options['width'])
-    height = int(options['height'])
     overlap = int(options['overlap'])
     processes = int(options['processes'])
     output = None
     if options['output']:
         output = options['output']
-    mapset_prefix = None
-    if options['mapset_prefix']:
-        mapset_prefix = options['mapset_prefix']
-
-
-    kwargs = {'expression' : expression,
-              'quiet' : True}
+    for option in ('width', 'mapset_prefix'):
+        if options[option]:
+            gscript.warning(_("Option <%s> is deprecated and ignored") % option)
 
+    lhs, rhs = expression.split('=', 1)
     if output:
         output_mapname = output
     else:
-        output_mapname = expression.split('=')[0].strip()
-
-    grd = MyGridModule('r.mapcalc',
-                       width=width,
-                       height=height,
-                       overlap=overlap,
-                       processes=processes,
-                       split=False,
-                       mapset_prefix=mapset_prefix,
-                       out_prefix=output_mapname,
-                       **kwargs)
-    grd.run()
+        output_mapname = lhs.strip()
+
+    region = Region()
+    height = (int(options['height']) if options['height']
+              else tile_height(region.rows, region.cols, processes,
+                               overlap=overlap,
+                               tiles_per_process=int(options['tiles_per_process'])))
+    tiles = split_rows(region.rows, height, overlap)
+    gscript.verbose(_("Computing %d tiles of %d rows") % (len(tiles), height))
+
+    prefix = 'tmp_%s_%d_' % (output_mapname.split('@')[0], os.getpid())
+    jobs = [('%s%d' % (prefix, i), rhs, os.environ.copy(), region.nsres,
+             region.north - c_start * region.nsres,
+             region.north - c_stop * region.nsres, region)
+            for i, (start, stop, c_start, c_stop) in enumerate(tiles)]
+
+    # tiles are handed out one at a time, so a slow tile does not keep the
+    # other processes idle; the results are written as soon as all the
+    # previous rows are available
+    pool = ThreadPool(processes)
+    out = None
+    try:
+        for (start, stop, c_start, c_stop), tmp in zip(
+                tiles, pool.imap(run_tile, jobs, chunksize=1)):
+            with RasterRow(tmp) as tile:
+                if out is None:
+                    out = RasterRow(output_mapname, mode='w',
+                                    mtype=tile.mtype,
+                                    overwrite=gscript.overwrite())
+                    out.open()
+                for row in range(start, stop):
+                    out.put_row(tile.get_row(row))
+            gscript.run_command('g.remove', flags='f', type='raster',
+                                name=tmp, quiet=True)
+            gscript.percent(stop, region.rows, 1)
+    except CalledModuleError:
+        if out is not None:
+            out.close()
+            out = None
+            gscript.run_command('g.remove', flags='f', type='raster',
+                                name=output_mapname, quiet=True)
+        gscript.fatal(_("r.mapcalc failed on expression <%s>") % expression)
+    finally:
+        pool.terminate()
+        pool.join()
+        if out is not None:
+            out.close()
+        gscript.run_command('g.remove', flags='f', type='raster',
+                            pattern=prefix + '*', quiet=True)
+    gscript.raster_history(output_mapname)
 
 if __name__ == "__main__":
     options, flags = gscript.parser()
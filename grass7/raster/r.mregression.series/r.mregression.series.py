@@ -49,6 +49,14 @@
 #% answer: ols
 #% multiple: no
 #%end
+#%option
+#% key: block_rows
+#% type: integer
+#% description: Number of rows read and fitted together
+#% required: no
+#% answer: 64
+#% multiple: no
+#%end
 
 
 
@@ -57,9 +65,6 @@ import sys
 
 import csv
 import numpy as np
-from numpy.linalg.linalg import LinAlgError
-
-# statsmodels lazy imported at the end of the file
 
 if "GISBASE" not in os.environ:
     sys.stderr.write("You must be in GRASS GIS to run this program.\n")
@@ -68,54 +73,113 @@ if "GISBASE" not in os.environ:
 import grass.script as grass
 from grass.pygrass import raster
 from grass.pygrass.gis.region import Region
+from grass.pygrass.raster.buffer import Buffer
 
 CNULL = -2147483648  # null value for CELL maps
 FNULL = np.nan       # null value for FCELL and DCELL maps
 
 
-def get_val_or_null(map, row, col):
+# Parameters of the robust linear model, they are the defaults of
+# statsmodels RLM: Huber's T norm, MAD scale and 50 IRLS iterations
+HUBER_T = 1.345
+MAD_NORM = 0.6744897501960817
+RLM_MAXITER = 50
+RLM_TOL = 1e-8
+
+
+def get_row_or_null(map, row):
+    """
+    Return the map row as float array, null cells are FNULL
     """
-    Return map value of the cell or FNULL (if the cell is null)
+    values = np.array(map[row], dtype=float)
+    if map.mtype == "CELL":
+        values[values == CNULL] = FNULL
+    return values
+
+
+def wls(y, x, weights):
+    """Weighted least squares for a batch of pixels.
+
+    :param x:   MxPxN array of data points (M samples of P pixels)
+    :param y:   MxP array of output values
+    :param weights: MxP array of the sample weights (0 for no-data)
+    :return:    PxN array of coefficients (x * b = y)
     """
-    value = map.get(row, col)
-    if map.mtype == "CELL" and value == CNULL:
-        value = FNULL
-    return value
+    xtx = np.einsum('mpi,mpj,mp->pij', x, x, weights)
+    xty = np.einsum('mpi,mp,mp->pi', x, y, weights)
+    # pinv gives the minimum norm solution for the singular systems
+    return np.einsum('pij,pj->pi', np.linalg.pinv(xtx), xty)
+
+
+def mad(resid, valid):
+    """Median absolute deviation (around 0) of the valid residuals
+    """
+    resid = np.where(valid, np.abs(resid), np.nan)
+    return np.nanmedian(resid, axis=0) / MAD_NORM
+
+
+def huber_weights(resid, scale):
+    """Weights of Huber's T norm
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.abs(resid / scale)
+        weights = np.where(z <= HUBER_T, 1.0, HUBER_T / z)
+    # Zero scale means exact fitting
+    weights[:, ~(scale > 0)] = 1.0
+    return weights
+
+
+def rlm(y, x, valid):
+    """Robust linear model (iteratively reweighted least squares)
+    for a batch of pixels, see wls for the parameters
+    """
+    mask = valid.astype(float)
+    coefs = wls(y, x, mask)
+    active = np.ones(y.shape[1], dtype=bool)
+    for i in range(RLM_MAXITER):
+        yi, xi, mi = y[:, active], x[:, active], mask[:, active]
+        resid = yi - np.einsum('mpi,pi->mp', xi, coefs[active])
+        weights = huber_weights(resid, mad(resid, mi > 0))
+        new = wls(yi, xi, weights * mi)
+        change = np.max(np.abs(new - coefs[active]), axis=1)
+        coefs[active] = new
+        converged = ~(change > RLM_TOL * (1 + np.max(np.abs(new), axis=1)))
+        active[np.flatnonzero(active)[converged]] = False
+        if not active.any():
+            break
+    return coefs
 
 
 def fit(y, x, model='ols'):
-    """Ordinary least squares.
+    """Fit the regression for a batch of pixels.
 
-    :param x:   MxN matrix of data points
+    :param x:   MxPxN array of data points (M samples of P pixels)
     :param x:   numpy.array
-    :param y:   vector of M output values
+    :param y:   MxP array of output values
     :param y:   numpy.array
-    :return:    vector b of coefficients (x * b = y)
+    :return:    PxN array of coefficients b (x * b = y)
     """
     # if a X sample has nan value,
-    # then the fitting procedure crashes.
-    # Delete no-data samples from the data
-    factor_count = x.shape[1]
-    nan_idx = np.logical_or(np.isnan(y), np.isnan(x).any(axis=1))
-    if nan_idx.any():
-        y = y[~nan_idx]
-        x = x[~nan_idx]
-    if x.shape[0] < x.shape[1]:
-        # The system can't be solved
-        return [FNULL for i in range(factor_count)]
-
+    # then the sample is excluded from the fitting.
+    factor_count = x.shape[2]
+    valid = ~np.logical_or(np.isnan(y), np.isnan(x).any(axis=2))
+    y = np.where(valid, y, 0)
+    x = np.where(valid[:, :, np.newaxis], x, 0)
+    # The system can't be solved
+    solvable = valid.sum(axis=0) >= factor_count
+
+    coefs = np.empty((y.shape[1], factor_count))
+    coefs.fill(FNULL)
+    if not solvable.any():
+        return coefs
+    y, x, valid = y[:, solvable], x[:, solvable], valid[:, solvable]
     if model == 'ols':
-        model = sm.OLS(y, x)
+        coefs[solvable] = wls(y, x, valid.astype(float))
     elif model == 'rlm':
-        model = sm.robust.robust_linear_model.RLM(y, x)
+        coefs[solvable] = rlm(y, x, valid)
     else:
         raise NotImplementedError("Model %s doesn't implemented" % (model, ))
 
-    try:
-        results = model.fit()
-        coefs = results.params
-    except LinAlgError:
-        coefs = [FNULL for i in range(factor_count)]
     return coefs
 
 
@@ -182,7 +246,7 @@ class DataModel(object):
 
     def _init_rasters(self):
         for name in self.y_names:
-            map = raster.RasterSegment(name)
+            map = raster.RasterRow(name)
             if not map.exist():
                 raise ValueError("Raster map %s doesn't exist" % (name, ))
             self._y_rasters.append(map)
@@ -190,7 +254,7 @@ class DataModel(object):
         for names in self.x_names:
             maps = []
             for name in names:
-                map = raster.RasterSegment(name)
+                map = raster.RasterRow(name)
                 if not map.exist():
                     raise ValueError("Raster map %s doesn't exist" % (name, ))
                 maps.append(map)
@@ -202,7 +266,7 @@ class DataModel(object):
         # Rasters of the regression coefitients
         for i in range(self.factor_count):
             name = self.b_names[i]
-            map = raster.RasterSegment(name)
+            map = raster.RasterRow(name)
             self._b_rasters.append(map)
 
     def open_rasters(self,  overwrite):
@@ -229,32 +293,37 @@ class DataModel(object):
                 map = self.x(i, j)
                 map.close()
 
-    def get_sample(self, row, col):
-        """Return X and Y matrices for one pixel sample
+    def get_block(self, start, stop):
+        """Return X and Y arrays for the pixels of the rows start..stop-1,
+        Y has shape (samples, pixels), X has shape (samples, pixels, factors)
         """
-        X = np.empty((self.sample_count, self.factor_count))
-        Y = np.empty(self.sample_count)
-        for snum in range(self.sample_count):
-            y = self.y(snum)
-            Y[snum] = get_val_or_null(y, row, col)
-            for fnum in range(self.factor_count):
-                x = self.x(snum, fnum)
-                X[snum, fnum] = get_val_or_null(x, row, col)
-
-        return Y, X
-
-    def fit(self, model='ols', overwrite=None):
+        rows = range(start, stop)
+        Y = np.array([[get_row_or_null(self.y(snum), r) for r in rows]
+                      for snum in range(self.sample_count)])
+        X = np.array([[[get_row_or_null(self.x(snum, fnum), r) for r in rows]
+                       for fnum in range(self.factor_count)]
+                      for snum in range(self.sample_count)])
+        Y = Y.reshape(self.sample_count, -1)
+        X = X.reshape(self.sample_count, self.factor_count, -1)
+
+        return Y, X.transpose(0, 2, 1)
+
+    def fit(self, model='ols', overwrite=None, block_rows=64):
         try:
             reg = Region()
             self.open_rasters(overwrite=overwrite)
             rows, cols = reg.rows, reg.cols
-            for r in range(rows):
-                for c in range(cols):
-                    Y, X = self.get_sample(r, c)
-                    coefs = fit(Y, X, model)
-                    for i in range(self.factor_count):
-                        b = self.b(i)
-                        b.put(r, c, coefs[i])
+            for start in range(0, rows, block_rows):
+                stop = min(start + block_rows, rows)
+                Y, X = self.get_block(start, stop)
+                coefs = fit(Y, X, model).reshape(stop - start, cols, -1)
+                for i in range(self.factor_count):
+                    b = self.b(i)
+                    for r in range(stop - start):
+                        buf = Buffer((cols, ), b.mtype)
+                        buf[:] = coefs[r, :, i]
+                        b.put_row(buf)
+                grass.percent(stop, rows, 1)
         finally:
             self.close_rasters()
 
@@ -263,6 +332,7 @@ def main(options, flags):
     samples = options['samples']
     res_pref = options['result_prefix']
     model_type = options['model']
+    block_rows = int(options['block_rows'])
     if not os.path.isfile(samples):
         sys.stderr.write("File '%s' doesn't exist.\n" % (samples, ))
         sys.exit(1)
@@ -270,17 +340,11 @@ def main(options, flags):
     headers, outputs, inputs = get_sample_names(samples)
 
     model = DataModel(headers, outputs, inputs, res_pref)
-    model.fit(model=model_type, overwrite=grass.overwrite())
+    model.fit(model=model_type, overwrite=grass.overwrite(),
+              block_rows=block_rows)
     sys.exit(0)
 
 if __name__ == "__main__":
     options, flags = grass.parser()
 
-    # lazy import (global to avoid import in a loop)
-    try:
-        import statsmodels.api as sm
-    except ImportError:
-        grass.fatal(_("Cannot import statsmodels."
-                      " Install python-statmodels package first"))
-
     main(options, flags)
@@ -79,6 +79,18 @@
 #% required: no
 #%end
 #%option G_OPT_F_OUTPUT
+#% key: learning_state
+#% description: File (npz format) to keep the SVM parameters and the kernel matrix of the labeled samples between learning steps
+#% required: no
+#%end
+#%option
+#% key: tuning_interval
+#% type: integer
+#% description: Number of learning steps between two automatic parameter searches (C, gamma) when a learning state file is used
+#% answer: 5
+#% required: no
+#%end
+#%option G_OPT_F_OUTPUT
 #% key: predictions
 #% description: Output file for class predictions
 #% required: no
@@ -110,7 +122,7 @@ import matplotlib.pyplot as plt
 
 
 
-def load_data(file_path, labeled=False, skip_header=1, scale=True) :
+def load_data(file_path, labeled=False, skip_header=1, scale=True, scaler=None) :
 
     """
         Load the data from a csv file
@@ -119,11 +131,14 @@ def load_data(file_path, labeled=False, skip_header=1, scale=True) :
         :param labeled: True if the data is labeled (default=False)
         :param skip_header: Header size (in line) (default=1)
         :param scale: True if the data should be normalize (default=True)
+        :param scaler: Mean and scale of the features used to normalize the data,
+                       None to normalize with the mean and scale of the file (default=None)
 
         :type file_path: string
         :type labeled: boolean
         :type skip_header: int
         :type scale: boolean
+        :type scaler: tuple(ndarray, ndarray)
 
         :return: Return 4 arrays, the features X, the IDs, the labels y and the header
         :rtype: ndarray
@@ -146,7 +161,9 @@ def load_data(file_path, labeled=False, skip_header=1, scale=True) :
         y = []
         X = data[:,1:] #remove ID
 
-    if scale :
+    if scale and scaler is not None :
+        X = (X - scaler[0]) / scaler[1]
+    elif scale :
         X = preprocessing.scale(X)
 
     return X, ID, y, header
@@ -282,7 +299,7 @@ def linear_scale(data) :
 
     return (data-p5)/(p95-p5)
 
-def train(X, y, c_svm, gamma_parameter) :
+def train(X, y, c_svm, gamma_parameter, K=None) :
     """
         Train a SVM classifier.
 
@@ -290,15 +307,155 @@ def train(X, y, c_svm, gamma_parameter) :
         :param gamma: Kernel coefficient
         :param X: Features of the training samples
         :param y: Labels of the training samples
+        :param K: Precomputed rbf kernel matrix of the training samples (default=None)
 
         :return: Returns the trained classifier
-        :rtype: sklearn.svm.SVC
+        :rtype: sklearn.svm.SVC or PrecomputedKernelSVC
     """
+    if K is not None :
+        classifier = svm.SVC(kernel='precomputed', C=c_svm, probability=False,decision_function_shape='ovr', random_state=1938475632)
+        classifier.fit(K, y)
+        return PrecomputedKernelSVC(classifier, X, gamma_parameter)
+
     classifier = svm.SVC(kernel='rbf', C=c_svm, gamma=gamma_parameter, probability=False,decision_function_shape='ovr', random_state=1938475632)
     classifier.fit(X, y)
 
     return classifier
 
+class PrecomputedKernelSVC(object) :
+    """
+        SVM classifier trained on a precomputed rbf kernel matrix. The kernel between
+        new samples and the training samples is computed by batches of samples.
+
+        :param classifier: SVC fitted with kernel='precomputed'
+        :param X_train: Features of the training samples
+        :param gamma: Kernel coefficient
+        :param batch_size: Number of samples processed at once (default=10000)
+
+        :type classifier: sklearn.svm.SVC
+        :type X_train: ndarray(#samples x #features)
+        :type gamma: float
+        :type batch_size: int
+    """
+    def __init__(self, classifier, X_train, gamma, batch_size=10000) :
+        self.classifier = classifier
+        self.X_train = X_train
+        self.gamma = gamma
+        self.batch_size = batch_size
+
+    def _batches(self, method, X) :
+        results = [getattr(self.classifier, method)(rbf_kernel(X[start:start+self.batch_size], self.X_train, gamma=self.gamma))
+                   for start in range(0, X.shape[0], self.batch_size)]
+        return np.concatenate(results)
+
+    def decision_function(self, X) :
+        return self._batches('decision_function', X)
+
+    def predict(self, X) :
+        return self._batches('predict', X)
+
+    def score(self, X, y) :
+        return np.mean(self.predict(X) == y)
+
+def load_learning_state(state_file) :
+    """
+        Load the state of the previous learning step
+
+        :param state_file: Path to the learning state file (npz format)
+        :type state_file: string
+
+        :return: The learning state (step, c_svm, gamma, ID, X, D, mean, scale) or None if the file does not exist
+        :rtype: dict
+    """
+    if state_file == '' or not os.path.isfile(state_file) :
+        return None
+
+    with np.load(state_file) as state :
+        return {key: state[key] for key in state.files}
+
+def learning_scaler(state_file, training_file) :
+    """
+        Return the mean and scale used to normalize the features when a learning state
+        file is used. They are computed on the training set of the first learning step
+        and kept in the learning state, so the normalized features of the labeled samples
+        don't change between the learning steps.
+
+        :param state_file: Path to the learning state file (npz format)
+        :param training_file: Path to the training set csv file
+
+        :type state_file: string
+        :type training_file: string
+
+        :return: The mean and the scale of the features
+        :rtype: tuple(ndarray, ndarray)
+    """
+    if os.path.isfile(state_file) :
+        with np.load(state_file) as state :
+            if 'mean' in state.files :
+                return state['mean'], state['scale']
+
+    X = load_data(training_file, labeled=True, scale=False)[0]
+    scaler = preprocessing.StandardScaler().fit(X)
+    return scaler.mean_, scaler.scale_
+
+def save_learning_state(state_file, step, c_svm, gamma_parameter, ID, X, D, scaler) :
+    """
+        Save the state of the learning step
+
+        :param state_file: Path to the learning state file (npz format)
+        :param step: Number of the learning step
+        :param c_svm: Penalty parameter C of the error term.
+        :param gamma_parameter: Kernel coefficient
+        :param ID: IDs of the training samples
+        :param X: Features of the training samples
+        :param D: Squared euclidean distances between the training samples
+        :param scaler: Mean and scale used to normalize the features
+    """
+    with open(state_file, 'wb') as f :
+        np.savez(f, step=step, c_svm=c_svm, gamma=gamma_parameter, ID=ID, X=X, D=D,
+                 mean=scaler[0], scale=scaler[1])
+
+def kernel_matrix(X, ID, gamma_parameter, state=None) :
+    """
+        Compute the rbf kernel matrix of the training samples from their squared
+        distances. The distances of samples that were already labeled in the previous
+        learning step (same ID and same features) are taken from the previous learning
+        state and only the distances of the new samples are computed, whatever the gamma.
+
+        :param X: Features of the training samples
+        :param ID: IDs of the training samples
+        :param gamma_parameter: Kernel coefficient
+        :param state: Learning state of the previous step (default=None)
+
+        :type X: ndarray(#samples x #features)
+        :type ID: ndarray(#samples)
+        :type gamma_parameter: float
+        :type state: dict
+
+        :return: The kernel matrix and the squared distances matrix
+        :rtype: ndarray(#samples x #samples), ndarray(#samples x #samples)
+    """
+    nbr_samples = X.shape[0]
+    D = np.empty((nbr_samples, nbr_samples))
+    known = np.zeros(nbr_samples, dtype=bool)
+
+    if state is not None and 'D' in state and state['X'].shape[1:] == X.shape[1:] :
+        previous = {sample_id: index for index, sample_id in enumerate(state['ID'])}
+        index = np.array([previous.get(sample_id, -1) for sample_id in ID], dtype=int)
+        known = index >= 0
+        known[known] = (state['X'][index[known]] == X[known]).all(axis=1)
+        D[np.ix_(known, known)] = state['D'][np.ix_(index[known], index[known])]
+
+    new = ~known
+    if new.any() :
+        D_new = euclidean_distances(X[new], X, squared=True)
+        D[new, :] = D_new
+        D[:, new] = D_new.T
+
+    gcore.verbose('Kernel rows reused : {}, computed : {}'.format(known.sum(), new.sum()))
+
+    return np.exp(-gamma_parameter * D), D
+
 def active_diversity_sample_selection(X_unlabled, nbr, classifier) :
     """
         Select a number of samples to label based on uncertainety and diversity
@@ -322,46 +479,43 @@ def active_diversity_sample_selection(X_unlabled, nbr, classifier) :
 
     return diversity_filter(uncertain_samples, uncertain_samples_index, nbr, diversity_lambda)
 
-def uncertainty_filter(samples, nbr, classifier) :
+def uncertainty_filter(samples, nbr, classifier, batch_size=100000) :
     """
         Keep only a few samples based on an uncertainty criterion
         Return the indexes of samples to keep
 
+        The decision function is evaluated on batches of samples and only
+        the functional margin of each sample is kept in memory
+
         :param samples: Pool of unlabeled samples to select from
         :param nbr: number of samples to select from the pool
         :param classifier: Used to predict the class of each sample
+        :param batch_size: Number of samples scored at once (default=100000)
 
         :type X_unlabeled: ndarray(#samples x #features)
         :type nbr: int
         :type classifier: sklearn.svm.SVC
+        :type batch_size: int
 
         :return: Indexes of selected samples
         :rtype: ndarray
     """
     NBR_NEW_SAMPLE = nbr
-    decision_function = np.absolute(classifier.decision_function(samples))
 
     # Check if the number of samples to return is not
     # bigger than the total number of samples
     if (nbr >= samples.shape[0]) :
         NBR_NEW_SAMPLE = samples.shape[0] - 1
 
-
-    # Get the max distance to each class hyperplane for each example
-    max_index = np.argmax(decision_function[:,:], axis=1)
-    max_values = decision_function[np.arange(len(decision_function)), max_index]
-
-    # Make the max values very small.
-    # The max value is now the second best
-    decision_function[np.arange(len(decision_function)), max_index] = np.NINF
-
-    # Get the second max distance to each class to hyperplane for each example
-    second_max_index = np.argmax(decision_function[:,:], axis=1)
-    second_max_values = decision_function[np.arange(len(decision_function)), second_max_index]
-
     # "Functionnal margin" for multiclass classifiers for each sample
-    f_MC = max_values - second_max_values
+    f_MC = np.empty(samples.shape[0])
 
+    for start in range(0, samples.shape[0], batch_size) :
+        decision_function = np.absolute(classifier.decision_function(samples[start:start+batch_size]))
+
+        # Difference between the max and the second max distance to each class hyperplane
+        two_max = np.partition(decision_function, -2, axis=1)[:, -2:]
+        f_MC[start:start+batch_size] = two_max[:, 1] - two_max[:, 0]
 
     selected_sample_index = np.argpartition(f_MC, NBR_NEW_SAMPLE)[:NBR_NEW_SAMPLE]
 
@@ -372,6 +526,11 @@ def diversity_filter(samples, uncertain_samples_index, nbr, diversity_lambda=0.2
         Keep only 'nbr' samples based on a diversity criterion (bruzzone2009 : Active Learning For Classification Of Remote Sensing Images)
         Return the indexes of samples to keep
 
+        The samples are discarded one by one. Instead of recomputing the distances between all
+        remaining samples after each discard, the closest neighbours are found with a ball tree and
+        only updated for samples whose closest neighbour was discarded, and the sum of the distances
+        to the other samples is updated by removing the distances to the discarded sample.
+
         :param samples: Pool of unlabeled samples
         :param uncertain_samples: Indexes of uncertain samples in the arry of samples
         :param nbr: number of samples to select from the pool
@@ -386,22 +545,101 @@ def diversity_filter(samples, uncertain_samples_index, nbr, diversity_lambda=0.2
         :rtype: ndarray
     """
     L = diversity_lambda
+    samples = np.asarray(samples, dtype=float)
     m = samples.shape[0]	# Number of samples
-    samples_cpy = np.empty(samples.shape)
-    samples_cpy[:] = samples
 
     selected_sample_index = uncertain_samples_index	# At the begining, take all samples
+    if selected_sample_index.shape[0] <= nbr :
+        return selected_sample_index
+
+    remaining = np.ones(m, dtype=bool)
+    tree = BallTree(samples)
+    closest_index, dist_to_closest = closest_samples(tree, samples, np.arange(m), remaining)
+    sum_dist = kernel_sum(samples, samples)
 
     while (selected_sample_index.shape[0] > nbr) :
 
-        dist_to_closest = distance_to_closest(samples_cpy)
-        average_dist = average_distance(samples_cpy)
-        discard = np.argmax(L*dist_to_closest + (1-L) * (1./m) * average_dist)
+        remaining_index = np.nonzero(remaining)[0]
+        nbr_remaining = remaining_index.shape[0]
+        average_dist = (sum_dist[remaining_index] - 1)/(nbr_remaining-1)	# Remove dist to itself (=1)
+        discard = np.argmax(L*dist_to_closest[remaining_index] + (1-L) * (1./m) * average_dist)
         selected_sample_index = np.delete(selected_sample_index, discard)	# Remove the sample to discard
-        samples_cpy = np.delete(samples_cpy, discard, axis=0)
+
+        # Incremental update of the distances without the discarded sample
+        discarded = remaining_index[discard]
+        remaining[discarded] = False
+        sum_dist -= rbf_kernel(samples, samples[discarded:discarded+1])[:, 0]
+        outdated = np.nonzero(remaining & (closest_index == discarded))[0]
+        if outdated.shape[0] > 0 :
+            closest_index[outdated], dist_to_closest[outdated] = closest_samples(tree, samples, outdated, remaining)
 
     return selected_sample_index
 
+def closest_samples(tree, samples, indexes, remaining) :
+    """
+        For some samples, find the closest other sample among the remaining samples using a ball tree,
+        and compute the (rbf kernel) distance to it
+
+        :param tree: Ball tree built on all samples
+        :param samples: All samples
+        :param indexes: Indexes of the samples to consider
+        :param remaining: True for the samples that can be a closest neighbour
+
+        :type tree: sklearn.neighbors.BallTree
+        :type samples: ndarray(#samples x #features)
+        :type indexes: ndarray(#indexes)
+        :type remaining: ndarray(#samples) of booleans
+
+        :return: For each sample, the index of its closest neighbour (-1 if none) and the distance to it
+        :rtype: ndarray(#indexes), ndarray(#indexes)
+    """
+    nbr_samples = samples.shape[0]
+    closest_index = np.full(indexes.shape[0], -1, dtype=int)
+    dist_to_closest = np.full(indexes.shape[0], np.NINF)
+
+    # Query an increasing number of neighbours until a remaining neighbour is found
+    k = 2
+    todo = np.arange(indexes.shape[0])
+    while todo.shape[0] > 0 :
+        k = min(k, nbr_samples)
+        neighbours = tree.query(samples[indexes[todo]], k=k, return_distance=False)
+        valid = remaining[neighbours] & (neighbours != indexes[todo][:, np.newaxis])
+        found = valid.any(axis=1)
+        closest_index[todo[found]] = neighbours[found, valid[found].argmax(axis=1)]
+        todo = todo[~found]
+        if k == nbr_samples :
+            break
+        k *= 2
+
+    found = closest_index >= 0
+    gamma = 1.0 / samples.shape[1] # Default gamma of rbf_kernel
+    squared_dist = ((samples[indexes[found]] - samples[closest_index[found]])**2).sum(axis=1)
+    dist_to_closest[found] = np.exp(squared_dist * -gamma)
+
+    return closest_index, dist_to_closest
+
+def kernel_sum(samples, others, batch_size=1000) :
+    """
+        For each sample, computes the sum of the (rbf kernel) distances to the other samples
+        by batches of samples, without storing the full distance matrix
+
+        :param samples: Samples to consider
+        :param others: Samples to compute the distances to
+        :param batch_size: Number of samples processed at once (default=1000)
+
+        :type samples: ndarray(#samples x #features)
+        :type others: ndarray(#others x #features)
+        :type batch_size: int
+
+        :return: For each sample, the sum of the distances to the other samples
+        :rtype: ndarray(#samples)
+    """
+    sum_dist = np.empty(samples.shape[0])
+    for start in range(0, samples.shape[0], batch_size) :
+        sum_dist[start:start+batch_size] = rbf_kernel(samples[start:start+batch_size], others).sum(axis=1)
+
+    return sum_dist
+
 def distance_to_closest(samples) :
     """
         For each sample, computes the distance to its closest neighbour
@@ -412,9 +650,10 @@ def distance_to_closest(samples) :
         :return: For each sample, the distance to its closest neighbour
         :rtype: ndarray(#samples)
     """
-    dist_with_samples = rbf_kernel(samples, samples) # Distance between each samples (symetric matrix)
-    np.fill_diagonal(dist_with_samples, np.NINF) # Do not take into acount the distance between a sample and itself (values on the diagonal)
-    dist_with_closest = dist_with_samples.max(axis=0) # For each sample, the distance to the closest other sample
+    samples = np.asarray(samples, dtype=float)
+    nbr_samples = samples.shape[0]
+    tree = BallTree(samples)
+    closest_index, dist_with_closest = closest_samples(tree, samples, np.arange(nbr_samples), np.ones(nbr_samples, dtype=bool))
 
     return dist_with_closest
 
@@ -431,12 +670,11 @@ def average_distance(samples) :
     """
     samples = np.asarray(samples)
     nbr_samples = samples.shape[0]
-    dist_with_samples = rbf_kernel(samples, samples)
-    average_dist = (dist_with_samples.sum(axis=1) - 1)/(nbr_samples-1)	# Remove dist to itself (=1)
+    average_dist = (kernel_sum(samples, samples) - 1)/(nbr_samples-1)	# Remove dist to itself (=1)
 
     return average_dist
 
-def learning(X_train, y_train, X_test, y_test, X_unlabeled, ID_unlabeled, steps, sample_selection) :
+def learning(X_train, y_train, X_test, y_test, X_unlabeled, ID_unlabeled, steps, sample_selection, ID_train=None, state_file='', tuning_interval=1, scaler=None) :
     """
         Train a SVM classifier with the training data, compute the score of the classifier based on testing data and
         make a class prediction for each sample in the unlabeled data.
@@ -450,6 +688,10 @@ def learning(X_train, y_train, X_test, y_test, X_unlabeled, ID_unlabeled, steps,
         :param ID_unlabeled: IDs of unlabeled samples
         :param steps: Number of samples to label
         :param sample_selection: Function used to select the samples to label (different heuristics)
+        :param ID_train: IDs of training samples, used to reuse the kernel matrix (default=None)
+        :param state_file: Path to the learning state file, empty to disable (default='')
+        :param tuning_interval: Number of learning steps between two parameter searches (default=1)
+        :param scaler: Mean and scale used to normalize the features, saved in the learning state (default=None)
 
         :type X_train: ndarray(#samples x #features)
         :type y_train: ndarray(#samples)
@@ -459,6 +701,10 @@ def learning(X_train, y_train, X_test, y_test, X_unlabeled, ID_unlabeled, steps,
         :type ID_unlabeled: ndarray(#samples)
         :type steps: int
         :type samples_selection: callable
+        :type ID_train: ndarray(#samples)
+        :type state_file: string
+        :type tuning_interval: int
+        :type scaler: tuple(ndarray, ndarray)
 
         :return: The IDs of samples to label, the score of the classifier and the prediction for all unlabeled samples
         :rtype indexes: ndarray(#steps)
@@ -469,10 +715,23 @@ def learning(X_train, y_train, X_test, y_test, X_unlabeled, ID_unlabeled, steps,
     if(X_unlabeled.size == 0) :
         raise Exception("Pool of unlabeled samples empty")
 
-    c_svm, gamma_parameter = SVM_parameters(options['c_svm'], options['gamma_parameter'], X_train, y_train, search_iter)
+    state = load_learning_state(state_file)
+    step = int(state['step']) + 1 if state is not None else 0
+
+    c_svm, gamma_parameter = options['c_svm'], options['gamma_parameter']
+    if state is not None and step % tuning_interval != 0 :
+        # Reuse the parameters of the previous step instead of a new search
+        c_svm = c_svm if c_svm != '' else str(state['c_svm'])
+        gamma_parameter = gamma_parameter if gamma_parameter != '' else str(state['gamma'])
+    c_svm, gamma_parameter = SVM_parameters(c_svm, gamma_parameter, X_train, y_train, search_iter)
     gcore.message('Parameters used : C={}, gamma={}, lambda={}'.format(c_svm, gamma_parameter, diversity_lambda))
 
-    classifier = train(X_train, y_train, c_svm, gamma_parameter)
+    if state_file != '' :
+        K, D = kernel_matrix(X_train, ID_train, gamma_parameter, state)
+        classifier = train(X_train, y_train, c_svm, gamma_parameter, K)
+        save_learning_state(state_file, step, c_svm, gamma_parameter, ID_train, X_train, D, scaler)
+    else :
+        classifier = train(X_train, y_train, c_svm, gamma_parameter)
     score = classifier.score(X_test, y_test)
 
     predictions = classifier.predict(X_unlabeled)
@@ -526,7 +785,7 @@ def main():
     global search_iter
 
     global svm, preprocessing, train_test_split, RandomizedSearchCV
-    global StratifiedKFold, rbf_kernel
+    global StratifiedKFold, rbf_kernel, euclidean_distances, BallTree
     try :
         from sklearn import svm
         from sklearn import preprocessing
@@ -534,6 +793,8 @@ def main():
         from sklearn.model_selection import RandomizedSearchCV
         from sklearn.model_selection import StratifiedKFold
         from sklearn.metrics.pairwise import rbf_kernel
+        from sklearn.metrics.pairwise import euclidean_distances
+        from sklearn.neighbors import BallTree
     except ImportError :
         gcore.fatal("This module requires the scikit-learn python package. Please install it.")
 
@@ -541,10 +802,15 @@ def main():
     search_iter = int(options['search_iter']) if options['search_iter'] != '0' else 10					# Number of samples to label at each iteration
     diversity_lambda = float(options['diversity_lambda']) if options['diversity_lambda'] != '' else 0.25		# Lambda parameter used in the diversity heuristic
     nbr_uncertainty = int(options['nbr_uncertainty']) if options['nbr_uncertainty'] != '0' else 15 	# Number of samples to select (based on uncertainty criterion) before applying the diversity criterion. Must be at least greater or equal to [LEARNING][steps]
+    tuning_interval = max(int(options['tuning_interval']), 1) if options['tuning_interval'] != '' else 5	# Number of learning steps between two parameter searches
+
+    scaler = None
+    if options['learning_state'] != '' : # Keep the same normalization between the learning steps
+        scaler = learning_scaler(options['learning_state'], options['training_set'])
 
-    X_train, ID_train, y_train, header_train = load_data(options['training_set'], labeled = True)
-    X_test, ID_test, y_test, header_test = load_data(options['test_set'], labeled = True)
-    X_unlabeled, ID_unlabeled, y_unlabeled, header_unlabeled = load_data(options['unlabeled_set'])
+    X_train, ID_train, y_train, header_train = load_data(options['training_set'], labeled = True, scaler=scaler)
+    X_test, ID_test, y_test, header_test = load_data(options['test_set'], labeled = True, scaler=scaler)
+    X_unlabeled, ID_unlabeled, y_unlabeled, header_unlabeled = load_data(options['unlabeled_set'], scaler=scaler)
 
     nbr_train = ID_train.shape[0]
 
@@ -556,7 +822,8 @@ def main():
         gcore.warning('No update file specified : could not write the updated files.')
     nbr_new_train = ID_train.shape[0]
 
-    samples_to_label_IDs, score, predictions = learning(X_train, y_train, X_test, y_test, X_unlabeled, ID_unlabeled, learning_steps, active_diversity_sample_selection)
+    samples_to_label_IDs, score, predictions = learning(X_train, y_train, X_test, y_test, X_unlabeled, ID_unlabeled, learning_steps, active_diversity_sample_selection,
+                                                        ID_train, options['learning_state'], tuning_interval, scaler)
 
     X_unlabeled, ID_unlabeled, y_unlabeled, header_unlabeled = load_data(options['unlabeled_set'], scale=False) # Load unscaled data
 
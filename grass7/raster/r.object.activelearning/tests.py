@@ -10,6 +10,11 @@ import imp
 open_file, file_name, description = imp.find_module('r.objects.activelearning')
 al = imp.load_source('al', file_name, open_file)
 
+# sklearn functions are imported in main() of the module
+from sklearn.neighbors import BallTree
+al.rbf_kernel = rbf_kernel
+al.BallTree = BallTree
+
 def silent_remove(filename) :
 	"""
 		Remove the file if it exists or do nothing if it does not exists
@@ -113,6 +118,27 @@ class Test (unittest.TestCase) :
 		self.assertTrue((samples == np.array([a, b, b_bis, c, d, e, f, g, h, i])).all())	# Check that the original array was not modified
 
 
+	def test_diversity_criterion_bruteforce(self) :
+		# Compare with the diversity criterion computed from the full distance matrix at each step
+		np.random.seed(1)
+		samples = np.random.rand(60, 3)
+		L = 0.25
+		m = samples.shape[0]
+
+		expected = np.arange(m)
+		remaining = samples
+		while expected.shape[0] > 10 :
+			dist = rbf_kernel(remaining, remaining)
+			average_dist = (dist.sum(axis=1) - 1)/(remaining.shape[0]-1)
+			np.fill_diagonal(dist, np.NINF)
+			discard = np.argmax(L*dist.max(axis=0) + (1-L) * (1./m) * average_dist)
+			expected = np.delete(expected, discard)
+			remaining = np.delete(remaining, discard, axis=0)
+
+		selected_samples = al.diversity_filter(samples, np.arange(m), 10, L)
+
+		self.assertTrue((np.sort(selected_samples) == np.sort(expected)).all())
+
 	def test_write_result_file(self) :
 		X = np.array([
 			[11., 3.5, 4.7],
@@ -39,7 +39,7 @@
 #% type: string
 #% gisprompt: prefix of result raster names
 #% description: Prefix for raster names of filterd X(t)
-#% required : yes
+#% required : no
 #% multiple: no
 #%end
 #%option
@@ -47,15 +47,15 @@
 #% type: string
 #% gisprompt: prefix for raster names of decomposition coefficients
 #% description: Prefix for names of result raster (rasters of coefficients)
-#% required : yes
+#% required : no
 #% multiple: no
 #%end
 #%option
-#% key:  timevar_prefix
+#% key: residual_prefix
 #% type: string
-#% gisprompt: prefix for raster names of time variables
-#% description: Prefix for names of result raster (rasters of time variables)
-#% required : yes
+#% gisprompt: prefix for raster names of residuals
+#% description: Prefix for raster names of residuals X(t) - filterd X(t)
+#% required : no
 #% multiple: no
 #%end
 #%option
@@ -66,22 +66,39 @@
 #% required : yes
 #% multiple: yes
 #%end
+#%option
+#% key: block_rows
+#% type: integer
+#% description: Number of rows read and decomposed together
+#% required: no
+#% answer: 64
+#% multiple: no
+#%end
+#%rules
+#% required: result_prefix,coef_prefix,residual_prefix
+#%end
 
 
 
 
 import os
 import sys
-import csv
-import uuid
 
 from math import pi, degrees
 
+import numpy as np
+
 if "GISBASE" not in os.environ:
     sys.stderr.write("You must be in GRASS GIS to run this program.\n")
     sys.exit(1)
 
 import grass.script as grass
+from grass.pygrass import raster
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster.buffer import Buffer
+
+CNULL = -2147483648  # null value for CELL maps
+FNULL = np.nan       # null value for FCELL and DCELL maps
 
 
 def get_time(N, t, deg=True):
@@ -98,125 +115,133 @@ def get_time(N, t, deg=True):
 def _freq_to_name(freq):
     return "_fr%s" % (freq)
 
-def _time_to_name(time):
-    return "_t%04d" % (time, )
-
 
-def _generate_time(N, prefix):
-    """Generate (constant) rasters of time line
-        t0, t1, t2, ..., t_{N-1})
-        where t0 = 0, t_{N-1} = 2*pi
-
-    N -- count of result rasters
-    prefix -- prefix for the raster names
-
-    return list of names for the result rasters
+def design_matrix(N, freq):
+    """Return the names of the variables and the (N, K) matrix of their
+    values at the N time points: const, time and sin(), cos() of each
+    frequency. The time is in degrees (as the time variables of r.mapcalc).
     """
-    assert N > 1
-    names = dict()
-    for i in range(N):
-        output = prefix + _time_to_name(i)
-        t = get_time(N, i, deg=True)
-        grass.mapcalc("${out} = ${t}", out=output, t=t,
-                      quiet=True, overwrite=grass.overwrite())
-        names[i] = output
-
-    return names
+    names = ['const', 'time']
+    for f in freq:
+        names.append('sin' + _freq_to_name(f))
+        names.append('cos' + _freq_to_name(f))
 
+    time = np.array([get_time(N, i, deg=True) for i in range(N)])
+    columns = [np.ones(N), time]
+    for f in freq:
+        columns.append(np.sin(np.radians(f * time)))
+        columns.append(np.cos(np.radians(f * time)))
 
-def _generate_harmonics(time_names, freq, prefix):
-    """Generate (constant) rasters of harmonics
-        t0, t1, t2, ..., t_{N-1})
-        where t0 = 0, t_{N-1} = 2*pi
+    return names, np.column_stack(columns)
 
-    freq -- frequencies for sin() and cos() rasters
-    prefix -- prefix for the raster names
 
-    return list of names for the result rasters
+def get_row_or_null(map, row):
     """
-    names = dict()
-    for i in time_names:
-        harm = dict()
-        t = get_time(len(time_names), i)
-        for f in freq:
-            sin_output = prefix + 'sin' + _time_to_name(i) + _freq_to_name(f)
-            grass.mapcalc("${out} = sin(${f} * ${t})", out=sin_output, t=t, f=f,
-                          quiet=True, overwrite=grass.overwrite())
-
-            cos_output = prefix + 'cos' + _time_to_name(i) + _freq_to_name(f)
-            grass.mapcalc("${out} = cos(${f} * ${t})", out=cos_output, t=t, f=f,
-                          quiet=True, overwrite=grass.overwrite())
-            harm[f] = dict(sin=sin_output, cos=cos_output)
-
-        names[i] = harm
-
-    return names
-
-def _generate_const(prefix):
-    output = prefix + 'const'
-    grass.mapcalc("${out} = 1.0", out=output,
-                  quiet=True, overwrite=grass.overwrite())
-    return output
-
-def generate_vars(time_count, freq, prefix):
-    """Generate time_count sets of variables.
+    Return the map row as float array, null cells are FNULL
     """
-    const_name = _generate_const(prefix)
-    time_names = _generate_time(time_count, prefix)
-    harm_names = _generate_harmonics(time_names, freq, prefix)
+    values = np.array(map[row], dtype=float)
+    if map.mtype == "CELL":
+        values[values == CNULL] = FNULL
+    return values
 
-    return const_name, time_names, harm_names
 
-def _generate_sample_descr(fileobj, freq, xnames, const_name, time_names, harm_names):
-    """Generate settings file for r.mregression.series
+def decompose(data, design, projection):
+    """Return (P, K) coefficients of the P pixels of data (N, P).
 
+    projection is the pseudo-inverse of design (N, K), the pixels
+    without NULLs are projected by a single matrix multiply. The pixels with
+    NULLs are fitted over their non-NULL values, the result is NULL only if
+    there aren't enough non-NULL values for computing.
     """
-    freq_names = []
-    for f in freq:
-        freq_names.append('sin' + _freq_to_name(f))
-        freq_names.append('cos' + _freq_to_name(f))
-    header = ['x', 'const', 'time'] + freq_names
-
-    writer = csv.writer(fileobj, delimiter=',')
-    writer.writerow(header)
-
-    size = len(xnames)
-    for i in range(size):
-        row = [xnames[i], const_name, time_names[i]]
-        f_name = harm_names[i]
-        for f in freq:
-            sin_name = f_name[f]['sin']
-            cos_name = f_name[f]['cos']
-            row.append(sin_name)
-            row.append(cos_name)
-        writer.writerow(row)
-
-def regression(settings_name, coef_prefix):
-    grass.run_command('r.mregression.series',
-                      samples=settings_name, result_prefix=coef_prefix,
-                      overwrite=grass.overwrite())
-
-
-def inverse_transform(settings_name, coef_prefix, result_prefix='res.'):
-    reader = csv.reader(open(settings_name), delimiter=',')
-    header = reader.next()
-
-    data_names = [coef_prefix + name for name in header[1:]]
-
-    for row in reader:
-        s = "%s%s = " % (result_prefix, row[0])
-        sums = []
-        for i in range(len(data_names)):
-            sums.append("%s*%s" % (data_names[i], row[i+1]))
-        s += ' + '.join(sums)
+    N, K = design.shape
+    valid = ~np.isnan(data)
+    full = valid.all(axis=0)
+
+    coefs = np.empty((data.shape[1], K))
+    coefs.fill(FNULL)
+    coefs[full] = np.dot(projection, data[:, full]).T
+
+    partial = ~full & (valid.sum(axis=0) >= K)
+    if partial.any():
+        weights = valid[:, partial].astype(float)
+        values = np.where(valid[:, partial], data[:, partial], 0)
+        xtx = np.einsum('ni,nj,np->pij', design, design, weights)
+        xty = np.einsum('ni,np->pi', design, values)
+        coefs[partial] = np.einsum('pij,pj->pi', np.linalg.pinv(xtx), xty)
+
+    return coefs
+
+
+def _open_outputs(names, overwrite):
+    maps = []
+    for name in names:
+        map = raster.RasterRow(name)
+        map.open('w', mtype='DCELL', overwrite=overwrite)
+        maps.append(map)
+    return maps
+
+
+def _put_rows(maps, values, cols):
+    """Write values (len(maps), rows, cols) to the next rows of maps"""
+    for map, rows in zip(maps, values):
+        for row in rows:
+            buf = Buffer((cols, ), map.mtype)
+            buf[:] = row
+            map.put_row(buf)
+
+
+def decompose_series(xnames, freq, coef_prefix=None, result_prefix=None,
+                     residual_prefix=None, block_rows=64):
+    """Decompose the series by blocks of rows and write the
+    coefficients, fitted series and residuals (when their prefix is given)
+    """
+    N = len(xnames)
+    names, design = design_matrix(N, freq)
+    projection = np.linalg.pinv(design)
+    overwrite = grass.overwrite()
+
+    inputs = [raster.RasterRow(name) for name in xnames]
+    coefs_maps, fitted_maps, resid_maps = [], [], []
+    try:
+        for map in inputs:
+            map.open()
+        if coef_prefix:
+            coefs_maps = _open_outputs([coef_prefix + name for name in names],
+                                       overwrite)
+        if result_prefix:
+            fitted_maps = _open_outputs([result_prefix + name for name in xnames],
+                                        overwrite)
+        if residual_prefix:
+            resid_maps = _open_outputs([residual_prefix + name for name in xnames],
+                                       overwrite)
+
+        reg = Region()
+        rows, cols = reg.rows, reg.cols
+        for start in range(0, rows, block_rows):
+            stop = min(start + block_rows, rows)
+            data = np.array([[get_row_or_null(map, r) for r in range(start, stop)]
+                             for map in inputs]).reshape(N, -1)
+            coefs = decompose(data, design, projection)
+            shape = (-1, stop - start, cols)
+            if coefs_maps:
+                _put_rows(coefs_maps, coefs.T.reshape(shape), cols)
+            if fitted_maps or resid_maps:
+                fitted = np.dot(design, coefs.T)
+                _put_rows(fitted_maps, fitted.reshape(shape), cols)
+                _put_rows(resid_maps, (data - fitted).reshape(shape), cols)
+            grass.percent(stop, rows, 1)
+    finally:
+        for map in inputs + coefs_maps + fitted_maps + resid_maps:
+            if map.is_open():
+                map.close()
 
-        grass.mapcalc(s, overwrite=grass.overwrite(), quite=True)
 
 def main(options, flags):
     xnames = options['input']
     coef_pref = options['coef_prefix']
-    timevar_pref = options['timevar_prefix']
     result_pref = options['result_prefix']
+    resid_pref = options['residual_prefix']
+    block_rows = int(options['block_rows'])
     freq = options['freq']
     freq = [float(f) for f in freq.split(',')]
 
@@ -227,15 +252,8 @@ def main(options, flags):
         grass.error("Count of used harmonics is to large. Reduce the paramether.")
         sys.exit(1)
 
-    const_name, time_names, harm_names = generate_vars(N, freq, timevar_pref)
-
-    settings_name = uuid.uuid4().hex
-    settings = open(settings_name, 'w')
-    _generate_sample_descr(settings, freq, xnames, const_name, time_names, harm_names)
-    settings.close()
-    regression(settings_name, coef_pref)
-    inverse_transform(settings_name, coef_pref, result_pref)
-    os.unlink(settings_name)
+    decompose_series(xnames, freq, coef_pref, result_pref, resid_pref,
+                     block_rows)
 
 if __name__ == "__main__":
     options, flags = grass.parser()
@@ -107,6 +107,22 @@
 #% description: Number of iterations
 #% answer: 1
 #%end
+#%option
+#% key: block_rows
+#% type: integer
+#% required: no
+#% multiple: no
+#% description: Number of rows read and filtered together
+#% answer: 50
+#%end
+#%option
+#% key: nprocs
+#% type: integer
+#% required: no
+#% multiple: no
+#% description: Number of processes filtering blocks of rows in parallel
+#% answer: 1
+#%end
 
 
 
@@ -115,6 +131,7 @@
 
 import os
 import sys
+from multiprocessing import Pool
 
 if "GISBASE" not in os.environ:
     sys.stderr.write("You must be in GRASS GIS to run this program.\n")
@@ -162,84 +179,94 @@ def close_rasters(raster_list):
         if r.is_open():
             r.close()
 
+def _smooth(method, arr, winsize, order):
+    """Apply the filter along the time axis (the first one) of arr"""
+    if method == 'savgol':
+        return savgol_filter(arr, winsize, order, axis=0, mode='nearest')
+    elif method == 'median':
+        return medfilt(arr, kernel_size=(winsize, ) + (1, ) * (arr.ndim - 1))
+    else:
+        grass.fatal('The method is not implemented')
+
+
 def _filter_up(method, arr, winsize, order):
     """Filter array using algorithm from the next article:
         Chen, Jin, et al. "A simple method for reconstructing a high-quality
         NDVI time-series data set based on the Savitzky–Golay filter."
         Remote sensing of Environment 91.3 (2004): 332-344.
-    """
 
-    size = len(arr)
+    arr is a 2d array (time, pixels), all the pixels are filtered together
+    and the iterations stop for each pixel when its optimum is found.
+    """
+    size = arr.shape[1]
 
-    old_f = np.inf     # Filter fitting index for previose iteration
-    cur_f = np.inf     # Filter fitting index for current iteration
-    wk = np.empty(size)     # Weights array
+    old_f = np.full(size, np.inf)     # Filter fitting index for previose iteration
+    cur_f = np.full(size, np.inf)     # Filter fitting index for current iteration
     init_arr = np.copy(arr)
+    old_arr = np.copy(arr)
+    result = np.copy(arr)
+    done = np.zeros(size, dtype=bool)
 
     while winsize > order + 2:  # We don't want fit for too small window size
-        if method == 'savgol':
-            trend = savgol_filter(arr, winsize, order, mode='nearest')
-        elif method == 'median':
-            trend = medfilt(arr, kernel_size=winsize)
-        else:
-            grass.fatal('The method is not implemented')
+        trend = _smooth(method, arr, winsize, order)
 
         # Weights
-        # import ipdb; ipdb.set_trace()
         difference = trend - init_arr
-        max_diff = np.max(difference)
-        for i in range(size):
-            wk[i] = 1.0 if difference[i] <= 0 else 1.0 - difference[i]/max_diff
+        max_diff = np.max(difference, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            wk = np.where(difference <= 0, 1.0, 1.0 - difference / max_diff)
 
         old_arr = np.copy(arr)
-        for i in range(size):
-            arr[i] = arr[i] if difference[i] <= 0 else trend[i]
+        arr = np.where(difference <= 0, arr, trend)
 
         # Fitting index and exit criteria
-        f = np.sum(np.abs(difference) * wk)
-        if old_f > cur_f < f:
-            # The optimm was found on previous iteration
-            # old_arr contains the optimal results
-            return old_arr
+        f = np.sum(np.abs(difference) * wk, axis=0)
+        # The optimum was found on previous iteration,
+        # old_arr contains the optimal results
+        found = ~done & (old_f > cur_f) & (cur_f < f)
+        result[:, found] = old_arr[:, found]
+        done |= found
+        if done.all():
+            return result
 
         old_f = cur_f
         cur_f = f
         winsize -= 2
-    return old_arr
+    result[:, ~done] = old_arr[:, ~done]
+    return result
 
 
 def _filter(method, row_data, winsize, order, itercount, fit_up):
-    result = np.empty(row_data.shape)
-    _, cols = row_data.shape
-    for i in range(cols):
-        arr = row_data[:, i]
-        if not all(np.isnan(arr)):
-            arr = _fill_nulls(arr)
-            if fit_up:
-                arr = _filter_up(method, arr, winsize, order)
-            else:
-                if method == 'savgol':
-                    for j in range(itercount):
-                        arr = savgol_filter(arr, winsize, order, mode='nearest')
-                elif method == 'median':
-                    for j in range(itercount):
-                        arr = medfilt(arr, kernel_size=winsize)
-                else:
-                    grass.fatal('The method is not implemented')
-        result[:, i] = arr
+    """Filter the time series of all the pixels of row_data, an array
+    (time, pixels) or (time, rows, cols)"""
+    shape = row_data.shape
+    data = row_data.reshape(shape[0], -1)
+    result = np.empty(data.shape)
+    valid = ~np.all(np.isnan(data), axis=0)
+    result[:, ~valid] = np.nan
+    arr = _fill_nulls(data[:, valid])
+    if arr.shape[1]:
+        if fit_up:
+            arr = _filter_up(method, arr, winsize, order)
+        else:
+            for j in range(itercount):
+                arr = _smooth(method, arr, winsize, order)
+    result[:, valid] = arr
 
-    return result
+    return result.reshape(shape)
 
 def _non_zero(x):
     return x.nonzero()[0]
 
 def _fill_nulls(arr):
-    """Fill no-data values in arr
+    """Fill no-data values in the columns of the 2d array arr
     Return np.array with filled data
     """
-    nans = np.isnan(arr)
-    if not all(nans):
-        arr[nans] = np.interp(_non_zero(nans), _non_zero(~nans), arr[~nans])
+    for i in _non_zero(np.isnan(arr).any(axis=0)):
+        col = arr[:, i]
+        nans = np.isnan(col)
+        if not all(nans):
+            col[nans] = np.interp(_non_zero(nans), _non_zero(~nans), col[~nans])
 
     return arr
 
@@ -256,7 +283,8 @@ def fitting_quality(input_data, fitted_data, diff_penalty=1.0, deriv_penalty=1.0
     return diff_penalty * difference + deriv_penalty * deriv_diff
 
 
-def optimize_params(method, names, npoints, diff_penalty, deriv_penalty, itercount):
+def optimize_params(method, names, npoints, diff_penalty, deriv_penalty, itercount,
+                    nprocs=1):
     """Perform crossvalidation:
         take 'npoints' random points,
         find winsize and order that minimize the quality function
@@ -292,57 +320,78 @@ def optimize_params(method, names, npoints, diff_penalty, deriv_penalty, itercou
     best_winsize = best_order = None
     if method == 'savgol':
         best_winsize, best_order = _optimize_savgol(input_data, diff_penalty,
-                                                    deriv_penalty, itercount)
+                                                    deriv_penalty, itercount,
+                                                    nprocs)
     elif method == 'median':
         best_winsize = _optimize_median(input_data,
-                                        diff_penalty, deriv_penalty, itercount)
+                                        diff_penalty, deriv_penalty, itercount,
+                                        nprocs)
     else:
         grass.fatal('The method is not implemented')
 
     return best_winsize, best_order
 
 
-def _optimize_savgol(input_data, diff_penalty, deriv_penalty, itercount):
+def _penalty(params):
+    """Penalty of the filter with the given parameters on the sample data"""
+    method, input_data, winsize, order, itercount, diff_penalty, deriv_penalty = params
+    test_data = _filter(method, np.copy(input_data), winsize, order, itercount, False)
+    return fitting_quality(input_data, test_data, diff_penalty, deriv_penalty)
+
+
+def _optimize(method, input_data, combinations, diff_penalty, deriv_penalty,
+              itercount, nprocs):
+    """Return the (winsize, order) combination with the smallest penalty,
+    the combinations are tested in parallel"""
+    params = [(method, input_data, winsize, order, itercount,
+               diff_penalty, deriv_penalty) for winsize, order in combinations]
+    pool = Pool(nprocs)
+    try:
+        penalties = pool.map(_penalty, params)
+    finally:
+        pool.close()
+        pool.join()
+    penalties = np.array(penalties, dtype=float)
+    penalties[np.isnan(penalties)] = np.inf
+    if not len(penalties) or not np.isfinite(penalties.min()):
+        return None, None
+    return combinations[int(np.argmin(penalties))]
+
+
+def _optimize_savgol(input_data, diff_penalty, deriv_penalty, itercount, nprocs=1):
     """Find optimal params for savgol_filter.
 
     Returns winsize and order
     """
     map_count, npoints = input_data.shape
-    best = np.inf
-    best_winsize = best_order = None
-    for winsize in range(5, map_count/2, 2):
-        for order in range(2, min(winsize - 2, 10)):    # 10 is a 'magic' number: we don't want very hight polynomyal fitting usually
-            test_data = np.copy(input_data)
-            test_data = _filter('savgol', test_data, winsize, order, itercount, False)
-            penalty = fitting_quality(input_data, test_data,
-                                      diff_penalty, deriv_penalty)
-            if penalty < best:
-                best = penalty
-                best_winsize, best_order = winsize, order
+    # 10 is a 'magic' number: we don't want very hight polynomyal fitting usually
+    combinations = [(winsize, order) for winsize in range(5, map_count // 2, 2)
+                    for order in range(2, min(winsize - 2, 10))]
+    return _optimize('savgol', input_data, combinations, diff_penalty,
+                     deriv_penalty, itercount, nprocs)
 
-    return best_winsize, best_order
 
-def _optimize_median(input_data, diff_penalty, deriv_penalty, itercount):
+def _optimize_median(input_data, diff_penalty, deriv_penalty, itercount, nprocs=1):
     """Find optimal params for median filter.
 
     Returns winsize
     """
     map_count, npoints = input_data.shape
-    best = np.inf
-    best_winsize = order = None
-    for winsize in range(3, map_count/2, 2):
-        test_data = np.copy(input_data)
-        test_data = _filter('median', test_data, winsize, order, itercount, False)
-        penalty = fitting_quality(input_data, test_data,
-                                  diff_penalty, deriv_penalty)
-        if penalty < best:
-            best = penalty
-            best_winsize = winsize
+    combinations = [(winsize, None) for winsize in range(3, map_count // 2, 2)]
+    return _optimize('median', input_data, combinations, diff_penalty,
+                     deriv_penalty, itercount, nprocs)[0]
 
-    return best_winsize
 
+def _filter_block(params):
+    """Filter a block (time, rows, cols) in a worker process"""
+    method, block, winsize, order, itercount, fit_up = params
+    return _filter(method, block, winsize, order, itercount, fit_up)
 
-def filter(method, names, winsize, order, prefix, itercount, fit_up):
+
+def filter(method, names, winsize, order, prefix, itercount, fit_up,
+           block_rows=1, nprocs=1):
+    """Filter the series by blocks of block_rows rows, the blocks are read
+    and written in order by this process and filtered by nprocs processes"""
 
     current_mapset = grass.read_command('g.mapset', flags='p')
     current_mapset = current_mapset.strip()
@@ -350,21 +399,37 @@ def filter(method, names, winsize, order, prefix, itercount, fit_up):
     inputs = init_rasters(names)
     output_names = [prefix + name for name in names]
     outputs = init_rasters(output_names, mapset=current_mapset)
+    pool = Pool(nprocs)
     try:
         open_rasters(outputs, write=True)
         open_rasters(inputs)
 
         reg = Region()
-        for i in range(reg.rows):
-            # import ipdb; ipdb.set_trace()
-            row_data = np.array([_get_row_or_nan(r, i) for r in inputs])
-            filtered_rows = _filter(method, row_data, winsize, order, itercount, fit_up)
+        starts = list(range(0, reg.rows, block_rows))
+        # keep all the processes busy while the blocks are written in order
+        pending = []
+        for start in starts + [None] * (2 * nprocs):
+            if start is not None:
+                stop = min(start + block_rows, reg.rows)
+                block = np.array([[_get_row_or_nan(r, i) for i in range(start, stop)]
+                                  for r in inputs])
+                pending.append((start, pool.apply_async(
+                    _filter_block,
+                    ((method, block, winsize, order, itercount, fit_up), ))))
+            if not pending or (start is not None and len(pending) < 2 * nprocs):
+                continue
+            first, result = pending.pop(0)
+            filtered = result.get()
             for map_num in range(len(outputs)):
                 map = outputs[map_num]
-                row = filtered_rows[map_num, :]
-                buf = Buffer(row.shape, map.mtype, row)
-                map.put_row(i, buf)
+                for j in range(filtered.shape[1]):
+                    row = filtered[map_num, j, :]
+                    buf = Buffer(row.shape, map.mtype, row)
+                    map.put_row(first + j, buf)
+            grass.percent(first + filtered.shape[1], reg.rows, 1)
     finally:
+        pool.close()
+        pool.join()
         close_rasters(outputs)
         close_rasters(inputs)
 
@@ -420,6 +485,9 @@ def main(options, flags):
 
     res_prefix = options['result_prefix']
 
+    block_rows = int(options['block_rows'])
+    nprocs = int(options['nprocs'])
+
     N = len(xnames)
     if N < winsize:
         grass.fatal("The used running window size is to big. Decrease the paramether or add more rasters to the series.")
@@ -433,11 +501,13 @@ def main(options, flags):
 
     if optimize:
         winsize, order = optimize_params(method, xnames, opt_points,
-                                         diff_penalty, deriv_penalty, itercount)
+                                         diff_penalty, deriv_penalty, itercount,
+                                         nprocs)
         if winsize is None:
             grass.fatal("Optimization procedure doesn't convergence.")
 
-    filter(method, xnames, winsize, order, res_prefix, itercount, fit_up)
+    filter(method, xnames, winsize, order, res_prefix, itercount, fit_up,
+           block_rows, nprocs)
 
 if __name__ == "__main__":
     options, flags = grass.parser()
@@ -118,7 +118,8 @@
 #% key_desc: stepsize
 #% type: string
 #% gisprompt: old,cell,raster
-#% description: Angle step size for multidirectional horizon [degrees]
+#% label: Angle step size for multidirectional horizon [degrees]
+#% description: Without horizon_basename the horizon maps are computed once and cached in the current mapset
 #% required : no
 #%end
 
@@ -248,11 +249,25 @@
 #%end
 
 import os
+import sys
+import time
 import atexit
-from multiprocessing import Process
+from multiprocessing import Pool
 
 import grass.script as grass
 import grass.script.core as core
+from grass.exceptions import CalledModuleError
+from grass.pygrass.utils import get_lib_path
+
+# rsun_horizon is next to the script in the source tree and in the etc
+# directory of the module once installed
+LIBPATH = os.path.dirname(os.path.abspath(__file__))
+if not os.path.exists(os.path.join(LIBPATH, 'rsun_horizon.py')):
+    LIBPATH = get_lib_path('r.sun.daily')
+if LIBPATH is None:
+    raise ImportError("Not able to find the rsun_horizon module of r.sun.daily")
+sys.path.insert(0, LIBPATH)
+from rsun_horizon import horizon_cache
 
 
 REMOVE = []
@@ -328,6 +343,20 @@ def run_r_sun(elevation, aspect, slope, latitude, longitude,
                       **params)
 
 
+def run_r_sun_job(kwargs):
+    """
+    Run r.sun in a worker of the pool, return the suffix of the computed
+    maps, the time spent and whether the computation succeeded
+    """
+    suffix = kwargs['suffix']
+    start = time.time()
+    try:
+        run_r_sun(**kwargs)
+    except (KeyboardInterrupt, CalledModuleError):
+        return suffix, time.time() - start, False
+    return suffix, time.time() - start, True
+
+
 def set_color_table(rasters):
     """
     Set 'gyr' color tables for raster maps
@@ -364,13 +393,25 @@ def check_daily_map_names(basename, mapset, start_day, end_day, day_step):
                           ''.format(name=map_)))
 
 
-def sum_maps(sum_, basename, suffixes):
+def add_maps(sum_, basename, suffixes):
     """
-    Sum up multiple raster maps
+    Add raster maps to a cumulative sum, the sum is created if it does
+    not exist yet
     """
     maps = '+'.join([basename + suf for suf in suffixes])
-    grass.mapcalc('{sum_} = {new}'.format(sum_=sum_, new=maps),
+    if not grass.find_file(sum_, element='cell',
+                           mapset=grass.gisenv()['MAPSET'])['file']:
+        grass.mapcalc('{sum_} = {new}'.format(sum_=sum_, new=maps),
+                      overwrite=True, quiet=True)
+        return
+    tmp = create_tmp_map_name('sum')
+    if tmp not in REMOVE:
+        REMOVE.append(tmp)
+    grass.mapcalc('{tmp} = {sum_} + {new}'.format(tmp=tmp, sum_=sum_,
+                                                  new=maps),
                   overwrite=True, quiet=True)
+    grass.run_command('g.rename', raster=[tmp, sum_], overwrite=True,
+                      quiet=True)
 
 
 def main():
@@ -425,6 +466,11 @@ def main():
 
     nprocs = int(options['nprocs'])
 
+    # the terrain shadowing is computed once for all the days
+    if horizon_step and not horizon_basename:
+        horizon_basename = horizon_cache(elevation_input, horizon_step,
+                                         nprocs)
+
     if beam_rad and not beam_rad_basename:
         beam_rad_basename = create_tmp_map_name('beam_rad')
         MREMOVE.append(beam_rad_basename)
@@ -465,14 +511,12 @@ def main():
         grass.run_command('r.slope.aspect', elevation=elevation_input,
                           quiet=True, **params)
 
-    if beam_rad:
-        grass.mapcalc('{beam} = 0'.format(beam=beam_rad), quiet=True)
-    if diff_rad:
-        grass.mapcalc('{diff} = 0'.format(diff=diff_rad), quiet=True)
-    if refl_rad:
-        grass.mapcalc('{refl} = 0'.format(refl=refl_rad), quiet=True)
-    if glob_rad:
-        grass.mapcalc('{glob} = 0'.format(glob=glob_rad), quiet=True)
+    # the sums are created from the first computed map
+    for sum_ in (beam_rad, diff_rad, refl_rad, glob_rad):
+        if sum_ and grass.find_file(sum_, element='cell',
+                                    mapset=grass.gisenv()['MAPSET'])['file']:
+            grass.run_command('g.remove', type='raster', name=sum_,
+                              flags='f', quiet=True)
 
     rsun_flags = ''
     if flags['m']:
@@ -481,59 +525,55 @@ def main():
         rsun_flags += 'p'
 
     grass.info(_("Running r.sun in a loop..."))
-    count = 0
-    # Parallel processing
-    proc_list = []
-    proc_count = 0
-    suffixes_all = []
     days = range(start_day, end_day + 1, day_step)
     num_days = len(days)
+    suffixes_all = ['_' + format_order(day) for day in days]
+    jobs = [dict(elevation=elevation_input, aspect=aspect_input,
+                 slope=slope_input, latitude=latitude, longitude=longitude,
+                 linke=linke_input, linke_value=linke_value,
+                 albedo=albedo_input, albedo_value=albedo_value,
+                 horizon_basename=horizon_basename, horizon_step=horizon_step,
+                 day=day, step=step,
+                 beam_rad=beam_rad_basename, diff_rad=diff_rad_basename,
+                 refl_rad=refl_rad_basename, glob_rad=glob_rad_basename,
+                 suffix=suffix, flags=rsun_flags)
+            for day, suffix in zip(days, suffixes_all)]
+
+    # Parallel processing: a new day is started as soon as a worker is
+    # free and each computed day is added to the cumulative maps while the
+    # other days are computed
+    count = 0
+    timings = []
+    start = time.time()
     core.percent(0, num_days, 1)
-    for day in days:
-        count += 1
-        core.percent(count, num_days, 10)
-
-        suffix = '_' + format_order(day)
-        proc_list.append(Process(target=run_r_sun,
-                                 args=(elevation_input,
-                                       aspect_input, slope_input,
-                                       latitude, longitude,
-                                       linke_input, linke_value,
-                                       albedo_input, albedo_value,
-                                       horizon_basename, horizon_step,
-                                       day, step,
-                                       beam_rad_basename,
-                                       diff_rad_basename,
-                                       refl_rad_basename,
-                                       glob_rad_basename,
-                                       suffix, rsun_flags)))
-
-        proc_list[proc_count].start()
-        proc_count += 1
-        suffixes_all.append(suffix)
-
-        if proc_count == nprocs or proc_count == num_days or count == num_days:
-            proc_count = 0
-            exitcodes = 0
-            for proc in proc_list:
-                proc.join()
-                exitcodes += proc.exitcode
-
-            if exitcodes != 0:
+    pool = Pool(nprocs)
+    try:
+        for suffix, elapsed, success in pool.imap_unordered(run_r_sun_job,
+                                                            jobs):
+            if not success:
+                pool.terminate()
                 core.fatal(_("Error while r.sun computation"))
-
-            # Empty process list
-            proc_list = []
-
-    if beam_rad:
-        sum_maps(beam_rad, beam_rad_basename, suffixes_all)
-    if diff_rad:
-        sum_maps(diff_rad, diff_rad_basename, suffixes_all)
-    if refl_rad:
-        sum_maps(refl_rad, refl_rad_basename, suffixes_all)
-    if glob_rad:
-        sum_maps(glob_rad, glob_rad_basename, suffixes_all)
-
+            count += 1
+            timings.append(elapsed)
+            core.verbose(_("r.sun for day {day} computed in {sec:.1f} s"
+                           "").format(day=suffix[1:], sec=elapsed))
+            if beam_rad:
+                add_maps(beam_rad, beam_rad_basename, [suffix])
+            if diff_rad:
+                add_maps(diff_rad, diff_rad_basename, [suffix])
+            if refl_rad:
+                add_maps(refl_rad, refl_rad_basename, [suffix])
+            if glob_rad:
+                add_maps(glob_rad, glob_rad_basename, [suffix])
+            core.percent(count, num_days, 10)
+    finally:
+        pool.close()
+        pool.join()
+    core.info(_("r.sun computed {n} days in {total:.1f} s (per day: mean "
+                "{mean:.1f} s, min {min:.1f} s, max {max:.1f} s)"
+                "").format(n=count, total=time.time() - start,
+                           mean=sum(timings) / len(timings),
+                           min=min(timings), max=max(timings)))
 
     # FIXME: how percent really works?
     # core.percent(1, 1, 1)
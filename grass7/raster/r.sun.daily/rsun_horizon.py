@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of the horizon maps shared by r.sun.daily and r.sun.hourly
+
+(C) 2018 by the GRASS Development Team
+This program is free software under the GNU General Public
+License (>=v2). Read the file COPYING that comes with GRASS
+for details.
+"""
+
+import os
+import math
+import hashlib
+from multiprocessing import Pool
+
+import grass.script as grass
+import grass.script.core as core
+from grass.exceptions import CalledModuleError
+
+
+def run_r_horizon(args):
+    """
+    Compute the horizon maps for a range of directions
+    """
+    elevation, step, start, end, basename = args
+    try:
+        grass.run_command('r.horizon', elevation=elevation, step=step,
+                          start=start, end=end, output=basename, quiet=True)
+    except (KeyboardInterrupt, CalledModuleError):
+        return False
+    return True
+
+
+def remove_horizons(basename):
+    """
+    Remove the horizon maps with the given basename from the current mapset
+    """
+    grass.run_command('g.remove', type='raster', pattern=basename + '_*',
+                      flags='f', quiet=True)
+
+
+def horizon_cache(elevation, step, nprocs=1):
+    """
+    Return the basename of the horizon maps of the elevation map for the
+    current region, the maps are computed with r.horizon only if they are
+    not already in the current mapset.
+
+    The basename is derived from the elevation map, its modification time,
+    the region and the angle step, so the maps are computed again as soon
+    as any of them changes and are shared by r.sun.daily and r.sun.hourly.
+    """
+    elev = grass.find_file(elevation, element='cell')
+    if not elev['file']:
+        grass.fatal(_("Raster map <{name}> not found").format(name=elevation))
+    step = float(step)
+    region = grass.region()
+    key = '|'.join([elev['fullname'], repr(os.path.getmtime(elev['file'])),
+                    repr(step)] +
+                   ['{k}={v}'.format(k=k, v=region[k])
+                    for k in ('n', 's', 'e', 'w', 'nsres', 'ewres')])
+    basename = 'rsun_horizon_' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:10]
+    directions = int(math.ceil(360. / step))
+    mapset = grass.gisenv()['MAPSET']
+    cached = grass.list_strings('raster', pattern=basename + '_*',
+                                mapset=mapset)
+    if len(cached) >= directions:
+        core.verbose(_("Using cached horizon maps <{name}>").format(name=basename))
+        return basename
+    if cached:
+        # maps left by a run killed during the computation
+        remove_horizons(basename)
+
+    grass.info(_("Computing horizon maps <{name}>...").format(name=basename))
+    # split the directions among the processes
+    chunk = int(math.ceil(directions / float(nprocs)))
+    jobs = [(elevation, step, i * step, min((i + chunk) * step, 360.),
+             basename) for i in range(0, directions, chunk)]
+    complete = False
+    pool = Pool(nprocs)
+    try:
+        complete = all(pool.map(run_r_horizon, jobs))
+    finally:
+        pool.close()
+        pool.join()
+        if not complete:
+            remove_horizons(basename)
+    if not complete:
+        grass.fatal(_("Error while r.horizon computation"))
+    return basename
@@ -168,6 +168,25 @@
 #% answer: 1.0
 #%end
 #%option
+#% key: horizon_basename
+#% key_desc: basename
+#% type: string
+#% gisprompt: old,cell,raster
+#% description: The horizon information input map basename
+#% required : no
+#%end
+#%option
+#% key: horizon_step
+#% key_desc: stepsize
+#% type: double
+#% label: Angle step size for multidirectional horizon [degrees]
+#% description: Without horizon_basename the horizon maps are computed once and cached in the current mapset
+#% required : no
+#%end
+#%rules
+#% requires_all: horizon_basename, horizon_step
+#%end
+#%option
 #% key: beam_rad_basename
 #% type: string
 #% label: Base name for output beam irradiance [W.m-2] (mode 1) or irradiation raster map [Wh.m-2] (mode 2)
@@ -247,13 +266,26 @@
 #%end
 
 import os
+import sys
+import time as timer
 import datetime
 import atexit
-from multiprocessing import Process
+from multiprocessing import Pool
 
 import grass.script as grass
 import grass.script.core as core
 from grass.exceptions import CalledModuleError
+from grass.pygrass.utils import get_lib_path
+
+# rsun_horizon is next to the script in the source tree and in the etc
+# directory of the module once installed
+LIBPATH = os.path.dirname(os.path.abspath(__file__))
+if not os.path.exists(os.path.join(LIBPATH, 'rsun_horizon.py')):
+    LIBPATH = get_lib_path('r.sun.hourly')
+if LIBPATH is None:
+    raise ImportError("Not able to find the rsun_horizon module of r.sun.hourly")
+sys.path.insert(0, LIBPATH)
+from rsun_horizon import horizon_cache
 
 REMOVE = []
 MREMOVE = []
@@ -288,7 +320,8 @@ def run_r_sun(elevation, aspect, slope, day, time, civil_time,
               linke, linke_value, albedo, albedo_value,
               coeff_bh, coeff_dh, lat, long_,
               beam_rad, diff_rad, refl_rad, glob_rad,
-              incidout, suffix, binary, tmpName, time_step, distance_step, flags):
+              incidout, suffix, binary, tmpName, time_step, distance_step,
+              horizon_basename, horizon_step, flags):
     params = {}
     if linke:
         params.update({'linke': linke})
@@ -322,6 +355,9 @@ def run_r_sun(elevation, aspect, slope, day, time, civil_time,
         params.update({'civil_time': civil_time})
     if distance_step is not None:
         params.update({'distance_step': distance_step})
+    if horizon_basename and horizon_step:
+        params.update({'horizon_basename': horizon_basename})
+        params.update({'horizon_step': horizon_step})
 
     if is_grass_7():
         grass.run_command('r.sun', elevation=elevation, aspect=aspect,
@@ -354,6 +390,18 @@ def run_r_sun(elevation, aspect, slope, day, time, civil_time,
                                                   output + suffix], overwrite=True, quiet=True)
 
 
+def run_r_sun_job(kwargs):
+    """Run r.sun in a worker of the pool, return the suffix of the computed
+    maps, the time spent and whether the computation succeeded"""
+    suffix = kwargs['suffix']
+    start = timer.time()
+    try:
+        run_r_sun(**kwargs)
+    except (KeyboardInterrupt, CalledModuleError):
+        return suffix, timer.time() - start, False
+    return suffix, timer.time() - start, True
+
+
 def set_color_table(rasters, binary=False):
     table = 'gyr'
     if binary:
@@ -424,13 +472,25 @@ def format_grass_time(dt):
                                             dt.second)
 
 
-def sum_maps(sum_, basename, suffixes):
+def add_maps(sum_, basename, suffixes):
     """
-    Sum up multiple raster maps
+    Add raster maps to a cumulative sum, the sum is created if it does
+    not exist yet
     """
     maps = '+'.join([basename + suf for suf in suffixes])
-    grass.mapcalc('{sum_} = {new}'.format(sum_=sum_, new=maps),
+    if not grass.find_file(sum_, element='cell',
+                           mapset=grass.gisenv()['MAPSET'])['file']:
+        grass.mapcalc('{sum_} = {new}'.format(sum_=sum_, new=maps),
+                      overwrite=True, quiet=True)
+        return
+    tmp = create_tmp_map_name('sum')
+    if tmp not in REMOVE:
+        REMOVE.append(tmp)
+    grass.mapcalc('{tmp} = {sum_} + {new}'.format(tmp=tmp, sum_=sum_,
+                                                  new=maps),
                   overwrite=True, quiet=True)
+    grass.run_command('g.rename', raster=[tmp, sum_], overwrite=True,
+                      quiet=True)
 
 
 def get_raster_from_strds(year, day, time, strds):
@@ -487,6 +547,8 @@ def main():
     end_time = float(options['end_time'])
     time_step = float(options['time_step'])
     nprocs = int(options['nprocs'])
+    horizon_basename = options['horizon_basename']
+    horizon_step = options['horizon_step']
     day = int(options['day'])
     civil_time = float(options['civil_time']) if options['civil_time'] else None
     distance_step = float(options['distance_step']) if options['distance_step'] else None
@@ -564,79 +626,96 @@ def main():
         grass.run_command('r.slope.aspect', elevation=elevation_input,
                           quiet=True, **params)
 
+    # the terrain shadowing is computed once for all the time steps
+    if horizon_step and not horizon_basename:
+        horizon_basename = horizon_cache(elevation_input, horizon_step,
+                                         nprocs)
+
     grass.info(_("Running r.sun in a loop..."))
-    count = 0
-    # Parallel processing
-    proc_list = []
-    proc_count = 0
-    suffixes = []
-    suffixes_all = []
     if mode1:
         times = list(frange1(start_time, end_time, time_step))
     else:
         times = list(frange2(start_time, end_time, time_step))
     num_times = len(times)
-    core.percent(0, num_times, 1)
-    for time in times:
-        count += 1
-        core.percent(count, num_times, 10)
-
+    suffixes_all = ['_' + format_time(time) for time in times]
+    jobs = []
+    for time, suffix in zip(times, suffixes_all):
         coeff_bh_raster = coeff_bh
         if coeff_bh_strds:
             coeff_bh_raster = get_raster_from_strds(year, day, time, strds=coeff_bh_strds)
         coeff_dh_raster = coeff_dh
         if coeff_dh_strds:
             coeff_dh_raster = get_raster_from_strds(year, day, time, strds=coeff_dh_strds)
-
-        suffix = '_' + format_time(time)
-        proc_list.append(Process(target=run_r_sun,
-                                 args=(elevation_input, aspect_input,
-                                       slope_input, day, time, civil_time,
-                                       linke, linke_value,
-                                       albedo, albedo_value,
-                                       coeff_bh_raster, coeff_dh_raster,
-                                       lat, long_,
-                                       beam_rad_basename,
-                                       diff_rad_basename,
-                                       refl_rad_basename,
-                                       glob_rad_basename,
-                                       incidout_basename,
-                                       suffix,
-                                       binary, tmpName,
-                                       None if mode1 else time_step,
-                                       distance_step,
-                                       rsun_flags)))
-
-        proc_list[proc_count].start()
-        proc_count += 1
-        suffixes.append(suffix)
-        suffixes_all.append(suffix)
-
-        if proc_count == nprocs or proc_count == num_times or count == num_times:
-            proc_count = 0
-            exitcodes = 0
-            for proc in proc_list:
-                proc.join()
-                exitcodes += proc.exitcode
-
-            if exitcodes != 0:
+        jobs.append(dict(elevation=elevation_input, aspect=aspect_input,
+                         slope=slope_input, day=day, time=time,
+                         civil_time=civil_time,
+                         linke=linke, linke_value=linke_value,
+                         albedo=albedo, albedo_value=albedo_value,
+                         coeff_bh=coeff_bh_raster, coeff_dh=coeff_dh_raster,
+                         lat=lat, long_=long_,
+                         beam_rad=beam_rad_basename,
+                         diff_rad=diff_rad_basename,
+                         refl_rad=refl_rad_basename,
+                         glob_rad=glob_rad_basename,
+                         incidout=incidout_basename,
+                         suffix=suffix,
+                         binary=binary, tmpName=tmpName,
+                         time_step=None if mode1 else time_step,
+                         distance_step=distance_step,
+                         horizon_basename=horizon_basename,
+                         horizon_step=horizon_step,
+                         flags=rsun_flags))
+
+    # the sums are created from the first computed map
+    for sum_ in (beam_rad, diff_rad, refl_rad, glob_rad):
+        if sum_ and grass.find_file(sum_, element='cell',
+                                    mapset=grass.gisenv()['MAPSET'])['file']:
+            grass.run_command('g.remove', type='raster', name=sum_,
+                              flags='f', quiet=True)
+
+    # Parallel processing: a new time step is started as soon as a worker
+    # is free and each computed time step is added to the sums while the
+    # other time steps are computed
+    count = 0
+    timings = []
+    start = timer.time()
+    core.percent(0, num_times, 1)
+    pool = Pool(nprocs)
+    try:
+        for suffix, elapsed, success in pool.imap_unordered(run_r_sun_job,
+                                                            jobs):
+            if not success:
+                pool.terminate()
                 core.fatal(_("Error while r.sun computation"))
-
-            # Empty process list
-            proc_list = []
-            suffixes = []
+            count += 1
+            timings.append(elapsed)
+            core.verbose(_("r.sun for time {t} computed in {sec:.1f} s"
+                           "").format(t=suffix[1:], sec=elapsed))
+            if beam_rad:
+                add_maps(beam_rad, beam_rad_basename, [suffix])
+            if diff_rad:
+                add_maps(diff_rad, diff_rad_basename, [suffix])
+            if refl_rad:
+                add_maps(refl_rad, refl_rad_basename, [suffix])
+            if glob_rad:
+                add_maps(glob_rad, glob_rad_basename, [suffix])
+            core.percent(count, num_times, 10)
+    finally:
+        pool.close()
+        pool.join()
+    core.info(_("r.sun computed {n} time steps in {total:.1f} s (per step: "
+                "mean {mean:.1f} s, min {min:.1f} s, max {max:.1f} s)"
+                "").format(n=count, total=timer.time() - start,
+                           mean=sum(timings) / len(timings),
+                           min=min(timings), max=max(timings)))
 
     if beam_rad:
-        sum_maps(beam_rad, beam_rad_basename, suffixes_all)
         set_color_table([beam_rad])
     if diff_rad:
-        sum_maps(diff_rad, diff_rad_basename, suffixes_all)
         set_color_table([diff_rad])
     if refl_rad:
-        sum_maps(refl_rad, refl_rad_basename, suffixes_all)
         set_color_table([refl_rad])
     if glob_rad:
-        sum_maps(glob_rad, glob_rad_basename, suffixes_all)
         set_color_table([glob_rad])
 
     if not any([beam_rad_basename_user, diff_rad_basename_user,
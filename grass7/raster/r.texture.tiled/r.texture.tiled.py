@@ -32,9 +32,9 @@
 #%option
 #% key: method
 #% type: string
-#% description: Texture method to apply
-#% required: yes
-#% multiple: no
+#% description: Texture method(s) to apply, all computed with a single read of each tile
+#% required: no
+#% multiple: yes
 #% options: asm,contrast,corr,var,idm,sa,sv,se,entr,dv,de,moc1,moc2
 #%end
 #
@@ -85,43 +85,72 @@
 #% description: Mapset prefix
 #% required: no
 #%end
+#
+#%flag
+#% key: a
+#% description: Calculate all textures
+#%end
+#
+#%rules
+#% required: method,-a
+#%end
 
 
-import math
 import grass.script as gscript
 from grass.pygrass.modules.grid.grid import *
 
+METHODS = {'asm' : 'ASM',
+           'contrast' : 'Contr',
+           'corr' : 'Corr',
+           'var' : 'Var',
+           'idm' : 'IDM',
+           'sa' : 'SA',
+           'sv' : 'SV',
+           'se' : 'SE',
+           'entr' : 'Entr',
+           'dv' : 'DV',
+           'de' : 'DE',
+           'moc1' : 'MOC-1',
+           'moc2' : 'MOC-2'}
+
+
 class MyGridModule(GridModule):
     """inherit GridModule, but handle the specific output naming of r.texture"""
 
     def patch(self):
-        """Patch the final results."""
+        """Patch the final results, one map for each texture measure
+        computed by r.texture on the tiles."""
         bboxes = split_region_tiles(width=self.width, height=self.height)
         loc = Location()
-        methods_dic = {'asm' : 'ASM',
-                       'contrast' : 'Contr',
-                       'corr' : 'Corr',
-                       'var' : 'Var',
-                       'idm' : 'IDM',
-                       'sa' : 'SA',
-                       'sv' : 'SV',
-                       'se' : 'SE',
-                       'entr' : 'Entr',
-                       'dv' : 'DV',
-                       'de' : 'DE',
-                       'moc1' : 'MOC-1',
-                       'moc2' : 'MOC-2'}
         mset = loc[self.mset.name]
         mset.visible.extend(loc.mapsets())
-        method = self.module.inputs['method'].value[0]
+        if self.module.flags.a:
+            methods = sorted(METHODS)
+        else:
+            methods = self.module.inputs['method'].value
         for otmap in self.module.outputs:
             otm = self.module.outputs[otmap]
             if otm.typedesc == 'raster' and otm.value:
-                otm.value = '%s_%s' % (otm.value, methods_dic[method])
-                rpatch_map(otm.value,
-                           self.mset.name, self.msetstr, bboxes,
-                           self.module.flags.overwrite,
-                           self.start_row, self.start_col, self.out_prefix)
+                prefix = otm.value
+                for method in methods:
+                    otm.value = '%s_%s' % (prefix, METHODS[method])
+                    rpatch_map(otm.value,
+                               self.mset.name, self.msetstr, bboxes,
+                               self.module.flags.overwrite,
+                               self.start_row, self.start_col,
+                               self.out_prefix)
+                otm.value = prefix
+
+
+def window_overlap(size):
+    """Return the number of cells of overlap needed by a moving window
+
+    >>> window_overlap(3)
+    1
+    >>> window_overlap(7)
+    3
+    """
+    return (size - 1) // 2
 
 
 def main():
@@ -130,10 +159,10 @@ def main():
     outputprefix = options['output']
     windowsize = int(options['size'])
     distance = int(options['distance'])
-    texture_method = options['method']
+    texture_method = options['method'].split(',') if options['method'] else []
     width = int(options['tile_width'])
     height = int(options['tile_height'])
-    overlap = math.ceil(windowsize/2.0)
+    overlap = window_overlap(windowsize)
     processes = int(options['processes'])
     mapset_prefix = None
     if options['mapset_prefix']:
@@ -144,9 +173,10 @@ def main():
               'output' : outputprefix,
               'size' : windowsize,
               'distance' : distance,
-              'method' : texture_method,
-              'flags' : 'n',
+              'flags' : 'na' if flags['a'] else 'n',
               'quiet' : True}
+    if texture_method:
+        kwargs['method'] = texture_method
 
     grd = MyGridModule('r.texture',
                        width=width,
@@ -85,6 +85,15 @@
 #% description: Patch the tiles
 #%end
 #%option
+#% key: nprocs
+#% type: integer
+#% required: no
+#% answer: 1
+#% multiple: no
+#% description: Number of tiles to vectorize in parallel
+#% guisection: Tiling
+#%end
+#%option
 #% key: x
 #% type: integer
 #% required: no
@@ -103,9 +112,143 @@
 #% guisection: Tiling
 #%end
 
+import os
 import sys
+import shutil
+import atexit
+from multiprocessing import Pool
 
 import grass.script as grass
+from grass.exceptions import CalledModuleError
+
+TMP_MAPSETS = []
+
+
+def cleanup():
+    for path in TMP_MAPSETS:
+        shutil.rmtree(path, ignore_errors = True)
+
+
+def tile_env(mapset):
+    """Create a temporary mapset and return an environment using it as
+    current mapset"""
+    genv = grass.gisenv()
+    location = os.path.join(genv['GISDBASE'], genv['LOCATION_NAME'])
+    path = os.path.join(location, mapset)
+    if not os.path.exists(path):
+        os.mkdir(path)
+    shutil.copy(os.path.join(location, 'PERMANENT', 'DEFAULT_WIND'),
+                os.path.join(path, 'WIND'))
+    gisrc = os.path.join(path, 'GISRC')
+    with open(gisrc, 'w') as f:
+        f.write('GISDBASE: %s\n' % genv['GISDBASE'])
+        f.write('LOCATION_NAME: %s\n' % genv['LOCATION_NAME'])
+        f.write('MAPSET: %s\n' % mapset)
+        f.write('GUI: text\n')
+    env = os.environ.copy()
+    env['GISRC'] = gisrc
+    return env
+
+
+def vectorize_tile(params):
+    """Vectorize a tile in its own temporary mapset, return the name of the
+    vector map or None if the tile is empty"""
+    (mapset, outname, input, ftype, column, rtvflags, region, clip) = params
+    env = tile_env(mapset)
+    env['GRASS_REGION'] = grass.region_env(**region)
+    tilename = outname
+    if clip:
+        tilename = outname.replace('_tile_', '_stile_')
+
+    grass.run_command('r.to.vect', input = input, output = tilename,
+                      type = ftype, column = column, flags = rtvflags,
+                      quiet = True, env = env)
+    if not clip:
+        return outname
+
+    topo = grass.parse_command('v.info', flags = 't', map = tilename,
+                               env = env)
+    if int(topo['areas']) == 0:
+        return None
+    cenv = env.copy()
+    cenv['GRASS_REGION'] = grass.region_env(**clip)
+    extname = 'extent_' + outname
+    grass.run_command('v.in.region', output = extname, flags = 'd',
+                      quiet = True, env = cenv)
+    grass.run_command('v.overlay', ainput = tilename, binput = extname,
+                      output = outname, operator = 'and', olayer = '0,1,0',
+                      quiet = True, env = cenv)
+    return outname
+
+
+def stitch(output, input, column, rtvflags, datatype):
+    """Merge the boundaries split by the tile seams and dissolve the areas
+    split by the seams, so that the result matches a single r.to.vect run"""
+    tmp = output + '_stitch'
+    grass.run_command('g.rename', vector = (output, tmp), quiet = True)
+    # the boundaries along the seams are duplicated, one for each tile
+    grass.run_command('v.clean', input = tmp, output = output + '_clean',
+                      tool = 'break,rmdupl', flags = 'c', quiet = True)
+    grass.run_command('g.remove', flags = 'f', type = 'vector', name = tmp,
+                      quiet = True)
+    tmp = output + '_clean'
+    if 'v' not in rtvflags:
+        # areas must share the same category to be dissolved, use a
+        # category for each raster value
+        grass.run_command('v.category', input = tmp, output = output + '_del',
+                          option = 'del', cat = -1, quiet = True)
+        grass.run_command('g.remove', flags = 'f', type = 'vector', name = tmp,
+                          quiet = True)
+        tmp = output + '_del'
+        grass.run_command('v.category', input = tmp, output = output + '_add',
+                          option = 'add', type = 'centroid', quiet = True)
+        grass.run_command('g.remove', flags = 'f', type = 'vector', name = tmp,
+                          quiet = True)
+        tmp = output + '_add'
+        ctype = 'integer' if datatype == 'CELL' else 'double precision'
+        grass.run_command('v.db.addtable', map = tmp,
+                          columns = 'tmp_value %s,tmp_label varchar(64)' % ctype,
+                          quiet = True)
+        grass.run_command('v.what.rast', map = tmp, raster = input,
+                          column = 'tmp_value', type = 'centroid',
+                          quiet = True)
+        # v.reclass needs an integer or a string column
+        grass.run_command('v.db.update', map = tmp, column = 'tmp_label',
+                          query_column = 'tmp_value', quiet = True)
+        grass.run_command('v.reclass', input = tmp, output = output + '_rcl',
+                          column = 'tmp_label', type = 'centroid',
+                          quiet = True)
+        grass.run_command('g.remove', flags = 'f', type = 'vector', name = tmp,
+                          quiet = True)
+        tmp = output + '_rcl'
+
+    grass.run_command('v.extract', input = tmp, output = output + '_dslv',
+                      type = 'area', flags = 'dt', quiet = True)
+    grass.run_command('g.remove', flags = 'f', type = 'vector', name = tmp,
+                      quiet = True)
+    tmp = output + '_dslv'
+
+    if 'v' in rtvflags:
+        grass.run_command('g.rename', vector = (tmp, output), quiet = True)
+    else:
+        # one category for each area, as r.to.vect does
+        grass.run_command('v.category', input = tmp, output = output + '_cat',
+                          option = 'del', cat = -1, quiet = True)
+        grass.run_command('g.remove', flags = 'f', type = 'vector', name = tmp,
+                          quiet = True)
+        tmp = output + '_cat'
+        grass.run_command('v.category', input = tmp, output = output,
+                          option = 'add', type = 'centroid', quiet = True)
+        grass.run_command('g.remove', flags = 'f', type = 'vector', name = tmp,
+                          quiet = True)
+
+    if 't' not in rtvflags:
+        ctype = 'integer' if datatype == 'CELL' else 'double precision'
+        grass.run_command('v.db.addtable', map = output,
+                          columns = '%s %s' % (column, ctype), quiet = True)
+        grass.run_command('v.what.rast', map = output, raster = input,
+                          column = column, type = 'centroid', quiet = True)
+
 
 def main():
     input = options['input']
@@ -114,6 +257,7 @@ def main():
     ftype = options['type']
     xtiles = int(options['x'])
     ytiles = int(options['y'])
+    nprocs = int(options['nprocs'])
 
     rtvflags=""
     for key in 'sbtvz':
@@ -123,12 +267,12 @@ def main():
     # check options
     if xtiles <= 0:
         grass.fatal(_("Number of tiles in x direction must be > 0"))
-    if ytiles < 0:
+    if ytiles <= 0:
         grass.fatal(_("Number of tiles in y direction must be > 0"))
     if grass.find_file(name = input)['name'] == '':
         grass.fatal(_("Input raster %s not found") % input)
+    input = grass.find_file(name = input)['fullname']
 
-    grass.use_temp_region()
     curr = grass.region()
     width = int(curr['cols'] / xtiles)
     if width <= 1:
@@ -160,8 +304,11 @@ def main():
         grass.fatal(_("Overlap is too large"))
 
     datatype = grass.raster_info(input)['datatype']
-    vtiles = None
+    # the stitched areas are built from the topology
+    if flags['p'] and ftype == 'area':
+        rtvflags = rtvflags.replace('b', '')
 
+    jobs = []
     # north to south
     for ytile in range(ytiles):
         n = curr['n'] - ytile * height * nsres
@@ -176,18 +323,7 @@ def main():
             if xtile == xtiles - 1:
                 e = curr['e']
 
-            grass.run_command('g.region', n = n, s = s, e = e, w = w, nsres = nsres, ewres = ewres)
-
-            if do_clip:
-                tilename = output + '_stile_' + str(ytile) + str(xtile)
-            else:
-                tilename = output + '_tile_' + str(ytile) + str(xtile)
-
-            outname = output + '_tile_' + str(ytile) + str(xtile)
-
-            grass.run_command('r.to.vect', input = input, output = tilename,
-                              type = ftype, column = column, flags = rtvflags)
-
+            clip = None
             if do_clip:
                 n2 = curr['n'] - ytile * height * nsres - yoverlap2
                 s2 = n2 - height * nsres
@@ -204,47 +340,53 @@ def main():
                     e2 = w2 + width * ewres + xoverlap2
                 if xtile == xtiles - 1:
                     e2 = curr['e']
+                clip = dict(n = n2, s = s2, e = e2, w = w2,
+                            nsres = nsres, ewres = ewres)
+
+            outname = output + '_tile_' + str(ytile) + str(xtile)
+            mapset = 'tmp_rtovect_%d_%d_%d' % (os.getpid(), ytile, xtile)
+            region = dict(n = n, s = s, e = e, w = w,
+                          nsres = nsres, ewres = ewres)
+            jobs.append((mapset, outname, input, ftype, column, rtvflags,
+                         region, clip))
 
-                tilename = output + '_stile_' + str(ytile) + str(xtile)
-                if grass.vector_info_topo(tilename)['areas'] > 0:
-                    grass.run_command('g.region', n = n2, s = s2, e = e2, w = w2,
-                                      nsres = nsres, ewres = ewres)
-
-                    extname = 'extent_tile_' + str(ytile) + str(xtile)
-                    grass.run_command('v.in.region', output = extname, flags = 'd')
-                    outname = output + '_tile_' + str(ytile) + str(xtile)
-                    grass.run_command('v.overlay', ainput = tilename, binput = extname,
-                                      output = outname, operator = 'and', olayer = '0,1,0')
-                    grass.run_command('g.remove', flags='f', type='vector', name= extname, quiet = True)
-
-                    if vtiles is None:
-                        vtiles = outname
-                    else:
-                        vtiles = vtiles + ',' + outname
-
-                grass.run_command('g.remove', flags='f', type='vector', name= tilename, quiet = True)
-
-            else:
-                # write cmd history:
-                grass.vector_history(outname)
-                if vtiles is None:
-                    vtiles = outname
-                else:
-                    vtiles = vtiles + ',' + outname
+    genv = grass.gisenv()
+    location = os.path.join(genv['GISDBASE'], genv['LOCATION_NAME'])
+    TMP_MAPSETS.extend(os.path.join(location, job[0]) for job in jobs)
+
+    # each tile is vectorized in its own mapset, so the tiles do not
+    # compete for the vector and the database files
+    pool = Pool(nprocs)
+    try:
+        results = pool.map(vectorize_tile, jobs, chunksize = 1)
+    except CalledModuleError as e:
+        grass.fatal(_("Vectorization of a tile failed: %s") % e)
+    finally:
+        pool.close()
+        pool.join()
+
+    vtiles = ['%s@%s' % (name, job[0])
+              for name, job in zip(results, jobs) if name]
 
     if flags['p']:
         grass.run_command('v.patch', input = vtiles, output = output,
                           flags = 'e')
 
-        grass.run_command('g.remove', flags='f', type='vector', name= vtiles, quiet = True)
-
-        if grass.vector_info_topo(output)['boundaries'] > 0:
+        if ftype == 'area':
+            stitch(output, input, column, rtvflags, datatype)
+        elif grass.vector_info_topo(output)['boundaries'] > 0 or \
+                grass.vector_info_topo(output)['lines'] > 0:
             outpatch = output + '_patch'
             grass.run_command('g.rename', vector = (output,outpatch))
             grass.run_command('v.clean', input = outpatch, output = output,
-                              tool = 'break', flags = 'c')
+                              tool = 'break,rmdupl', flags = 'c')
             grass.run_command('g.remove', flags='f', type='vector', name= outpatch)
-
+        grass.vector_history(output)
+    else:
+        for vtile in vtiles:
+            grass.run_command('g.copy', vector = (vtile, vtile.split('@')[0]),
+                              quiet = True)
+            grass.vector_history(vtile.split('@')[0])
 
     grass.message(_("%s complete") % 'r.to.vect.tiled')
 
@@ -252,4 +394,5 @@ def main():
 
 if __name__ == "__main__":
     options, flags = grass.parser()
+    atexit.register(cleanup)
     sys.exit(main())
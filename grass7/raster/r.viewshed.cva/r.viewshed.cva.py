@@ -78,6 +78,14 @@
 #% required : no
 #%end
 
+#%option
+#% key: nprocs
+#% type: integer
+#% description: Number of viewsheds to compute in parallel
+#%answer: 1
+#% required : no
+#%end
+
 #%option G_OPT_DB_COLUMN
 #% key: name_column
 #% description: Database column for point names (with flag -k)
@@ -113,9 +121,70 @@
 
 import sys
 import os
+import math
+from multiprocessing import Pool
 grass_install_tree = os.getenv('GISBASE')
 sys.path.append(grass_install_tree + os.sep + 'etc' + os.sep + 'python')
 import grass.script as grass
+from grass.exceptions import CalledModuleError
+
+
+def viewshed_window(region, x, y, max_distance):
+    """Return the first row, first column, number of rows and number of
+    columns of the part of the region within max_distance from the observer.
+    The window is aligned to the region cells."""
+    if max_distance < 0:
+        return 0, 0, region['rows'], region['cols']
+    col0 = max(int(math.floor((x - max_distance - region['w']) / region['ewres'])), 0)
+    col1 = min(int(math.ceil((x + max_distance - region['w']) / region['ewres'])), region['cols'])
+    row0 = max(int(math.floor((region['n'] - y - max_distance) / region['nsres'])), 0)
+    row1 = min(int(math.ceil((region['n'] - y + max_distance) / region['nsres'])), region['rows'])
+    return row0, col0, row1 - row0, col1 - col0
+
+
+def viewshed(params):
+    """Compute the viewshed of an observer within its window, return the
+    position of the window and the visible cells as a numpy array"""
+    import numpy as np
+    (elev, name, x, y, region, window, flagstring, keep, viewshed_options) = params
+    row0, col0, rows, cols = window
+    env = os.environ.copy()
+    env['GRASS_REGION'] = grass.region_env(
+        n=region['n'] - row0 * region['nsres'],
+        s=region['n'] - (row0 + rows) * region['nsres'],
+        w=region['w'] + col0 * region['ewres'],
+        e=region['w'] + (col0 + cols) * region['ewres'],
+        nsres=region['nsres'], ewres=region['ewres'])
+    # without -k only visibility is needed, binary output does not have nulls
+    vflags = flagstring if keep else flagstring.replace('e', '') + ('' if 'b' in flagstring else 'b')
+    binfile = grass.tempfile()
+    # only the kept viewsheds are named after the points, temporary maps
+    # must not overwrite existing maps of the user
+    tmpname = 'tmp_rviewshedcva_{pid}_{name}'.format(pid=os.getpid(), name=name)
+    try:
+        if keep:
+            grass.run_command("r.viewshed", quiet=True, overwrite=grass.overwrite(),
+                              flags=vflags, input=elev, output=name,
+                              coordinates=(x, y), env=env, **viewshed_options)
+            visible = tmpname
+            expr = 'if({v} == 1, 1, 0)' if 'b' in vflags else 'if(isnull({v}), 0, 1)'
+            grass.mapcalc(visible + ' = ' + expr.format(v=name), quiet=True,
+                          overwrite=True, env=env)
+        else:
+            visible = tmpname
+            grass.run_command("r.viewshed", quiet=True, overwrite=True, flags=vflags,
+                              input=elev, output=visible, coordinates=(x, y), env=env,
+                              **viewshed_options)
+        grass.run_command("r.out.bin", quiet=True, input=visible, output=binfile,
+                          null=0, bytes=1, env=env)
+        grass.run_command("g.remove", quiet=True, flags='f', type='raster',
+                          name=visible, env=env)
+        array = np.fromfile(binfile, dtype=np.uint8).reshape(rows, cols)
+    except CalledModuleError:
+        return name, None, None
+    finally:
+        grass.try_remove(binfile)
+    return name, (row0, col0), array
 
 
 # main block of code starts here
@@ -158,36 +227,69 @@ def main():
     for line in output_points.splitlines():
         if line:  # see ticket #3155
             masterlist.append(line.strip().split(','))
-    # now, loop through the master list and run r.viewshed for each of the sites,
-    # and append the viewsheds to a list (so we can work with them later)
-    vshed_list = []
-    counter = 0
-    for site in masterlist:
-        if flags['k'] and options["name_column"] is not '':
+    # the viewsheds are computed by a pool of processes and each of them is
+    # added to the cumulative viewshed and removed as soon as it is ready
+    import numpy as np
+    region = grass.region()
+    max_distance = float(options['max_distance'])
+    keep = flags['k']
+    jobs = []
+    for counter, site in enumerate(masterlist):
+        if flags['k'] and options["name_column"] != '':
             ptname = site[3]
         else:
             ptname = site[2]
-        grass.verbose(_('Calculating viewshed for location %s,%s (point name = %s)') % (site[0], site[1], ptname))
+        x, y = float(site[0]), float(site[1])
         # need additional number for cases when points have the same category (e.g. from v.to.points)
-        tempry = "vshed_{ptname}_{c}".format(ptname=ptname, c=counter)
-        counter += 1
-        vshed_list.append(tempry)
-        grass.run_command("r.viewshed", quiet=True, overwrite=grass.overwrite(), flags=flagstring,
-                          input=elev, output=tempry, coordinates=site[0] + "," + site[1], **viewshed_options)
-    # now make a mapcalc statement to add all the viewsheds together to make the outout cumulative viewsheds map
-    grass.message(_("Calculating cumulative viewshed map <%s>") % out)
-    # when binary viewshed, r.series has to use sum instead of count
-    rseries_method = 'sum' if 'b' in flagstring else 'count'
-    grass.run_command("r.series", quiet=True, overwrite=grass.overwrite(),
-                      input=(",").join(vshed_list), output=out, method=rseries_method)
+        name = "vshed_{ptname}_{c}".format(ptname=ptname, c=counter)
+        jobs.append((elev, name, x, y, region,
+                     viewshed_window(region, x, y, max_distance),
+                     flagstring, keep, viewshed_options))
+    if keep and not grass.overwrite():
+        mapset = grass.gisenv()['MAPSET']
+        for job in jobs:
+            if grass.find_file(job[1], element='cell', mapset=mapset)['file']:
+                grass.fatal(_("Raster map <%s> already exists") % job[1])
+
+    # the cumulative viewshed is a memory mapped file, so that the memory
+    # does not depend on the size of the region
+    cumulative_file = grass.tempfile()
+    cumulative = np.memmap(cumulative_file, dtype=np.uint32, mode='w+',
+                           shape=(region['rows'], region['cols']))
+    pool = Pool(int(options['nprocs']))
+    failed = []
+    try:
+        for count, (name, position, visible) in enumerate(pool.imap_unordered(viewshed, jobs)):
+            grass.percent(count, len(jobs), 1)
+            if visible is None:
+                failed.append(name)
+                continue
+            grass.verbose(_('Adding viewshed <%s>') % name)
+            row0, col0 = position
+            rows, cols = visible.shape
+            cumulative[row0:row0 + rows, col0:col0 + cols] += visible
+        grass.percent(1, 1, 1)
+        if failed:
+            grass.fatal(_("Viewshed computation failed for: %s") % ', '.join(failed))
+
+        grass.message(_("Writing cumulative viewshed map <%s>") % out)
+        from grass.pygrass.raster import RasterRow
+        from grass.pygrass.raster.buffer import Buffer
+        with RasterRow(out, mode='w', mtype='CELL', overwrite=grass.overwrite()) as output:
+            for row in range(region['rows']):
+                buf = Buffer((region['cols'],), mtype='CELL')
+                buf[:] = cumulative[row]
+                output.put_row(buf)
+    finally:
+        pool.close()
+        pool.join()
+        del cumulative
+        grass.try_remove(cumulative_file)
+    grass.raster_history(out)
     if flags['e']:
         grass.run_command("r.null", quiet=True, map=out, setnull='0')
-    # Clean up temporary maps, if requested
     if flags['k']:
-        grass.message(_("Temporary viewshed maps will not removed"))
-    else:
-        grass.message(_("Removing temporary viewshed maps"))
-        grass.run_command("g.remove",  quiet=True, flags='f', type='raster', name=(",").join(vshed_list))
+        grass.message(_("Viewshed maps were not removed"))
     return
 
 # here is where the code in "main" actually gets executed. This way of programming is neccessary for the way g.parser needs to run.
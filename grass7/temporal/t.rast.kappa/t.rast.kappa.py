@@ -73,30 +73,39 @@
 #%option G_OPT_F_SEP
 #%end
 
+#%option
+#% key: block_rows
+#% type: integer
+#% description: Number of rows read and processed together in the pixel by pixel analysis
+#% required: no
+#% answer: 64
+#% multiple: no
+#%end
+
 import sys
 import grass.script as gscript
 import grass.temporal as tgis
 from grass.pygrass.raster import RasterRow
 from grass.pygrass.gis.region import Region
 from grass.script.utils import separator
-try:
-    from collections import OrderedDic
-except:
-    from types import DictType as OrderedDic
 import numpy as np
 
+CNULL = -2147483648  # null value for CELL maps
+
 def _load_skll():
     try:
         from sklearn.metrics import cohen_kappa_score
         return False
     except ImportError:
-        gscript.warning(_(""))
+        gscript.warning(_("scikit-learn is not installed, r.kappa is used"))
         return True
 
 def _split_maps(maps, splitting):
+    """Return the names of the maps before and after the splitting day,
+    in temporal order"""
     from datetime import datetime
-    before = OrderedDic()
-    after = OrderedDic()
+    before = []
+    after = []
     split = None
     if splitting.count('T') == 0:
         try:
@@ -114,42 +123,86 @@ def _split_maps(maps, splitting):
                         "'%Y-%m-%d' or '%Y-%m-%dT%H:%M:%S'"))
     for mapp in maps:
         tempext = mapp.get_temporal_extent()
-        raster = RasterRow(mapp.get_name())
-        raster.open('r')
-        array = np.array(raster)
         if tempext.start_time <= split:
-            before[mapp.get_name()] = array
+            before.append(mapp.get_name())
         else:
-            after[mapp.get_name()] = array
+            after.append(mapp.get_name())
     return before, after
 
-def _kappa_pixel(maps1, maps2, out, method, over):
+def _read_rows(rasters, start, stop):
+    """Return the rows start..stop-1 of the rasters as a (maps, cells)
+    array, null cells are NaN"""
+    block = np.array([[raster[row] for row in range(start, stop)]
+                      for raster in rasters], dtype=np.float64)
+    for i, raster in enumerate(rasters):
+        if raster.mtype == 'CELL':
+            block[i][block[i] == CNULL] = np.nan
+    return block.reshape(len(rasters), -1)
+
+def _ranks(values):
+    """Return the index of each value in the sorted list of the distinct
+    values of its column (the labels used by cohen_kappa_score)"""
+    order = np.argsort(values, axis=0, kind='mergesort')
+    ordered = np.take_along_axis(values, order, axis=0)
+    new = np.ones(values.shape, dtype=bool)
+    new[1:] = ordered[1:] != ordered[:-1]
+    ranks = np.empty(values.shape, dtype=np.int64)
+    np.put_along_axis(ranks, order, np.cumsum(new, axis=0) - 1, axis=0)
+    return ranks
+
+def _weights(rank1, rank2, method):
+    """Return the disagreement weights of the pairs of labels"""
+    if method == 'linear':
+        return np.abs(rank1 - rank2)
+    elif method == 'quadratic':
+        return (rank1 - rank2) ** 2
+    return (rank1 != rank2).astype(np.int64)
+
+def kappa_cells(vals1, vals2, method=None):
+    """Cohen's kappa (as sklearn.metrics.cohen_kappa_score) of each cell,
+    vals1 and vals2 are (samples, cells) arrays. The kappa is NaN for the
+    cells with null values or without expected disagreement"""
+    nsamples = vals1.shape[0]
+    ranks = _ranks(np.concatenate((vals1, vals2)))
+    rank1, rank2 = ranks[:nsamples], ranks[nsamples:]
+    observed = _weights(rank1, rank2, method).sum(axis=0)
+    expected = np.zeros(vals1.shape[1])
+    for sample in range(nsamples):
+        expected += _weights(rank1, rank2[sample], method).sum(axis=0)
+    expected /= nsamples
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kappa = 1 - observed / expected
+    nulls = np.isnan(vals1).any(axis=0) | np.isnan(vals2).any(axis=0)
+    kappa[nulls] = np.nan
+    return kappa
+
+def _kappa_pixel(maps1, maps2, out, method, over, block_rows):
     from grass.pygrass.raster.buffer import Buffer
-    import sklearn
+    if len(maps1) != len(maps2):
+        gscript.fatal(_("The number of maps before and after the splitting "
+                        "day must be the same ({b} and {a})".format(
+                            b=len(maps1), a=len(maps2))))
+    rasters1 = [RasterRow(name) for name in maps1]
+    rasters2 = [RasterRow(name) for name in maps2]
     rasterout = RasterRow(out, overwrite=over)
-    rasterout.open('w','DCELL')
-    array1 = maps1.values()[0]
-    for row in range(len(array1)):
-        newrow = Buffer((len(array1[row]),), mtype='DCELL')
-        for col in range(len(array1[row])):
-            vals1 = np.ndarray(len(maps1.values()))
-            vals2 = np.ndarray(len(maps2.values()))
-            x = 0
-            for value in maps1.values():
-                vals1[x] = value[row][col]
-                x += 1
-            x = 0
-            for value in maps2.values():
-                vals2[x] = value[row][col]
-                x += 1
-            if sklearn.__version__ >= '0.18':
-                outval = sklearn.metrics.cohen_kappa_score(vals1, vals2,
-                                                           weights=method)
-            else:
-                outval = sklearn.metrics.cohen_kappa_score(vals1, vals2)
-            newrow[col] = outval
-        rasterout.put_row(newrow)
-    rasterout.close()
+    current = Region()
+    try:
+        for raster in rasters1 + rasters2:
+            raster.open('r')
+        rasterout.open('w', 'DCELL')
+        for start in range(0, current.rows, block_rows):
+            stop = min(start + block_rows, current.rows)
+            kappa = kappa_cells(_read_rows(rasters1, start, stop),
+                                _read_rows(rasters2, start, stop), method)
+            for row in kappa.reshape(stop - start, current.cols):
+                newrow = Buffer((current.cols,), mtype='DCELL')
+                newrow[:] = row
+                rasterout.put_row(newrow)
+            gscript.percent(stop, current.rows, 1)
+    finally:
+        for raster in rasters1 + rasters2 + [rasterout]:
+            if raster.is_open():
+                raster.close()
     return
 
 def _kappa_skll(map1, map2, lowmem, method):
@@ -200,6 +253,9 @@ def main():
 
     if flags['k'] and flags['p']:
         gscript.fatal(_("It is not possible to use 'k' and 'p' flag together"))
+    elif flags['p']:
+        # computed with numpy, scikit-learn is not needed
+        rkappa = False
     elif flags['k'] and not method:
         rkappa = True
     elif flags['k'] and method:
@@ -223,7 +279,8 @@ def main():
 
     if flags['p']:
         before, after = _split_maps(maps, options["splittingday"])
-        _kappa_pixel(before, after, out_name, method, gscript.overwrite())
+        _kappa_pixel(before, after, out_name, method, gscript.overwrite(),
+                     int(options['block_rows']))
         return
 
     mapnames = [mapp.get_name() for mapp in maps]
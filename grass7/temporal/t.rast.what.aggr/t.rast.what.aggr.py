@@ -114,42 +114,129 @@
 from datetime import datetime
 from datetime import timedelta
 from subprocess import PIPE as PI
+from multiprocessing.dummy import Pool
 import numpy as np
 import grass.script as gscript
 from grass.exceptions import CalledModuleError
 
+# maximum number of raster maps sampled by a single r.what call
+MAPS_PER_QUERY = 200
+
 
 def return_value(vals, met):
-    """Return the value according the choosen method"""
+    """Return the values according the choosen method, vals is a 2D array
+    (points, maps) and the aggregate is computed for each point"""
     if met == 'average':
-        return vals.mean()
+        return vals.mean(axis=1)
     elif met == 'median':
-        return np.median(vals)
+        return np.median(vals, axis=1)
     elif met == 'mode':
         try:
             from scipy import stats
-            m = stats.mode(vals)
-            return m.mode[0]
+            m = stats.mode(vals, axis=1)
+            return np.ravel(m.mode)
         except ImportError:
             gscript.fatal(_("For method 'mode' you need to install scipy"))
     elif met == 'minimum':
-        return vals.min()
+        return vals.min(axis=1)
     elif met == 'maximum':
-        return vals.max()
+        return vals.max(axis=1)
     elif met == 'stddev':
-        return vals.std()
+        return vals.std(axis=1)
     elif met == 'sum':
-        return vals.sum()
+        return vals.sum(axis=1)
     elif met == 'variance':
-        return vals.var()
+        return vals.var(axis=1)
     elif met == 'quart1':
-        return np.percentile(vals, 25)
+        return np.percentile(vals, 25, axis=1)
     elif met == 'quart3':
-        return np.percentile(vals, 75)
+        return np.percentile(vals, 75, axis=1)
     elif met == 'perc90':
-        return np.percentile(vals, 90)
+        return np.percentile(vals, 90, axis=1)
     elif met == 'quantile':
-        return 
+        return [None] * vals.shape[0]
+
+
+def get_points(invect):
+    """Return the categories of the points of the vector map"""
+    points = gscript.read_command("v.category", input=invect, type="point",
+                                  option="print")
+    return points.splitlines()
+
+
+def sample_maps(invect, maps):
+    """Sample the raster maps at the points of the vector map, return
+    the categories of the points and a 2D array (points, maps) with NaN
+    for null values"""
+    try:
+        out = gscript.read_command("r.what", map=maps, points=invect,
+                                   flags="v", separator="|", null_value="*",
+                                   quiet=True)
+    except CalledModuleError:
+        gscript.fatal(_("r.what returned an error"))
+    cats = []
+    vals = []
+    for line in out.splitlines():
+        fields = line.split("|")
+        if len(fields) != len(maps) + 4:
+            gscript.fatal(_("Unexpected r.what output: {li}").format(li=line))
+        cats.append(fields[0])
+        vals.append([np.nan if v == '*' else float(v) for v in fields[4:]])
+    return cats, np.array(vals, dtype=float).reshape(-1, len(maps))
+
+
+def sample_all(invect, maps, nprocs):
+    """Sample all the raster maps once, by groups of MAPS_PER_QUERY maps
+    queried by nprocs parallel r.what. Return the categories of the points
+    and a 2D array (points, maps) of the sampled values"""
+    groups = [maps[i:i + MAPS_PER_QUERY]
+              for i in range(0, len(maps), MAPS_PER_QUERY)]
+    pool = Pool(nprocs)
+    try:
+        samples = pool.map(lambda group: sample_maps(invect, group), groups)
+    finally:
+        pool.close()
+        pool.join()
+    cats = samples[0][0]
+    npoints = gscript.vector_info_topo(invect)['points']
+    if len(cats) != npoints or any(group[0] != cats for group in samples):
+        gscript.fatal(_("r.what returned {nr} values for the {np} points of "
+                        "vector map <{vm}>").format(nr=len(cats), np=npoints,
+                                                    vm=invect))
+    return cats, np.hstack([group[1] for group in samples])
+
+
+def update_table(invect, cols, updates, incol=None):
+    """Write all the aggregated values in a single transaction,
+    updates is a list of (cat, date, values)"""
+    dbinfo = gscript.vector_db(invect)[1]
+    sqlfile = gscript.tempfile()
+    with open(sqlfile, 'w') as fsql:
+        fsql.write('BEGIN TRANSACTION;\n')
+        for cat, data, vals in updates:
+            sets = ', '.join("{col}={val}".format(col=col, val=val)
+                             for col, val in zip(cols, vals)
+                             if val is not None and not np.isnan(val))
+            if not sets:
+                continue
+            if incol:
+                where = "{dc}='{da}' AND {key}={ca}".format(dc=incol, da=data,
+                                                           key=dbinfo['key'],
+                                                           ca=cat)
+            else:
+                where = "{key}={ca}".format(key=dbinfo['key'], ca=cat)
+            fsql.write("UPDATE {tab} SET {sets} WHERE {wh};\n".format(
+                tab=dbinfo['table'], sets=sets, wh=where))
+        fsql.write('END TRANSACTION;')
+    try:
+        gscript.run_command('db.execute', input=sqlfile, quiet=True,
+                            database=dbinfo['database'],
+                            driver=dbinfo['driver'])
+    except CalledModuleError:
+        gscript.fatal(_("db.execute return an error"))
+    finally:
+        gscript.try_remove(sqlfile)
+
 
 def main(options, flags):
     import grass.pygrass.modules as pymod
@@ -227,15 +314,17 @@ def main(options, flags):
         gscript.fatal(_("Cannot combine 'date_column' and 'date' options"))
     elif not incol and not indate:
         gscript.fatal(_("You have to fill 'date_column' or 'date' option"))
-    elif incol:
+
+    if incol:
         try:
             dates = pymod.Module("db.select", flags='c', stdout_=PI,
-                                 stderr_=PI, sql="SELECT DISTINCT {dc} from " \
-                                   "{vmap} order by {dc}".format(vmap=invect,
-                                                                 dc=incol))
-            mydates = dates.outputs["stdout"].value.splitlines()
+                                 stderr_=PI, sql="SELECT cat, {dc} from " \
+                                   "{vmap}".format(vmap=invect, dc=incol))
+            catdates = dict(line.split('|', 1) for line in
+                            dates.outputs["stdout"].value.splitlines())
         except CalledModuleError:
             gscript.fatal(_("db.select return an error"))
+        mydates = sorted(set(v for v in catdates.values() if v))
     elif indate:
         mydates = [indate]
         pymap = VectorTopo(invect)
@@ -250,100 +339,85 @@ def main(options, flags):
                                 "<%s>" % invect))
         if pymap.is_open():
             pymap.close()
-        qfeat = pymod.Module("v.category", stdout_=PI, stderr_=PI,
-                             input=invect, option='print')
-        myfeats = qfeat.outputs["stdout"].value.splitlines()
-    
-    if stdout:
-        outtxt = ''
+
+    # Time window of each date
+    windows = []
     for data in mydates:
         if sp.get_temporal_type() == 'absolute':
             fdata = datetime.strptime(data, dateformat)
         else:
             fdata = int(data)
         if flags['a']:
-            sdata = fdata + td
-            mwhere="start_time >= '{inn}' and end_time < " \
-                   "'{out}'".format(inn=fdata, out=sdata)
+            windows.append((fdata, fdata + td))
         else:
-            sdata = fdata - td
-            mwhere="start_time >= '{inn}' and end_time < " \
-                   "'{out}'".format(inn=sdata, out=fdata)
-        lines = None
-        try:
-            r_what = pymod.Module("t.rast.what", points=invect, strds=strds,
-                                  layout='timerow', separator=separator,
-                                  flags="v", where=mwhere, quiet=True,
-                                  stdout_=PI, stderr_=PI)
-            lines = r_what.outputs["stdout"].value.splitlines()
-        except CalledModuleError:
-            pass
-        if incol:
-            try:
-                qfeat = pymod.Module("db.select", flags='c', stdout_=PI,
-                                     stderr_=PI, sql="SELECT DISTINCT cat from"
-                                     " {vmap} where {dc}='{da}' order by "
-                                     "cat".format(vmap=invect, da=data,
-                                                  dc=incol))
-                myfeats = qfeat.outputs["stdout"].value.splitlines()
-            except CalledModuleError:
-                gscript.fatal(_("db.select returned an error for date "
-                                "{da}".format(da=data)))
-        if not lines and stdout:
-            for feat in myfeats:
-                outtxt += "{di}{sep}{da}".format(di=feat, da=data,
-                                                   sep=separator)
-                for n in range(len(mets)):
-                    outtxt += "{sep}{val}".format(val='*', sep=separator)
-                outtxt += "\n"
-        if not lines:
+            windows.append((fdata - td, fdata))
+
+    # Select the maps needed by at least one window and sample them once
+    maps = sp.get_registered_maps("id,start_time,end_time",
+                                  order="start_time", dbif=dbif)
+    dbif.close()
+    maps = [m for m in maps if m["end_time"] is not None and
+            any(m["start_time"] >= inn and m["end_time"] < out
+                for inn, out in windows)]
+    if maps:
+        pointcats, samples = sample_all(options["input"],
+                                        [m["id"] for m in maps],
+                                        int(options["nprocs"]))
+    else:
+        pointcats = get_points(options["input"])
+    starts = np.array([m["start_time"] for m in maps])
+    ends = np.array([m["end_time"] for m in maps])
+
+    if stdout:
+        outtxt = ''
+    updates = []
+    # group the points by date
+    bydate = {}
+    for i, cat in enumerate(pointcats):
+        bydate.setdefault(catdates.get(cat) if incol else indate,
+                          []).append(i)
+    pointcats = np.array(pointcats)
+    for data, (inn, out) in zip(mydates, windows):
+        points = np.array(bydate.get(data, []), dtype=int)
+        if maps:
+            inwindow = (starts >= inn) & (ends < out)
+        if not maps or not inwindow.any():
+            if stdout:
+                for feat in pointcats[points]:
+                    outtxt += "{di}{sep}{da}".format(di=feat, da=data,
+                                                     sep=separator)
+                    for n in range(len(mets)):
+                        outtxt += "{sep}{val}".format(val='*', sep=separator)
+                    outtxt += "\n"
             continue
-        x=0
-        for line in lines:
-            vals = line.split(separator)
-            if vals[0] in myfeats:
-                try:
-                    nvals = np.array(vals[4:]).astype(np.float)
-                except ValueError:
-                    if stdout:
-                        outtxt += "{di}{sep}{da}".format(di=vals[0],
-                                                         da=data,
-                                                         sep=separator)
-                        for n in range(len(mets)):
-                            outtxt += "{sep}{val}".format(val='*',
-                                                          sep=separator)
-                        outtxt += "\n"
-                    continue
+        nvals = samples[points][:, inwindow]
+        # points with a null value in the window are not aggregated
+        valid = ~np.isnan(nvals).any(axis=1)
+        results = [return_value(nvals[valid], met) for met in mets]
+        idx = np.cumsum(valid) - 1
+        for i, feat in enumerate(pointcats[points]):
+            if not valid[i]:
                 if stdout:
-                    outtxt += "{di}{sep}{da}".format(di=vals[0], da=data,
+                    outtxt += "{di}{sep}{da}".format(di=feat, da=data,
                                                      sep=separator)
-                for n in range(len(mets)):
-                    result =  return_value(nvals, mets[n])
-                    if stdout:
-                        outtxt += "{sep}{val}".format(val=result,
+                    for n in range(len(mets)):
+                        outtxt += "{sep}{val}".format(val='*',
                                                       sep=separator)
-                    else:
-                        try:
-                            if incol:
-                                pymod.Module("v.db.update", map=output,
-                                             column=cols[n], value=str(result),
-                                             where="{dc}='{da}' AND cat="
-                                             "{ca}".format(da=data, ca=vals[0],
-                                                           dc=incol))
-                            else:
-                                pymod.Module("v.db.update", map=output,
-                                             column=cols[n], value=str(result),
-                                             where="cat={ca}".format(ca=vals[0]))
-                        except CalledModuleError:
-                            gscript.fatal(_("v.db.update return an error"))
-                if stdout:
                     outtxt += "\n"
-                if x == len(myfeats):
-                    break
-                else:
-                    x += 1
+                continue
+            vals = [result[idx[i]] for result in results]
+            if stdout:
+                outtxt += "{di}{sep}{da}".format(di=feat, da=data,
+                                                 sep=separator)
+                for val in vals:
+                    outtxt += "{sep}{val}".format(val=val, sep=separator)
+                outtxt += "\n"
+            else:
+                updates.append((feat, data, vals))
     if stdout:
         print(outtxt)
+    elif updates:
+        update_table(output, cols, updates, incol)
 
 if __name__ == "__main__":
     options, flags = gscript.parser()
@@ -147,6 +147,29 @@ A_average
 """
         self.assertLooksLike(text, t_rast_what.outputs.stdout)
 
+    def test_uflag_date_column(self):
+        """Testing u flag with date_column option and more methods"""
+        self.runModule("v.db.addcolumn", map="points",
+                       columns="minval double precision,"
+                               "maxval double precision")
+        self.assertModule(SimpleModule("t.rast.what.aggr", flags="u",
+                                       strds="A", input="points",
+                                       date_column="data", verbose=True,
+                                       columns=["minval", "maxval"],
+                                       method=["minimum", "maximum"],
+                                       granularity="3 months",
+                                       overwrite=True))
+        dbvals = SimpleModule("v.db.select", map="points",
+                              columns="cat,minval,maxval")
+        self.assertModule(dbvals)
+        text="""cat|minval|maxval
+1|300|400
+2|200|300
+3|400|400
+
+"""
+        self.assertLooksLike(text, dbvals.outputs.stdout)
+
 
 class TestRasterWhatFails(TestCase):
 
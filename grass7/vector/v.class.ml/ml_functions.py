@@ -9,7 +9,14 @@ import time
 import random as rnd
 from gettext import lgettext as _
 import sys
+import json
 import pickle as pk
+from multiprocessing import Pool
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -19,7 +26,7 @@ from sklearn import metrics as metrics
 from sklearn.metrics import (precision_recall_curve as prc, roc_curve, auc,
                              confusion_matrix)
 from sklearn.cross_validation import StratifiedKFold
-from sklearn.grid_search import GridSearchCV
+from sklearn.grid_search import GridSearchCV, ParameterGrid
 from sklearn.svm import SVC
 from sklearn.cross_validation import cross_val_score
 
@@ -41,6 +48,11 @@ SCORES_DTYPE = [('index', 'i'),
                 ('std', 'f')]
 
 
+BENCH_COLS = ('index', 'name', 'mean', 'max', 'min', 'std',
+              'fit_time', 'predict_time', 'fit_throughput',
+              'predict_throughput', 'peak_rss_increase', 'error')
+
+
 def print_cols(clss, sep=';', save=sys.stdout):
     clsses = sorted(set(clss))
     cols = ['ml_index', 'ml_name', 'fit_time', 'prediction_time',
@@ -451,3 +463,118 @@ def explore_SVC(Xt, Yt, n_folds=3, n_jobs=1, **kwargs):
     grid.fit(Xt, Yt)
     print("The best classifier is: ", grid.best_estimator_)
     return grid
+
+
+def peak_rss():
+    """Return the peak resident set size of the current process in MB"""
+    if resource is None:
+        return float('nan')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X and in kilobytes on linux
+    return rss / (1024. * 1024.) if sys.platform == 'darwin' else rss / 1024.
+
+
+_BENCH_DATA = {}
+
+
+def _init_benchmark(Xd, Yd, cv):
+    """Share the data set with the worker processes"""
+    _BENCH_DATA.update(X=Xd, y=Yd, cv=cv)
+
+
+def benchmark_classifier(args):
+    """Fit and predict a classifier on each cross-validation fold and
+    return a dictionary with the scores, the mean fit/predict time in
+    seconds, the throughput in samples per second and the increase of the
+    peak RSS in MB of the worker process during the benchmark.
+    """
+    # the worker starts with the memory copied from the parent at fork,
+    # only the increase over this baseline is due to the classifier
+    baseline = peak_rss()
+    index, cls = args
+    Xd, Yd, cv = _BENCH_DATA['X'], _BENCH_DATA['y'], _BENCH_DATA['cv']
+    res = dict(index=index, name=cls['name'], error='')
+    scores, fit_times, pred_times, ntrain, ntest = [], [], [], 0, 0
+    try:
+        for train, test in cv:
+            clf = cls['classifier'](**cls['kwargs'])
+            start = time.time()
+            clf.fit(Xd[train], Yd[train])
+            fit_times.append(time.time() - start)
+            start = time.time()
+            pred = clf.predict(Xd[test])
+            pred_times.append(time.time() - start)
+            scores.append((pred == Yd[test]).mean())
+            ntrain += len(train)
+            ntest += len(test)
+    except Exception as exc:
+        res['error'] = '%s: %s' % (exc.__class__.__name__, exc)
+    scores = np.array(scores) if scores else np.array([np.nan])
+    fit, pred = sum(fit_times), sum(pred_times)
+    res.update(mean=scores.mean(), max=scores.max(), min=scores.min(),
+               std=scores.std(),
+               fit_time=fit / len(fit_times) if fit_times else np.nan,
+               predict_time=pred / len(pred_times) if pred_times else np.nan,
+               fit_throughput=ntrain / fit if fit else np.nan,
+               predict_throughput=ntest / pred if pred else np.nan,
+               peak_rss_increase=max(peak_rss() - baseline, 0.))
+    return res
+
+
+def svc_classifiers(**kwargs):
+    """Return the list of SVC classifiers of the explore_SVC grid"""
+    clsses = []
+    for params in ParameterGrid(kwargs):
+        name = 'SVC ' + ' '.join('%s=%s' % (k, params[k])
+                                 for k in sorted(params))
+        clsses.append({'name': name, 'classifier': SVC, 'kwargs': params})
+    return clsses
+
+
+def write_benchmark(res, report):
+    """Write the benchmark results to a JSON or CSV file"""
+    if report.lower().endswith('.json'):
+        # json does not support NaN in a portable way
+        rows = [{k: (None if isinstance(v, float) and np.isnan(v) else v)
+                 for k, v in r.items()} for r in res]
+        with open(report, 'w') as rep:
+            json.dump(rows, rep, indent=2, sort_keys=True)
+    else:
+        with open(report, 'w') as rep:
+            rep.write(';'.join(BENCH_COLS) + '\n')
+            for r in res:
+                rep.write(';'.join(str(r[k]) for k in BENCH_COLS) + '\n')
+
+
+def benchmark_clsfiers(clsses, Xd, Yd, indexes=None, n_folds=5, n_jobs=1,
+                       report=''):
+    """Run the classifiers in a pool of processes and return a list of
+    dictionaries with accuracy, timing and memory of each classifier.
+
+    Each worker process is used for a single classifier, so the increase
+    of its peak RSS over the RSS at the start of the task is the memory
+    required by that classifier (rounded by the pages already resident).
+    """
+    gen = zip(indexes, clsses) if indexes else enumerate(clsses)
+    cv = list(StratifiedKFold(Yd, n_folds=n_folds, shuffle=True))
+    fmt = '%5d %-30s %6.4f %6.4f %9.4fs %9.4fs %12.1f %9.1fMB'
+    res = []
+    pool = Pool(processes=n_jobs, initializer=_init_benchmark,
+                initargs=(Xd, Yd, cv), maxtasksperchild=1)
+    try:
+        for r in pool.imap_unordered(benchmark_classifier, gen):
+            if r['error']:
+                print('problem with: %s, %s' % (r['name'], r['error']))
+            else:
+                print(fmt % (r['index'], r['name'], r['mean'], r['std'],
+                             r['fit_time'], r['predict_time'],
+                             r['predict_throughput'],
+                             r['peak_rss_increase']))
+            res.append(r)
+    finally:
+        pool.close()
+        pool.join()
+    res.sort(key=lambda r: r['index'])
+    if report:
+        write_benchmark(res, report)
+    return res
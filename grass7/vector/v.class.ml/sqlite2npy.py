@@ -6,6 +6,9 @@ Created on Sat Nov  2 23:40:22 2013
 """
 from __future__ import print_function, division
 
+import os
+import time
+
 import numpy as np
 from grass.pygrass.vector import VectorTopo
 
@@ -17,25 +20,59 @@ FCLSS = 'training_classes.npy'
 FTDATA = 'training_data.npy'
 
 
-def cpdata(shape, iterator, dtype=float, msg=''):
-    """Avoid to create a python list and then convert the python list to a
-    numpy array. This function instantiate statically a numpy array and then
-    fill the numpy array with the data coming from the generator to reduce
-    the memory consumption."""
-    nrows = shape[0]
-    #msgr = ???
-    #msgr.message(msg)
+#: numpy data types of the SQL column types that can be converted
+SQLTYPES = {'INTEGER': np.int64, 'INT': np.int64, 'SMALLINT': np.int64,
+            'BIGINT': np.int64, 'REAL': np.float64, 'DOUBLE': np.float64,
+            'DOUBLE PRECISION': np.float64, 'FLOAT': np.float64,
+            'NUMERIC': np.float64}
+
+
+def fetch2npy(fname, cursor, shape, dtype=float, chunk=10000, msg='',
+              select=None, fselect=None):
+    """Fetch the rows of a cursor in chunks using ``fetchmany`` and write
+    them directly into a preallocated ``.npy`` memory-mapped file, only one
+    chunk of rows is kept in memory. NULL values are converted to NaN for
+    floating point arrays. If a boolean array ``select`` is given, the
+    selected rows are also written to the ``fselect`` npy file.
+    Return a tuple with the memory-mapped array and the memory-mapped
+    selection, or None if ``select`` is not given."""
     print(msg)
-    dt = np.empty(shape, dtype=dtype)
-    for i, data in enumerate(iterator):
-        #msgr.percent(i, nrows, 2)
-        dt[i] = data
-    return dt
+    start = time.time()
+    arr = np.lib.format.open_memmap(fname, mode='w+', dtype=dtype,
+                                    shape=shape)
+    sarr = None
+    if select is not None:
+        sarr = np.lib.format.open_memmap(fname=fselect, mode='w+',
+                                         dtype=dtype,
+                                         shape=(int(select.sum()), ) +
+                                         shape[1:])
+    i, j = 0, 0
+    rows = cursor.fetchmany(chunk)
+    while rows:
+        n = len(rows)
+        arr[i:i + n] = np.array(rows, dtype=dtype).reshape((n, ) +
+                                                           shape[1:])
+        if select is not None:
+            sel = select[i:i + n]
+            nsel = int(sel.sum())
+            sarr[j:j + nsel] = arr[i:i + n][sel]
+            j += nsel
+        i += n
+        rows = cursor.fetchmany(chunk)
+    if i != shape[0]:
+        raise ValueError('Expected %d rows, fetched %d' % (shape[0], i))
+    arr.flush()
+    if sarr is not None:
+        sarr.flush()
+    elapsed = max(time.time() - start, 1e-6)
+    print('    - %d rows fetched in %.2fs (%.0f rows/s, %.1f MB/s)' % (
+          i, elapsed, i / elapsed, arr.nbytes / elapsed / 2.**20))
+    return arr, sarr
 
 
 def save2npy(vect, l_data, l_trn,
              fcats=FCATS, fcols=FCOLS, fdata=FDATA, findx=FINDX,
-             fclss=FCLSS, ftdata=FTDATA):
+             fclss=FCLSS, ftdata=FTDATA, chunk=10000):
     """Return 6 arrays:
         - categories,
         - columns name,
@@ -43,6 +80,9 @@ def save2npy(vect, l_data, l_trn,
         - a boolean array with the training,
         - the training classes,
         - the training data.
+
+    The tables are read in chunks of ``chunk`` rows and written directly to
+    the npy files, the data arrays are returned as memory-mapped arrays.
     """
     with VectorTopo(vect, mode='r') as vct:
         # instantiate the tables
@@ -60,51 +100,60 @@ def save2npy(vect, l_data, l_trn,
             raise
 
         # extract the training
-        slct_trn = "SELECT class FROM {tname};".format(tname=trng.name)
-        trn_all = cpdata((n_data, ), (np.nan if a[0] is None else a[0]
-                                      for a in trng.execute(slct_trn)),
-                         msg=slct_trn)
-        # trn_all = np.array([np.nan if a[0] is None else a[0]
-        #                     for a in trng.execute(slct_trn)])
+        slct_trn = "SELECT class FROM {tname} ORDER BY {cat};".format(
+                   tname=trng.name, cat=trng.key)
+        fall = os.path.splitext(fclss)[0] + '_all.npy'
+        trn_all = fetch2npy(fall, trng.execute(slct_trn),
+                            (n_data, ), dtype=float, chunk=chunk,
+                            msg=slct_trn)[0]
         trn_indxs = ~np.isnan(trn_all)
 
-        # extract the data
+        # extract the cats
+        slct_cats = "SELECT {cat} FROM {tname} ORDER BY {cat};".format(
+                    cat=trng.key, tname=trng.name)
+        cats = fetch2npy(fcats, data.execute(slct_cats), (n_data, ),
+                         dtype=np.int64, chunk=chunk, msg=slct_cats)[0]
+
+        # check the data types of the columns
         data_cols = data.columns.names()
         cols = np.array(data_cols)
         data_cols.remove(data.key)
+        types = dict(zip(data.columns.names(), data.columns.types()))
+        notnum = [col for col in data_cols
+                  if types[col].upper() not in SQLTYPES]
+        if notnum:
+            raise TypeError('Columns with non numeric type: %s' %
+                            ', '.join(notnum))
+
+        # extract the data and the training samples in a single pass
         scols = ', '.join(data_cols)
-        slct_data = "SELECT {cols} FROM {tname};".format(cols=scols,
-                                                         tname=data.name)
+        slct_data = "SELECT {cols} FROM {tname} ORDER BY {cat};".format(
+                    cols=scols, tname=data.name, cat=data.key)
         shape = (n_data, len(data_cols))
-        # use the function to be more memory efficient
-        dta = cpdata(shape, data.execute(slct_data), msg=slct_data)
+        dta, trn_dta = fetch2npy(fdata, data.execute(slct_data), shape,
+                                 chunk=chunk, msg=slct_data,
+                                 select=trn_indxs, fselect=ftdata)
 
-        # extract the cats
-        slct_cats = "SELECT {cat} FROM {tname};".format(cat=trng.key,
-                                                        tname=trng.name)
-        cats = cpdata((n_data, ), (c[0] for c in data.execute(slct_cats)),
-                      dtype=int, msg=slct_cats)
-        # cats = np.array([c[0] for c in data.execute(slct_cats)])
-
-        # training samples
-        trn_dta = dta[trn_indxs]
+        # training classes
         trn_ind = trn_all[trn_indxs]
 
         # save
-        np.save(fcats, cats)
         np.save(fcols, cols)
-        np.save(fdata, dta)
         np.save(findx, trn_indxs)
         np.save(fclss, trn_ind)
-        np.save(ftdata, trn_dta)
+        del trn_all
+        os.remove(fall)
         return cats, cols, dta, trn_indxs, trn_ind, trn_dta
 
 
 def load_from_npy(fcats=FCATS, fdata=FDATA, findx=FINDX,
-                  fclss=FCLSS, ftdata=FTDATA):
-    cats = np.load(fcats)
-    data = np.load(fdata)
-    indx = np.load(findx)
-    Yt = np.load(fclss)
-    Xt = np.load(ftdata)
+                  fclss=FCLSS, ftdata=FTDATA, mmap_mode='c'):
+    """Open the npy files lazily as memory-mapped arrays, by default in
+    copy-on-write mode, so the data can be modified without changing
+    the files."""
+    cats = np.load(fcats, mmap_mode=mmap_mode)
+    data = np.load(fdata, mmap_mode=mmap_mode)
+    indx = np.load(findx, mmap_mode=mmap_mode)
+    Yt = np.load(fclss, mmap_mode=mmap_mode)
+    Xt = np.load(ftdata, mmap_mode=mmap_mode)
     return cats, data, indx, Yt, Xt
@@ -273,6 +273,22 @@
 #% answer: 1
 #%end
 #%option
+#% key: bench_report
+#% type: string
+#% multiple: no
+#% description: csv or json file name with the benchmark of the machine learning algorithms
+#% required: no
+#% answer: benchmark.csv
+#%end
+#%option
+#% key: bench_n_jobs
+#% type: integer
+#% multiple: no
+#% description: number of processes to use during the benchmark
+#% required: no
+#% answer: 1
+#%end
+#%option
 #% key: svc_c
 #% type: double
 #% multiple: no
@@ -356,6 +372,10 @@
 #% description: Explore the SVC domain
 #%end
 #%flag
+#% key: m
+#% description: Benchmark fit/predict time, throughput and memory of the classifiers and of the SVC domain if -d is set
+#%end
+#%flag
 #% key: a
 #% description: append the classification results
 #%end
@@ -493,7 +513,8 @@ def extract_classes(vect, layer):
 def main(opt, flg):
     # import functions which depend on sklearn only after parser run
     from ml_functions import (balance, explorer_clsfiers, run_classifier,
-                          optimize_training, explore_SVC, plot_grid)
+                          optimize_training, explore_SVC, plot_grid,
+                          benchmark_clsfiers, svc_classifiers)
     from features import importances, tocsv
 
     msgr = get_msgr()
@@ -562,7 +583,7 @@ def main(opt, flg):
     num = int(opt['n_training']) if opt['n_training'] else None
 
     # load fron npy files
-    Xt = np.load(opt['npy_tdata'])
+    Xt = np.load(opt['npy_tdata'], mmap_mode='c')
     Yt = np.load(opt['npy_tclasses'])
     cols = np.load(opt['npy_cols'])
 
@@ -644,6 +665,8 @@ def main(opt, flg):
         for k in allkwargs:
             if allkwargs[k]:
                 kwargs[k] = allkwargs[k]
+
+    if flg['d'] and not flg['m']:
         msgr.message("Exploring the SVC domain.")
         grid = explore_SVC(Xbt, Ybt, n_folds=5, n_jobs=int(opt['svc_n_jobs']),
                            **kwargs)
@@ -671,10 +694,27 @@ def main(opt, flg):
         with open(opt['csv_test_cls'], 'w') as csv:
             csv.write(tocsv(res))
 
+    # benchmark the cost of the different classifiers
+    if flg['m']:
+        msgr.message("Benchmarking the classifiers.")
+        msgr.message("cls_id   cls_name          mean     std  fit_time "
+                     "pred_time    samples/s   rss_increase")
+        bench = list(classifiers)
+        bindexes = (list(indexes) if indexes
+                    else list(range(len(classifiers))))
+        if flg['d']:
+            svcs = svc_classifiers(**kwargs)
+            start = max(bindexes) + 1 if bindexes else 0
+            bench.extend(svcs)
+            bindexes.extend(range(start, start + len(svcs)))
+        benchmark_clsfiers(bench, Xt, Yt, indexes=bindexes, n_folds=5,
+                           n_jobs=int(opt['bench_n_jobs']),
+                           report=opt['bench_report'])
+
     if flg['c']:
         # classify
-        data = np.load(opt['npy_data'])
-        indx = np.load(opt['npy_index'])
+        data = np.load(opt['npy_data'], mmap_mode='c')
+        indx = np.load(opt['npy_index'], mmap_mode='r')
 
         # Substitute using column values
         data, dummy = substitute(data, rules, cols[1:])